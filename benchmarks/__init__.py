@@ -0,0 +1,4 @@
+"""
+offline benchmarks for the fetch/clean/index pipeline, run them from the repo root,
+e.g. python -m benchmarks.text_extraction
+"""
@@ -0,0 +1,366 @@
+"""
+local stand-ins for the services the pipeline talks to, used by the benchmarks.
+
+* FakeServer: an http server playing both the ssc plus drupal api (all-ids,
+  updated-ids/week|month, page-by-id with ETag/304) and the azure openai
+  embeddings endpoint (deterministic vectors out of a hash of the text).
+  latency and the rate of 503s are configurable.
+* MemoryBlobServiceClient: in memory blob storage, the subset of
+  BlobServiceClient/ContainerClient/BlobClient used by function_app and sscplus.
+  latency is added to every call on a blob (not the listings). with a directory,
+  the content of the blobs goes to files in it (only the names and metadata stay
+  in memory), so it does not add up in the memory of the benchmarked process.
+  AsyncMemoryBlobServiceClient is the azure.storage.blob.aio flavour of it, on the
+  same blobs, for the crawler.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import numpy as np
+from azure.core import MatchConditions
+from azure.core.exceptions import (ResourceExistsError, ResourceModifiedError,
+                                   ResourceNotFoundError)
+
+TYPES = ["page", "news-item", "blog", "article"]
+
+WORDS = ("service network cloud server storage account request support security policy employee "
+         "department project update access government digital data platform migration incident").split()
+
+def page_type(nid: int) -> str:
+    return TYPES[nid % len(TYPES)]
+
+def page_body(nid: int, lang: str, version: int = 0, paragraphs: int = 6) -> str:
+    """ html in the shape of the drupal bodies: navigation and scripts around a few paragraphs of text """
+    rng = random.Random(f"{nid}-{lang}-{version}")
+    text = "".join(f"<p>{' '.join(rng.choice(WORDS) for _ in range(rng.randint(40, 120)))}.</p>\n" for _ in range(paragraphs))
+    return (f"<div class=\"nav\"><ul><li><a href=\"/{lang}\">Home</a></li></ul></div>"
+            f"<script>var nid = {nid};</script><h2>Page {nid} ({lang}) v{version}</h2>\n{text}"
+            f"<section class=\"block-date-modified-block\">Date modified: 2024-01-01</section>")
+
+def embedding(text: str, dim: int) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(dim, dtype=np.float32)
+
+class FakeServer:
+    def __init__(self, ids: int, updated: float = 0.02, latency: float = 0.0, failure_rate: float = 0.0,
+                 dim: int = 1536, seed: int = 0):
+        self.ids = ids
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.dim = dim
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # pages listed by updated-ids/*, their content changes (version 1)
+        self.updated = set(random.Random(seed).sample(range(1, ids + 1), int(ids * updated)))
+        self.versions: dict[int, int] = {}
+        self.requests = 0
+        self.failures = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(self))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self) -> "FakeServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def publish_updates(self) -> None:
+        """ the pages listed by updated-ids/* get a new version """
+        for nid in self.updated:
+            self.versions[nid] = self.versions.get(nid, 0) + 1
+
+    def fail(self) -> bool:
+        with self.lock:
+            self.requests += 1
+            failed = self.failure_rate > 0 and self.random.random() < self.failure_rate
+            self.failures += failed
+            return failed
+
+    def ids_payload(self, endpoint: str) -> list[dict]:
+        nids = range(1, self.ids + 1) if endpoint == "all-ids" else sorted(self.updated)
+        return [{"nid": str(nid), "type": page_type(nid)} for nid in nids]
+
+    def page_payload(self, nid: int, lang: str) -> list[dict]:
+        version = self.versions.get(nid, 0)
+        return [{"nid": str(nid), "title": f"Page {nid} ({lang})", "url": f"/{lang}/node/{nid}",
+                 "date": f"2024-01-{version + 1:02d}", "body": page_body(nid, lang, version)}]
+
+    def embeddings_payload(self, request: dict) -> dict:
+        texts = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        data = []
+        for i, text in enumerate(texts):
+            vector = embedding(text, self.dim)
+            value = base64.b64encode(vector.tobytes()).decode() if request.get("encoding_format") == "base64" else vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": value})
+        tokens = sum(len(text) // 4 + 1 for text in texts)
+        return {"object": "list", "data": data, "model": request.get("model", "text-embedding-ada-002"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+def _handler(fake: FakeServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if fake.latency:
+                time.sleep(fake.latency)
+            if fake.fail():
+                return self._send(503, b"unavailable", {"Retry-After": "0"})
+            match = re.match(r"^/(en|fr)/rest/(all-ids|updated-ids/week|updated-ids/month|page-by-id/(\d+))$", self.path)
+            if match is None:
+                return self._send(404, b"not found")
+            if match.group(3) is None:
+                return self._send(200, json.dumps(fake.ids_payload(match.group(2))).encode())
+            nid = int(match.group(3))
+            if nid < 1 or nid > fake.ids:
+                return self._send(404, b"not found")
+            body = json.dumps(fake.page_payload(nid, match.group(1))).encode()
+            etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+            if self.headers.get("If-None-Match") == etag:
+                return self._send(304, b"", {"ETag": etag})
+            self._send(200, body, {"ETag": etag})
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if fake.latency:
+                time.sleep(fake.latency)
+            if not self.path.split("?")[0].endswith("/embeddings"):
+                return self._send(404, b"not found")
+            if fake.fail():
+                return self._send(429, b"{}", {"retry-after-ms": "10"})
+            self._send(200, json.dumps(fake.embeddings_payload(request)).encode())
+
+        def _send(self, status: int, body: bytes, headers: Optional[dict] = None):
+            self.send_response(status)
+            for name, value in {"Content-Type": "application/json", **(headers or {})}.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+class _DiskData:
+    """ content of a blob in a file of the directory of the storage, named after its md5 """
+    def __init__(self, directory: str, data: bytes):
+        self.md5 = hashlib.md5(data).hexdigest()
+        self.size = len(data)
+        self.path = os.path.join(directory, self.md5)
+        if not os.path.exists(self.path):
+            with open(self.path, "wb") as f:
+                f.write(data)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __bytes__(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+class _Download:
+    def __init__(self, data: bytes, properties: "_BlobProperties"):
+        self.data = data
+        self.properties = properties
+
+    def readall(self) -> bytes:
+        return bytes(self.data)
+
+    def readinto(self, stream) -> int:
+        stream.write(bytes(self.data))
+        return len(self.data)
+
+    def chunks(self):
+        yield bytes(self.data)
+
+class _BlobProperties:
+    def __init__(self, name: str, data: bytes, metadata: dict):
+        self.name = name
+        self.size = len(data)
+        self.metadata = dict(metadata)
+        self.etag = '"' + (data.md5 if isinstance(data, _DiskData) else hashlib.md5(data).hexdigest()) + '"'
+
+class MemoryBlobClient:
+    def __init__(self, service: "MemoryBlobServiceClient", container_name: str, blob_name: str):
+        self.service = service
+        self.container_name = container_name
+        self.blob_name = blob_name
+        self.url = f"memory://{container_name}/{blob_name}"
+
+    def _wait(self) -> None:
+        if self.service.latency:
+            time.sleep(self.service.latency)
+
+    def _get(self) -> tuple:
+        self._wait()
+        with self.service.lock:
+            try:
+                return self.service.blobs[(self.container_name, self.blob_name)]
+            except KeyError:
+                raise ResourceNotFoundError(f"{self.url} not found")
+
+    def upload_blob(self, data, overwrite: bool = False, metadata: Optional[dict] = None, etag: Optional[str] = None,
+                    match_condition: Optional[MatchConditions] = None, **kwargs) -> dict:
+        if hasattr(data, "read"):
+            data = data.read()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._wait()
+        with self.service.lock:
+            current = self.service.blobs.get((self.container_name, self.blob_name))
+            if not overwrite and current is not None:
+                raise ResourceExistsError(f"{self.url} already exists")
+            if match_condition == MatchConditions.IfNotModified and (current is None or _BlobProperties(self.blob_name, *current).etag != etag):
+                raise ResourceModifiedError(f"{self.url} was modified")
+            stored = self.service.blobs[(self.container_name, self.blob_name)] = (self.service.store(bytes(data)), metadata or {})
+        return {"etag": _BlobProperties(self.blob_name, stored[0], {}).etag}
+
+    def download_blob(self, **kwargs) -> _Download:
+        data, metadata = self._get()
+        return _Download(data, _BlobProperties(self.blob_name, data, metadata))
+
+    def get_blob_properties(self) -> _BlobProperties:
+        data, metadata = self._get()
+        return _BlobProperties(self.blob_name, data, metadata)
+
+    def exists(self) -> bool:
+        self._wait()
+        with self.service.lock:
+            return (self.container_name, self.blob_name) in self.service.blobs
+
+    def delete_blob(self, **kwargs) -> None:
+        self._get()
+        with self.service.lock:
+            self.service.blobs.pop((self.container_name, self.blob_name), None)
+
+    def start_copy_from_url(self, url: str, **kwargs) -> dict:
+        container_name, blob_name = url[len("memory://"):].split("/", 1)
+        source = self.service.get_blob_client(container_name, blob_name)._get()
+        with self.service.lock:
+            self.service.blobs[(self.container_name, self.blob_name)] = source
+        return {"copy_status": "success", "etag": _BlobProperties(self.blob_name, source[0], {}).etag}
+
+class MemoryContainerClient:
+    def __init__(self, service: "MemoryBlobServiceClient", container_name: str):
+        self.service = service
+        self.container_name = container_name
+
+    def get_blob_client(self, blob: str) -> MemoryBlobClient:
+        return MemoryBlobClient(self.service, self.container_name, blob)
+
+    def list_blob_names(self, name_starts_with: str = "", **kwargs) -> list[str]:
+        with self.service.lock:
+            return sorted(name for container, name in self.service.blobs
+                          if container == self.container_name and name.startswith(name_starts_with))
+
+    def list_blobs(self, name_starts_with: str = "", **kwargs) -> list[_BlobProperties]:
+        with self.service.lock:
+            return [_BlobProperties(name, data, metadata) for (container, name), (data, metadata) in sorted(self.service.blobs.items())
+                    if container == self.container_name and name.startswith(name_starts_with)]
+
+    def walk_blobs(self, name_starts_with: str = "", delimiter: str = "/", **kwargs) -> list[_BlobProperties]:
+        """ blobs and virtual directories right under the prefix (directories are only named) """
+        items: dict[str, _BlobProperties] = {}
+        for name in self.list_blob_names(name_starts_with):
+            rest = name[len(name_starts_with):]
+            if delimiter in rest:
+                prefix = name_starts_with + rest.split(delimiter)[0] + delimiter
+                items.setdefault(prefix, _BlobProperties(prefix, b"", {}))
+            else:
+                items[name] = _BlobProperties(name, b"", {})
+        return list(items.values())
+
+    def delete_blob(self, blob: str, **kwargs) -> None:
+        self.get_blob_client(blob).delete_blob()
+
+class MemoryBlobServiceClient:
+    def __init__(self, latency: float = 0.0, directory: Optional[str] = None):
+        self.latency = latency
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.blobs: dict[tuple[str, str], tuple[bytes, dict]] = {}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def store(self, data: bytes):
+        """ what the blobs keep of the content, the bytes or their file """
+        return _DiskData(self.directory, data) if self.directory else data
+
+    def get_container_client(self, container: str) -> MemoryContainerClient:
+        return MemoryContainerClient(self, container)
+
+    def get_blob_client(self, container: str, blob: str) -> MemoryBlobClient:
+        return MemoryBlobClient(self, container, blob)
+
+    def size(self, container: str, prefix: str = "") -> tuple[int, int]:
+        """ number of blobs and bytes under a prefix """
+        with self.lock:
+            sizes = [len(data) for (c, name), (data, _) in self.blobs.items() if c == container and name.startswith(prefix)]
+        return len(sizes), sum(sizes)
+
+class AsyncMemoryBlobClient:
+    def __init__(self, blob_client: MemoryBlobClient, latency: float):
+        self.blob_client = blob_client
+        self.latency = latency
+        self.blob_name = blob_client.blob_name
+        self.url = blob_client.url
+
+    async def _call(self, method: str, *args, **kwargs):
+        # the latency is awaited, not slept, so the event loop keeps going
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return getattr(self.blob_client, method)(*args, **kwargs)
+
+    async def upload_blob(self, data, **kwargs) -> dict:
+        return await self._call("upload_blob", data, **kwargs)
+
+    async def get_blob_properties(self) -> _BlobProperties:
+        return await self._call("get_blob_properties")
+
+    async def start_copy_from_url(self, url: str, **kwargs) -> dict:
+        return await self._call("start_copy_from_url", url, **kwargs)
+
+class AsyncMemoryContainerClient:
+    def __init__(self, container_client: MemoryContainerClient, latency: float):
+        self.container_client = container_client
+        self.latency = latency
+
+    def get_blob_client(self, blob: str) -> AsyncMemoryBlobClient:
+        return AsyncMemoryBlobClient(self.container_client.get_blob_client(blob), self.latency)
+
+    async def list_blobs(self, name_starts_with: str = "", **kwargs):
+        for blob in self.container_client.list_blobs(name_starts_with, **kwargs):
+            yield blob
+
+class AsyncMemoryBlobServiceClient:
+    def __init__(self, service: MemoryBlobServiceClient):
+        # same blobs, without the latency (awaited by AsyncMemoryBlobClient instead)
+        self.service = MemoryBlobServiceClient()
+        self.service.blobs, self.service.lock, self.service.directory = service.blobs, service.lock, service.directory
+        self.latency = service.latency
+
+    async def __aenter__(self) -> "AsyncMemoryBlobServiceClient":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        pass
+
+    def get_container_client(self, container: str) -> AsyncMemoryContainerClient:
+        return AsyncMemoryContainerClient(self.service.get_container_client(container), self.latency)
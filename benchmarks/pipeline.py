@@ -0,0 +1,302 @@
+"""
+end to end benchmark of the pipeline against local stand-ins (see benchmarks/fakes.py),
+no drupal, storage account or azure openai needed.
+
+    python -m benchmarks.pipeline [--pages 1000 10000 50000] [--latency 0.01] [--failure-rate 0.01] [--blob-latency 0.005]
+                                  [--storage memory|disk|<connection string>] [--output results.json]
+                                  [--baseline results.json] [--tolerance 0.2]
+
+for every size, a fresh process runs the stages one after the other:
+
+  fetch   fetch_sscplus_data (full crawl), activities called in process
+  load    _get_pages_as_json of the crawl
+  build   build_index_orc, embeddings from the fake endpoint
+  update  get_page_updates, after UPDATED of the pages changed on the fake site
+
+and reports pages/sec and the peak memory (rss, the loader processes included when
+psutil is installed) of each stage, with the main counters of sscplus.metrics.
+--baseline compares with the output of a previous run and fails if a stage is more
+than --tolerance slower.
+
+before that, the import of function_app (what every worker pays on a cold start) is
+profiled with python -X importtime: total, slowest top level imports, and the time
+the index stack (llama_index, langchain) adds when an index function first needs it.
+
+--storage takes an azurite (or any storage account) connection string instead of the
+in memory blob storage, --blob-latency adds a round trip to the reads and writes of the
+in memory one. --storage disk keeps the content of the in memory blobs in files, so the
+peak memory of a stage does not include what the previous stages uploaded (and build
+only has BUILD_BATCH_DOCUMENTS pages of a shard in memory, keep it below the pages of
+a shard to compare the sizes). the scratch directories of function_app under /tmp (page cache included)
+are reset, the stages of one size share them like activities running on one worker.
+"""
+import argparse
+import inspect
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from benchmarks.fakes import AsyncMemoryBlobServiceClient, FakeServer, MemoryBlobServiceClient
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# azurite's well known development account, function_app builds its (unused) client out of it
+AZURITE = ("DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;"
+           "AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFEsXeOxZ4Q1U8tv3DnA==;"
+           "BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;")
+SCRATCH_DIRS = ["/tmp/storage", "/tmp/checkpoints", "/tmp/build", "/tmp/latest", "/tmp/embedding-cache", os.path.dirname(os.getenv("PAGE_CACHE_PATH", "/tmp/page-cache/pages.sqlite"))]
+COUNTERS = ["fetch.requests", "fetch.retries", "fetch.bytes", "blob.bytes_written", "load.pages", "load.bytes",
+            "page_cache.raw_hits", "page_cache.clean_hits",
+            "index.nodes", "embed.texts", "embed.tokens", "embed.batches", "embed.throttled", "sync.uploaded_bytes"]
+
+class PeakMemory:
+    """ highest rss seen while in the block, sampled every `interval` seconds """
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = 0
+        self.stop = threading.Event()
+        self.process = psutil.Process() if psutil else None
+
+    def rss(self) -> int:
+        if self.process is None:
+            # high-water mark of the whole process, not of the block
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        processes = [self.process] + self.process.children(recursive=True)
+        total = 0
+        for process in processes:
+            try:
+                total += process.memory_info().rss
+            except psutil.Error:
+                pass
+        return total
+
+    def sample(self) -> None:
+        while not self.stop.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self) -> "PeakMemory":
+        self.peak = self.rss()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.rss())
+
+class Orchestration:
+    """
+    just enough of a DurableOrchestrationContext to run an orchestrator in process:
+    activities are called directly, task_all fans out to a thread pool.
+    """
+    def __init__(self, app, input, concurrency: int):
+        self.app = app
+        self.input = input
+        self.instance_id = f"benchmark-{os.getpid()}-{time.time_ns()}"
+        self.current_utc_datetime = datetime.now(timezone.utc)
+        self.concurrency = concurrency
+
+    def get_input(self):
+        return self.input
+
+    def call_activity(self, name: str, input=None) -> tuple:
+        return (name, input)
+
+    def call_activity_with_retry(self, name: str, retry_options, input=None) -> tuple:
+        return (name, input)
+
+    def task_all(self, tasks: list) -> list:
+        return tasks
+
+    def activity(self, task: tuple):
+        return getattr(self.app, task[0])._function._func(task[1])
+
+    def run(self, orchestrator):
+        # the durable handle keeps the generator function in its closure
+        fn = inspect.getclosurevars(orchestrator._function._func).nonlocals["fn"]
+        generator, result = fn(self), None
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            try:
+                while True:
+                    task = generator.send(result)
+                    result = list(executor.map(self.activity, task)) if isinstance(task, list) else self.activity(task)
+            except StopIteration as e:
+                return e.value
+
+def _configure(args, server: FakeServer):
+    """ import function_app against the stand-ins """
+    os.environ.setdefault("HTTP_RATE_LIMIT", "0")
+    os.environ["StorageConnectionString"] = AZURITE if args.storage in ["memory", "disk"] else args.storage
+    os.environ["AzureOpenAIEndpoint"] = server.url
+    os.environ["AzureOpenAIKey"] = "benchmark"
+    import function_app
+
+    function_app.domain = server.url
+    if args.storage in ["memory", "disk"]:
+        directory = tempfile.mkdtemp(prefix="blobs-") if args.storage == "disk" else None
+        function_app._blob_service_client = MemoryBlobServiceClient(latency=args.blob_latency, directory=directory)
+        function_app._get_async_blob_service_client = lambda: AsyncMemoryBlobServiceClient(function_app._blob_service_client)
+    else:
+        for container in ["sscplusdata", "indices"]:
+            try:
+                function_app.get_blob_service_client().create_container(container)
+            except Exception:
+                pass
+    return function_app
+
+def _promote(blob_service_client, index: str) -> None:
+    """ latest points at the version of <index>, what the weekly update works on (same as the publish_index route) """
+    from sscplus.versions import publish, read_pointer
+
+    container_client = blob_service_client.get_container_client("indices")
+    publish(container_client, "latest", read_pointer(container_client, index)[0]["version"])
+
+def run_child(args) -> list[dict]:
+    for path in SCRATCH_DIRS:
+        shutil.rmtree(path, ignore_errors=True)
+
+    ids = max(args.pages // 2, 1)
+    with FakeServer(ids, updated=args.updated, latency=args.latency, failure_rate=args.failure_rate, dim=args.dim) as server:
+        app = _configure(args, server)
+        logging.getLogger().setLevel(args.log_level.upper())
+        from sscplus.metrics import metrics, summarise
+        date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        results = []
+
+        def stage(name: str, pages: int, fn):
+            before = metrics.snapshot()
+            start = time.perf_counter()
+            with PeakMemory() as memory:
+                outcome = fn()
+            seconds = time.perf_counter() - start
+            counters = summarise(before, metrics.snapshot())["counters"]
+            results.append({"pages": args.pages, "stage": name, "documents": pages, "seconds": round(seconds, 2),
+                            "pages_per_second": round(pages / max(seconds, 1e-9), 1), "peak_rss_mb": round(memory.peak / 2 ** 20),
+                            "counters": {key: counters[key] for key in COUNTERS if key in counters}, "outcome": outcome})
+            return outcome
+
+        stage("fetch", ids * 2, lambda: Orchestration(app, {"full": True}, app.download_window_size).run(app.fetch_sscplus_data))
+        stage("load", ids * 2, lambda: len(app._get_pages_as_json("preload", date)))
+        stage("build", ids * 2, lambda: Orchestration(app, {"date": date, "index": "benchmark"}, args.build_concurrency).run(app.build_index_orc))
+        _promote(app.get_blob_service_client(), "benchmark")
+        server.publish_updates()
+        stage("update", len(server.updated) * 2, lambda: app.get_page_updates._function._func(None))
+        if args.storage == "disk":
+            shutil.rmtree(app._blob_service_client.directory, ignore_errors=True)
+    return results
+
+# the lazy imports of the index functions, see function_app.py
+INDEX_IMPORTS = "import langchain_openai, llama_index, sscplus.checkpoint, sscplus.chunking, sscplus.embeddings, sscplus.shards, sscplus.spill"
+HEAVY_MODULES = ["llama_index", "langchain", "langchain_openai", "openai", "numpy", "azure.storage.blob"]
+
+def import_profile(top: int = 8) -> dict:
+    """ cold import of function_app in a fresh interpreter """
+    code = ("import json, sys, time; start = time.perf_counter(); import function_app; app = time.perf_counter() - start; "
+            f"heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]; start = time.perf_counter(); {INDEX_IMPORTS}; "
+            "print(json.dumps({'seconds': app, 'heavy_modules': heavy, 'index_seconds': time.perf_counter() - start}))")
+    env = dict(os.environ, StorageConnectionString=os.getenv("StorageConnectionString", AZURITE))
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env, capture_output=True, text=True, check=True)
+    profile = json.loads(process.stdout.strip().splitlines()[-1])
+    # "import time: self [us] | cumulative | imported package", nested imports are indented by 2 and
+    # listed before the module importing them: the direct imports of function_app come right before it
+    imports = []
+    for line in process.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        indent = len(fields[2]) - len(fields[2].lstrip()) - 1
+        if indent == 0 and fields[2].strip() == "function_app":
+            break
+        if indent == 0:
+            imports = []
+        elif indent == 2:
+            imports.append((fields[2].strip(), int(fields[1]) / 1e6))
+    profile["slowest"] = [[name, round(seconds, 3)] for name, seconds in sorted(imports, key=lambda item: -item[1])[:top]]
+    profile["seconds"], profile["index_seconds"] = round(profile["seconds"], 3), round(profile["index_seconds"], 3)
+    return profile
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """ stages more than tolerance slower than in the baseline """
+    previous = {(entry["pages"], entry["stage"]): entry for entry in baseline}
+    regressions = []
+    for entry in results:
+        base = previous.get((entry["pages"], entry["stage"]))
+        if base and entry["pages_per_second"] < base["pages_per_second"] * (1 - tolerance):
+            regressions.append(f"{entry['stage']} at {entry['pages']} pages: {entry['pages_per_second']} pages/sec "
+                               f"(baseline {base['pages_per_second']})")
+    return regressions
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, nargs="+", default=[1000, 10000, 50000], help="pages (en + fr) of the fake site")
+    parser.add_argument("--updated", type=float, default=0.02, help="share of the pages changed before the update stage")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request of the fake server")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of requests answered with 503/429")
+    parser.add_argument("--blob-latency", type=float, default=0.0, help="seconds added to every blob read/write of the in memory storage")
+    parser.add_argument("--dim", type=int, default=1536, help="dimension of the fake embeddings")
+    parser.add_argument("--build-concurrency", type=int, default=4, help="shards built at the same time")
+    parser.add_argument("--storage", default="memory", help="'memory', 'disk' or a storage connection string (azurite)")
+    parser.add_argument("--log-level", default="error", help="of the pipeline logs (retries, throttles ...)")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--baseline", help="results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown allowed against the baseline")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        args.pages = args.pages[0]
+        with open(args.child, "w", encoding="utf-8") as f:
+            json.dump(run_child(args), f)
+        return 0
+
+    profile = import_profile()
+    print(f"import function_app: {profile['seconds']:.2f}s, index stack on first use: {profile['index_seconds']:.2f}s, "
+          f"heavy modules at import: {', '.join(profile['heavy_modules']) or 'none'}")
+    for name, seconds in profile["slowest"]:
+        print(f"    {name:<40} {seconds:>8.3f}s")
+
+    results = []
+    print(f"{'pages':>8} {'stage':<8} {'seconds':>10} {'pages/sec':>12} {'peak rss mb':>12}")
+    for pages in args.pages:
+        # one process per size, so the peak memory of one does not carry over to the next
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+            path = f.name
+        subprocess.run([sys.executable, "-m", "benchmarks.pipeline", "--pages", str(pages), "--updated", str(args.updated),
+                        "--latency", str(args.latency), "--failure-rate", str(args.failure_rate), "--blob-latency", str(args.blob_latency), "--dim", str(args.dim),
+                        "--build-concurrency", str(args.build_concurrency), "--storage", args.storage, "--log-level", args.log_level, "--child", path], check=True)
+        with open(path, encoding="utf-8") as f:
+            entries = json.load(f)
+        os.remove(path)
+        for entry in entries:
+            print(f"{entry['pages']:>8} {entry['stage']:<8} {entry['seconds']:>10.2f} {entry['pages_per_second']:>12.1f} {entry['peak_rss_mb']:>12}")
+        results.extend(entries)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"import": profile, "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if profile["seconds"] > baseline["import"]["seconds"] * (1 + args.tolerance):
+            regressions.append(f"import function_app: {profile['seconds']}s (baseline {baseline['import']['seconds']}s)")
+        for regression in regressions:
+            print(f"slower than the baseline: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
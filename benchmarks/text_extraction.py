@@ -0,0 +1,95 @@
+"""
+golden check and pages/sec for each html to text backend (see sscplus.text_extraction),
+and for the structured text of the chunker.
+
+    python -m benchmarks.text_extraction [--seconds 2] [--regenerate]
+
+every golden/<name>.html has a golden/<name>.txt with the text the reference (bs4)
+extraction gives, that every backend has to reproduce, as well as
+flatten_text(extract_structured_text(...)) (newlines inside the strings become spaces),
+and a golden/<name>.structured.txt with the extract_structured_text output (the lines
+the chunker gets). --regenerate rewrites them, only do that if the output changed on
+purpose (and read the diff of the .structured.txt files, they have no other reference).
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+from sscplus.text_extraction import (BACKENDS, IGNORE_SELECTORS, available_backends,
+                                     extract_structured_text, flatten_text)
+
+golden_dir = os.path.join(os.path.dirname(__file__), "golden")
+
+def flattened_text(body: str, ignore_selectors: list[str]) -> str:
+    return flatten_text(extract_structured_text(body, ignore_selectors))
+
+# extraction -> (function, its expected output out of the golden files of a page), the backends first
+EXTRACTIONS = {
+    **{backend: (BACKENDS[backend], lambda golden: golden[".txt"]) for backend in available_backends()},
+    "structured": (extract_structured_text, lambda golden: golden[".structured.txt"]),
+    "flattened":  (flattened_text, lambda golden: golden[".txt"] and golden[".txt"].replace("\n", " ")),
+}
+# lxml/selectolax build their own tree, they are best effort on broken markup
+BEST_EFFORT = ["lxml", "selectolax"]
+
+def _read(path: str):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+def load_golden() -> list[tuple]:
+    """ (name, body, {suffix: expected text}) of the golden pages """
+    pages = []
+    for path in sorted(glob.glob(os.path.join(golden_dir, "*.html"))):
+        base = path[:-len(".html")]
+        expected = {suffix: _read(base + suffix) for suffix in (".txt", ".structured.txt")}
+        pages.append((os.path.basename(path), _read(path), expected))
+    return pages
+
+def regenerate(pages: list[tuple]) -> None:
+    for name, body, _ in pages:
+        base = os.path.join(golden_dir, name[:-len(".html")])
+        for extract, suffix in [(BACKENDS["bs4"], ".txt"), (extract_structured_text, ".structured.txt")]:
+            with open(base + suffix, "w", encoding="utf-8") as f:
+                f.write(extract(body, IGNORE_SELECTORS))
+
+def check(extraction: str, pages: list[tuple]) -> list[str]:
+    """ names of the golden pages the extraction does not reproduce """
+    extract, expected = EXTRACTIONS[extraction]
+    return [name for name, body, golden in pages if extract(body, IGNORE_SELECTORS) != expected(golden)]
+
+def pages_per_second(extraction: str, pages: list[tuple], seconds: float) -> float:
+    (extract, _), count, start = EXTRACTIONS[extraction], 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for _, body, _ in pages:
+            extract(body, IGNORE_SELECTORS)
+        count += len(pages)
+    return count / (time.perf_counter() - start)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=2.0, help="time spent measuring each backend")
+    parser.add_argument("--regenerate", action="store_true", help="rewrite the golden .txt files with the bs4 and extract_structured_text output")
+    args = parser.parse_args()
+
+    pages = load_golden()
+    if args.regenerate:
+        regenerate(pages)
+        pages = load_golden()
+
+    failed = False
+    print(f"{'extraction':<12} {'golden':>10} {'pages/sec':>12}")
+    for extraction in EXTRACTIONS:
+        mismatches = check(extraction, pages)
+        failed = failed or (extraction not in BEST_EFFORT and bool(mismatches))
+        golden = "ok" if not mismatches else f"{len(pages) - len(mismatches)}/{len(pages)}"
+        print(f"{extraction:<12} {golden:>10} {pages_per_second(extraction, pages, args.seconds):>12.1f}")
+        for name in mismatches:
+            print(f"    differs on {name}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,49 +1,87 @@
-import glob
+import asyncio
+import itertools
 import json  # bourne
 import logging
 import os
-import re
+import shutil
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import uuid
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Iterator
 
 import azure.durable_functions as df
 import azure.functions as func
 import requests
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient
-from azure.storage.fileshare import ShareServiceClient
-from bs4 import BeautifulSoup
+from azure.core.exceptions import ResourceNotFoundError
 from dotenv import load_dotenv
-from langchain_openai import AzureChatOpenAI
-from langchain_openai import AzureOpenAIEmbeddings
-from llama_index import (Document, LLMPredictor, PromptHelper, ServiceContext,
-                         StorageContext, VectorStoreIndex,
-                         load_index_from_storage, set_global_service_context)
-from llama_index.callbacks import CallbackManager, LlamaDebugHandler
-from llama_index.llms import AzureOpenAI
-from tenacity import retry, stop_after_attempt, wait_fixed
+
+from sscplus.fetch import Download, conditional_headers, get_fetch_client
+from sscplus.loader import (delete_corpus, iter_corpus, iter_pages,
+                            structured_text, write_corpus_shards)
+from sscplus.metrics import in_context, merge_reports, metrics, run_report
+from sscplus.page_cache import get_page_cache
+from sscplus.sync import download_dir, sync_block_size, upload_files
+from sscplus.versions import (directory_files, new_version, prune, publish,
+                              read_pointer, replace_directory, resolve,
+                              sync_version_to_share, version_prefix,
+                              write_version)
+
+# every worker imports this module before running anything, only what the fetch activities need is
+# imported here. the llama_index/langchain stack (and the modules of sscplus built on it) is imported
+# by the functions that build or update the index, the clients are created on first use.
+if TYPE_CHECKING:
+    from azure.storage.blob import BlobServiceClient
+    from llama_index import Document, LLMPredictor, ServiceContext
+
+    from sscplus.embedding_cache import EmbeddingCache
 
 load_dotenv()
 
 app = df.DFApp(http_auth_level=func.AuthLevel.FUNCTION)
 
 connection_string   = os.getenv("StorageConnectionString")
-blob_service_client = BlobServiceClient.from_connection_string(str(connection_string))
 
 azure_openai_uri    = os.getenv("AzureOpenAIEndpoint")
 api_key     = os.getenv("AzureOpenAIKey")
 api_version = "2023-07-01-preview"
 
-client = AzureOpenAI(
-    engine="gpt4",
-    api_version=api_version,
-    azure_endpoint=azure_openai_uri,
-    api_key=api_key
-)
-
 # make this configurable via a env variable ..
 domain = "https://plus.ssc-spc.gc.ca"
 
+# pages handled by a single download_pages activity, how many of them are fetched in parallel
+# within that activity and how many of those activities the orchestrator keeps in flight at once.
+download_batch_size  = int(os.getenv("DOWNLOAD_BATCH_SIZE", "100"))
+download_concurrency = int(os.getenv("DOWNLOAD_CONCURRENCY", "8"))
+download_window_size = int(os.getenv("DOWNLOAD_WINDOW_SIZE", "4"))
+
+# retries of the index build activities, they resume from their last checkpoint (see sscplus/checkpoint.py)
+build_retry_options = df.RetryOptions(
+    first_retry_interval_in_milliseconds=int(os.getenv("BUILD_RETRY_INTERVAL_SECONDS", "60")) * 1000,
+    max_number_of_attempts=int(os.getenv("BUILD_RETRY_ATTEMPTS", "3")))
+
+_blob_service_client: "BlobServiceClient | None" = None
+_blob_service_client_lock = threading.Lock()
+
+def get_blob_service_client() -> "BlobServiceClient":
+    """ one client (and connection pool) per worker, created the first time it is needed """
+    global _blob_service_client
+    with _blob_service_client_lock:
+        if _blob_service_client is None:
+            from azure.storage.blob import BlobServiceClient
+
+            # large index files are moved in parallel blocks/chunks of this size, see sscplus/sync.py
+            _blob_service_client = BlobServiceClient.from_connection_string(str(connection_string),
+                                                                            max_single_put_size=sync_block_size, max_block_size=sync_block_size,
+                                                                            max_single_get_size=sync_block_size, max_chunk_get_size=sync_block_size)
+        return _blob_service_client
+
+# where the date of the last successful crawl is kept (high-water mark for the incremental crawls)
+crawl_state_blob_name = "crawl-state.json"
+# incremental crawls only refetch the updated pages, a full crawl is forced once the last one is this old
+crawl_full_max_age_days = int(os.getenv("CRAWL_FULL_MAX_AGE_DAYS", "30"))
+
 @app.route(route="orchestrators/fetch_data")
 @app.durable_client_input(client_name="client")
 async def fetch_data(req: func.HttpRequest, client) -> func.HttpResponse:
@@ -58,7 +96,9 @@ async def fetch_data(req: func.HttpRequest, client) -> func.HttpResponse:
     if response.status_code == 200:
         logging.info(f"Able to reach ipinfo.io/ip... External ip is: {response.text}")
 
-    instance_id = await client.start_new("fetch_sscplus_data")
+    # ?full=true forces a full crawl, otherwise only the pages updated since the last crawl are fetched
+    full = str(req.params.get('full', '')).lower() == "true"
+    instance_id = await client.start_new("fetch_sscplus_data", None, {"full": full})
     response = client.create_check_status_response(req, instance_id)
 
     return response
@@ -67,21 +107,99 @@ async def fetch_data(req: func.HttpRequest, client) -> func.HttpResponse:
 @app.orchestration_trigger(context_name="context") #without a param the task is not properly registered..
 def fetch_sscplus_data(context: df.DurableOrchestrationContext):
 
-    #This will change in the future but the delta grab of ids is not yet implemented
-    present_date = cutoffdate = datetime.now().strftime("%Y-%m-%d")
-    pages = yield context.call_activity("get_all_ids", (present_date, cutoffdate))
+    options = context.get_input() or {}
+
+    # (use the orchestration clock, datetime.now() is not replay safe)
+    present_date = context.current_utc_datetime.strftime("%Y-%m-%d")
+    # the cutoff is the last successful crawl, it decides if we grab the ids updated this week, month or all of them
+    cutoffdate = None if options.get("full") else (yield context.call_activity("get_last_crawl_date", present_date))
+    # every activity reports what it measured under reports/<instance id>/, see sscplus/metrics.py
+    run = context.instance_id
+    pages = yield context.call_activity("get_all_ids", (present_date, cutoffdate, run))
+    if pages is None:
+        return "failed to get the ids to download .."
     logging.info(f"There are {len(pages)} page(s) to process.")
 
     # compare ids against what has been downloaded so far. make a list of missing ids.
-    download_pages_tasks = []
-    for page in pages:
-        blob_client = blob_service_client.get_blob_client("sscplusdata", page['blob_name'])
-        if not blob_client.exists():
-            download_pages_tasks.append(context.call_activity("download_page", page))
-    # once we loop over the pages that do not exists in the storage, we task the function to download them.
-    list_of_download = yield context.task_all(download_pages_tasks)
+    # this is done in an activity, orchestrators should not be doing any I/O themselves.
+    missing_pages = yield context.call_activity("get_missing_pages", {"date": present_date, "pages": pages})
+
+    # once we have the pages that do not exists in the storage, we task the function to download them.
+    # pages are grouped in batches and only a window of batches is scheduled at a time, otherwise
+    # the drupal ingress gets flooded and the history grows by one event per page.
+    batches = [missing_pages[i:i + download_batch_size] for i in range(0, len(missing_pages), download_batch_size)]
+    downloaded = 0
+    for i in range(0, len(batches), download_window_size):
+        download_pages_tasks = [context.call_activity("download_pages", {"run": run, "pages": batch}) for batch in batches[i:i + download_window_size]]
+        list_of_download = yield context.task_all(download_pages_tasks)
+        downloaded += sum(list_of_download)
+
+    # an incremental crawl only fetched the updated pages, the rest are brought over from the last crawl
+    full = _get_ids_endpoint(present_date, cutoffdate) == "all-ids"
+    if not full:
+        yield context.call_activity("carry_forward_pages", (present_date, cutoffdate, run))
+
+    # only move the high-water mark if everything made it, otherwise the next run picks up from the same spot
+    if downloaded == len(missing_pages):
+        yield context.call_activity("set_last_crawl_date", {"date": present_date, "full": full})
+
+    yield context.call_activity("write_run_report", {"run": run, "name": "fetch_sscplus_data"})
+    return f"Finished downloading (or trying to ..): {downloaded}/{len(missing_pages)} page(s)"
 
-    return f"Finished downloading (or trying to ..): {len(download_pages_tasks)} page(s)"
+# Activity
+@app.activity_trigger(input_name="present_date")
+def get_last_crawl_date(present_date: str) -> str | None:
+    """
+    date of the last successful crawl, None if we never completed one or if the last
+    full crawl is more than CRAWL_FULL_MAX_AGE_DAYS old (a full crawl is due).
+    """
+    try:
+        state = _get_crawl_state()
+    except ResourceNotFoundError:
+        return None
+    last_full_crawl = state.get("last_full_crawl")
+    if not last_full_crawl or _days_between(last_full_crawl, present_date) >= crawl_full_max_age_days:
+        logging.info(f"Last full crawl was on {last_full_crawl}, forcing a full crawl")
+        return None
+    return state["last_successful_crawl"]
+
+# Activity
+@app.activity_trigger(input_name="crawl")
+def set_last_crawl_date(crawl: dict) -> str:
+    """ record the date of a successful crawl ({"date", "full"}), and of the last full one """
+    date, full = crawl["date"], crawl["full"]
+    state = {"last_successful_crawl": date}
+    try:
+        previous = _get_crawl_state()
+    except ResourceNotFoundError:
+        previous = {}
+    last_full_crawl = date if full else previous.get("last_full_crawl")
+    if last_full_crawl:
+        state["last_full_crawl"] = last_full_crawl
+    blob_client = get_blob_service_client().get_blob_client("sscplusdata", crawl_state_blob_name)
+    blob_client.upload_blob(json.dumps(state).encode('utf-8'), overwrite=True)
+    return date
+
+def _get_crawl_state() -> dict:
+    blob_client = get_blob_service_client().get_blob_client("sscplusdata", crawl_state_blob_name)
+    return json.loads(blob_client.download_blob().readall())
+
+def _days_between(start: str, end: str) -> int:
+    return (datetime.strptime(end, "%Y-%m-%d") - datetime.strptime(start, "%Y-%m-%d")).days
+
+def _get_ids_endpoint(present_date: str, cutoffdate: str | None) -> str:
+    """
+    pick the smallest drupal id listing that covers everything updated since the cutoff
+    (updated-ids/week and updated-ids/month cover the past 7 and 30 days).
+    """
+    if not cutoffdate:
+        return "all-ids"
+    gap = _days_between(cutoffdate, present_date)
+    if gap < 7:
+        return "updated-ids/week"
+    if gap < 30:
+        return "updated-ids/month"
+    return "all-ids"
 
 # Activity
 @app.activity_trigger(input_name="dates")
@@ -89,68 +207,245 @@ def get_all_ids(dates: tuple) -> list[dict]:
     """
     get all ids from the https://plus-test.ssc-spc.gc.ca/en/rest/all-ids call
 
-    refine process so we can be more selective about the ids we retreive...
-    produce a list that we will be looking at, specifically re-indexing a specific portion.
+    or only a portion of them, depending on how long ago the cutoff date (last crawl) is:
     •	/rest/updated-ids/week
       o	same
       o	updated with past 7 days
     •	/rest/updated-ids/month
       o	same
       o	updated within last 30 days
+
+    an incremental crawl also saves the all-ids listing, carry_forward_pages only
+    brings over the pages that are still on it (the deleted/unpublished ones are dropped).
+
+    returns None if the ids could not be retrieved.
     """
     logging.info(f'Getting all page IDs. Cutoff date is {dates[1]}')
     pages = []
 
-    try:
-        r = _get_and_save(f"{domain}/en/rest/all-ids", f"ids-{dates[0]}.json")
-        logging.info("Getting all ids that need to be processed...")
-        for d in r:
-            # add both pages here, en/fr versions
-            pages.append({"id": d["nid"], "type": d["type"], "url": f"{domain}/en/rest/page-by-id/{d['nid']}", "blob_name": f"preload/{dates[0]}/{d['type']}/en/{d['nid']}.json"})
-            pages.append({"id": d["nid"], "type": d["type"], "url": f"{domain}/fr/rest/page-by-id/{d['nid']}", "blob_name": f"preload/{dates[0]}/{d['type']}/fr/{d['nid']}.json"})
-    except Exception as e:
-        logging.error("Unable to send request and/or parse json. Error:" + str(e))
-        return []
+    with run_report(_get_reports_container(), dates[2], "get_all_ids") as report:
+        try:
+            endpoint = _get_ids_endpoint(dates[0], dates[1])
+            logging.info(f"Using /rest/{endpoint} to get the ids")
+            # most recent crawl before this one, used to send conditional requests and skip the pages that did not change
+            previous_date = _get_previous_date("preload", dates[0])
+            ids_blob_name = _get_ids_blob_name(dates[0]) if endpoint == "all-ids" else f"{endpoint.replace('/', '-')}-{dates[0]}.json"
+            with metrics.timer("ids.list"):
+                r = _get_and_save(f"{domain}/en/rest/{endpoint}", ids_blob_name)
+                if endpoint != "all-ids":
+                    # only saved, read by carry_forward_pages
+                    _save(f"{domain}/en/rest/all-ids", _get_ids_blob_name(dates[0]))
+            logging.info("Getting all ids that need to be processed...")
+            for d in r:
+                # add both pages here, en/fr versions
+                for lang in ["en", "fr"]:
+                    pages.append({"id": d["nid"], "type": d["type"], "url": f"{domain}/{lang}/rest/page-by-id/{d['nid']}",
+                                  "blob_name": f"preload/{dates[0]}/{d['type']}/{lang}/{d['nid']}.json",
+                                  "previous_blob_name": f"preload/{previous_date}/{d['type']}/{lang}/{d['nid']}.json" if previous_date else None})
+        except Exception as e:
+            logging.error("Unable to send request and/or parse json. Error:" + str(e))
+            report["error"] = str(e)
+            return None
+        report.update(endpoint=endpoint, pages=len(pages))
 
     return pages
 
+def _get_ids_blob_name(date: str) -> str:
+    """ where the all-ids listing of a crawl is saved """
+    return f"ids-{date}.json"
+
 # Activity
-@app.activity_trigger(input_name="page")
-def download_page(page: dict):
+@app.activity_trigger(input_name="dates")
+def carry_forward_pages(dates: tuple) -> int:
     """
-    Will query the https://plus-test.ssc-spc.gc.ca/en/rest/page-by-id/336 API
-    we make two separate calls, 1 for en and 1 for fr content.
+    copy (server side) the pages of the previous crawl, preload/<dates[1]>/, that are
+    not in preload/<dates[0]>/ and still listed by all-ids (saved by get_all_ids) so the
+    new prefix is a complete snapshot of the site, without the pages deleted since.
     """
+    container_client = get_blob_service_client().get_container_client("sscplusdata")
+    present_prefix, previous_prefix = f"preload/{dates[0]}/", f"preload/{dates[1]}/"
+    with run_report(_get_reports_container(), dates[2], "carry_forward_pages") as report:
+        ids = json.loads(container_client.get_blob_client(_get_ids_blob_name(dates[0])).download_blob().readall())
+        live = {(d["type"], str(d["nid"])) for d in ids}
+        existing = {name[len(present_prefix):] for name in container_client.list_blob_names(name_starts_with=present_prefix)}
+        to_copy, removed = [], 0
+        for blob in container_client.list_blobs(name_starts_with=previous_prefix):
+            name = blob.name[len(previous_prefix):]
+            if name in existing:
+                continue
+            # <type>/<lang>/<nid>.json
+            parts = name.split("/")
+            if len(parts) == 3 and (parts[0], parts[2][:-len(".json")]) in live:
+                to_copy.append((name, blob.etag))
+            else:
+                removed += 1
+
+        def copy(item):
+            name, etag = item
+            source = container_client.get_blob_client(previous_prefix + name)
+            with metrics.timer("blob.copy"):
+                result = container_client.get_blob_client(present_prefix + name).start_copy_from_url(source.url)
+            _cache_copy(previous_prefix + name, etag, present_prefix + name, result)
+
+        with ThreadPoolExecutor(max_workers=download_concurrency) as executor:
+            list(executor.map(in_context(copy), to_copy))
+        report.update(pages=len(to_copy), removed=removed)
+
+    logging.info(f"Carried {len(to_copy)} unchanged page(s) forward from {previous_prefix}, {removed} page(s) no longer listed")
+    return len(to_copy)
+
+# Activity
+@app.activity_trigger(input_name="manifest")
+def get_missing_pages(manifest: dict) -> list[dict]:
+    """
+    list the preload/<date>/ prefix once and return the pages that are not in it yet.
+
+    this replaces the per page blob_client.exists() call, one paged listing
+    per run instead of one HEAD request per page (x2 for en/fr). the previous
+    crawl is listed once too, with the metadata: the etag and validators of its
+    copy of a page go with the page (see _get_and_save_if_changed).
+    """
+    container_client = get_blob_service_client().get_container_client("sscplusdata")
+    existing = set(container_client.list_blob_names(name_starts_with=f"preload/{manifest['date']}/"))
+    missing = [page for page in manifest['pages'] if page['blob_name'] not in existing]
+    logging.info(f"{len(existing)} page(s) already downloaded, {len(missing)} page(s) missing.")
+
+    previous_prefixes = {page['previous_blob_name'].rsplit("/", 3)[0] + "/" for page in missing if page.get('previous_blob_name')}
+    previous = {blob.name: blob for prefix in previous_prefixes
+                for blob in container_client.list_blobs(name_starts_with=prefix, include=["metadata"])}
+    for page in missing:
+        blob = previous.get(page.get('previous_blob_name'))
+        if blob is None:
+            page['previous_blob_name'] = None
+        else:
+            page['previous_etag'], page['validators'] = blob.etag, dict(blob.metadata or {})
+
+    return missing
+
+# Activity
+@app.activity_trigger(input_name="batch")
+def download_pages(batch: dict) -> int:
+    """
+    Will query the https://plus-test.ssc-spc.gc.ca/en/rest/page-by-id/336 API for a
+    batch of pages ({"run", "pages"}, en and fr content are separate pages), fetched
+    by a pool of DOWNLOAD_CONCURRENCY threads. Returns how many pages were downloaded.
+    """
+    pages = batch["pages"]
+    with run_report(_get_reports_container(), batch["run"], "download_pages") as report:
+        with ThreadPoolExecutor(max_workers=download_concurrency) as executor:
+            results = list(executor.map(in_context(_download_page), pages))
+        report.update(pages=len(pages), downloaded=sum(results))
+
+    logging.info(f"Downloaded {sum(results)}/{len(pages)} page(s) in batch.")
+    return sum(results)
+
+def _download_page(page: dict) -> bool:
     try:
         logging.debug(f"Processing file id {page['id']}")
-        _get_and_save(page['url'], page['blob_name'])
+        _get_and_save_if_changed(page['url'], page['blob_name'], page.get('previous_blob_name'),
+                                 page.get('previous_etag'), page.get('validators'))
         return True
     except Exception as e:
+        metrics.count("fetch.failed_pages")
         logging.error("Unable to download separate page file. Error:" + str(e))
         return False
 
 # getting loads of connection terminated by fw or lb over their aks instances
-# this helps greatly, but still need a net to catch missing ids.
-@retry(stop=stop_after_attempt(5), wait=wait_fixed(3))
-def _get_and_save(url, blob_name):
-    response = requests.get(url, verify=False)
-    blob_client = blob_service_client.get_blob_client("sscplusdata", blob_name)
-    blob_client.upload_blob(json.dumps(response.json()).encode('utf-8'), overwrite=True)
+# the fetch client retries with backoff (and rate limits per host), but still need a net to catch missing ids.
+def _get_and_save(url, blob_name) -> Iterator[dict]:
+    """ upload the json array at url as is, then return its items, parsed from the spooled body as they are read """
+    download = get_fetch_client().download(url)
+    try:
+        _upload_page(get_blob_service_client().get_blob_client("sscplusdata", blob_name), download)
+    except BaseException:
+        download.close()
+        raise
+
+    return download.json_items()
 
-    return response.json()
+def _save(url, blob_name) -> None:
+    """ upload the json array at url as is """
+    with get_fetch_client().download(url) as download:
+        _upload_page(get_blob_service_client().get_blob_client("sscplusdata", blob_name), download)
+
+def _get_and_save_if_changed(url: str, blob_name: str, previous_blob_name: str | None = None,
+                             previous_etag: str | None = None, validators: dict | None = None) -> bool:
+    """
+    Same as _get_and_save, but the page is only uploaded if it changed since the
+    previous crawl, whose copy of the page (previous_blob_name, its blob etag and
+    metadata) was listed by get_missing_pages.
+
+    The ETag/Last-Modified and a hash of the body are kept as blob metadata, they are
+    sent back as If-None-Match/If-Modified-Since and compared with the new body.
+    Unchanged pages from the previous crawl are copied server side.
+
+    Returns True if the page was uploaded, False if it was unchanged.
+    """
+    container_client = get_blob_service_client().get_container_client("sscplusdata")
+    blob_client = container_client.get_blob_client(blob_name)
+    source, validators = (previous_blob_name, validators or {}) if previous_blob_name else (None, {})
+
+    with get_fetch_client().download(url, headers=conditional_headers(validators)) as download:
+        if source and (download.status == 304 or download.sha256 == validators.get("content_sha256")):
+            with metrics.timer("blob.copy"):
+                copy = blob_client.start_copy_from_url(container_client.get_blob_client(source).url)
+            _cache_copy(source, previous_etag, blob_name, copy)
+            metrics.count("fetch.unchanged_pages")
+            logging.debug(f"{url} did not change since {source}, skipping upload")
+            return False
+
+        _upload_page(blob_client, download)
+    return True
+
+def _upload_page(blob_client, download: Download) -> None:
+    # the spooled body is streamed, the sdk stages it in blocks past max_single_put_size
+    with metrics.timer("blob.write"):
+        download.body.seek(0)
+        result = blob_client.upload_blob(download.body, length=download.size, overwrite=True, metadata=download.validators())
+    metrics.count("blob.bytes_written", download.size)
+    # the loader finds it there if it runs on this worker
+    cache = get_page_cache()
+    if cache is not None:
+        download.body.seek(0)
+        cache.put_raw(blob_client.blob_name, (result or {}).get("etag"), download.body)
+
+def _cache_copy(source: str, source_etag: str | None, blob_name: str, copy: dict | None) -> None:
+    """ a page copied server side is the same as its source in the page cache, once the copy is done """
+    cache = get_page_cache()
+    if cache is not None and copy and copy.get("copy_status") == "success":
+        cache.copy_raw(source, source_etag, blob_name, copy.get("etag"))
+
+def _get_previous_date(dir: str, date: str) -> str | None:
+    """ most recent <dir>/<date>/ prefix before the given date, if any """
+    container_client = get_blob_service_client().get_container_client("sscplusdata")
+    dates = [prefix.name.rstrip("/").split("/")[-1] for prefix in container_client.walk_blobs(name_starts_with=dir + "/", delimiter="/")]
+    dates = [d for d in dates if d < date]
+    return max(dates) if dates else None
+
+def _get_reports_container():
+    """ run reports go to sscplusdata/reports/, see sscplus/metrics.py """
+    return get_blob_service_client().get_container_client("sscplusdata")
 
 @app.route(route="orchestrators/durable_build_index")
 @app.durable_client_input(client_name="client")
 async def durable_build_index(req: func.HttpRequest, client) -> func.HttpResponse:
     '''
     build an index based on the date passed in parameter
+
+    ?shards=page-en,news-fr only (re)builds those shards, into the index named by ?index= (today by default),
+    the other shards of that index are left as they are.
     '''
     # get the parameter from the request
     date = req.params.get('date')
+    shards = req.params.get('shards')
 
     if date:
         logging.info(f"Current date used: {date}")
-        instance_id = await client.start_new("build_index_orc", None, date)
+        instance_id = await client.start_new("build_index_orc", None, {
+            "date": date,
+            "shards": shards.split(",") if shards else None,
+            "index": req.params.get('index')
+        })
         response = client.create_check_status_response(req, instance_id)
         return response
 
@@ -162,39 +457,90 @@ async def durable_build_index(req: func.HttpRequest, client) -> func.HttpRespons
 # Orchestrator
 @app.orchestration_trigger(context_name="context")
 def build_index_orc(context: df.DurableOrchestrationContext):
-    # Get the input data (date)
-    date = context.get_input()
-    pages = yield context.call_activity("load_pages_as_json", date)
-    if pages is not None:
-        yield context.call_activity("build_index", pages)
-        return f"Finished creating index (with name: {date})!"
+    # Get the input data (date, and optionally the shards to rebuild and the index they go to)
+    data = context.get_input()
+    if isinstance(data, str):
+        data = {"date": data}
+    index_name = data.get("index") or context.current_utc_datetime.strftime("%Y-%m-%d")
+    run = context.instance_id
+    # the shards are uploaded to a new version of the index, published once all of them are built (see sscplus/versions.py)
+    version = new_version(context.current_utc_datetime, run)
+    # only references to the staged corpus go through the activities, not the pages themselves
+    manifest = yield context.call_activity_with_retry("load_pages_as_json", build_retry_options, {"date": data["date"], "shards": data.get("shards"), "run": run})
+    if manifest is not None:
+        # one build per (type, language) shard, run in parallel, see sscplus/shards.py.
+        # a build that runs out of time checkpoints and returns early, it is called again until it completes
+        pending, shards = manifest["shards"], {}
+        while pending:
+            tasks = [context.call_activity_with_retry("build_index", build_retry_options, {"index": index_name, "version": version, "shard": shard, "corpus": corpus, "run": run})
+                     for shard, corpus in pending.items()]
+            for result in (yield context.task_all(tasks)):
+                if result.get("complete", True):
+                    shards[result["shard"]] = result
+            pending = {shard: corpus for shard, corpus in pending.items() if shard not in shards}
+        # published last, the new shards are only seen once all of them are uploaded
+        yield context.call_activity("publish_index_version", {"index": index_name, "version": version, "shards": list(shards.values())})
+        yield context.call_activity("delete_staged_corpus", {"prefix": manifest["prefix"]})
+        yield context.call_activity("write_run_report", {"run": run, "name": "build_index_orc"})
+        return f"Finished creating index (with name: {index_name}, version: {version}, {len(shards)} shard(s))!"
 
     return "failed to get date to start indexing .."
 
-@app.activity_trigger(input_name="date")
-def load_pages_as_json(date: str) -> list:
-    logging.info("getting pages ...")
-    return _get_pages_as_json("preload", date)
-
-@app.activity_trigger(input_name="pages")
-def build_index(pages: list) -> str:
+@app.activity_trigger(input_name="request")
+def load_pages_as_json(request: dict) -> dict:
+    """ clean the pages of preload/<date>/ and stage them in one json lines blob per shard, under staging/<date>/<run>/ """
+    from sscplus.shards import shard_entry, shard_key
 
-    documents = []
-    for page in pages:
-        # https://gpt-index.readthedocs.io/en/v0.6.34/how_to/customization/custom_documents.html
-        document = Document(
-            text=str(page["body"]).replace("\n", " "),
-            metadata={ # type: ignore
-                'filename': page["filename"],
-                'url': page["url"],
-                'title': page["title"],
-                'date': page["date"],
-                'nid': page['nid']
-            }
-        )
-        documents.append(document)
-
-    logging.info("Finished loading all document in memory")
+    logging.info("getting pages ...")
+    date = request["date"]
+    container_client = get_blob_service_client().get_container_client("sscplusdata")
+    if request.get("shards"):
+        # a shard is a <type>/<lang>/ folder of the preload, only those are read
+        pages = itertools.chain.from_iterable(
+            iter_pages(container_client, f"preload/{date}/{entry['type']}/{entry['lang']}/", cache=get_page_cache())
+            for entry in map(shard_entry, request["shards"]))
+    else:
+        pages = _iter_pages("preload", date)
+    with run_report(_get_reports_container(), request.get("run"), "load_pages_as_json") as report:
+        # two builds of the same date each have their own corpus
+        prefix = f"staging/{date}/{request['run']}/"
+        shards = write_corpus_shards(container_client, prefix, pages, lambda page: shard_key(page["filename"]))
+        report["pages"] = {shard: manifest["count"] for shard, manifest in shards.items()}
+    for shard, manifest in shards.items():
+        logging.info(f"Staged {manifest['count']} page(s) in {manifest['blob_name']}")
+    return {"date": date, "prefix": prefix, "shards": shards}
+
+@app.activity_trigger(input_name="request")
+def delete_staged_corpus(request: dict) -> int:
+    """ the corpus staged by load_pages_as_json, once the version built out of it is published """
+    container_client = get_blob_service_client().get_container_client("sscplusdata")
+    deleted = delete_corpus(container_client, request["prefix"])
+    logging.info(f"Deleted the {deleted} staged blob(s) under {request['prefix']}")
+    return deleted
+
+@app.activity_trigger(input_name="request")
+def build_index(request: dict) -> dict:
+    """ build and upload the <shard>/ of a new version of indices/<index> out of the staged corpus of that shard """
+    with run_report(_get_reports_container(), request.get("run"), f"build_index-{request['shard']}") as report:
+        result = _build_index(request)
+        report.update(result)
+    return result
+
+def _build_index(request: dict) -> dict:
+    from llama_index import (StorageContext, VectorStoreIndex,
+                             load_index_from_storage)
+
+    from sscplus import spill
+    from sscplus.checkpoint import (BuildCheckpoint, batch_documents,
+                                    build_streaming, iter_batches, time_budget)
+    from sscplus.indexing import NidIndex, delete_ref_docs, insert_documents
+    from sscplus.shards import shard_entry
+    from sscplus.vector_store import new_vector_store
+
+    shard = request["shard"]
+    # read from the staged corpus a batch at a time, as they are inserted
+    corpus_client = get_blob_service_client().get_container_client(request["corpus"]["container"])
+    documents = (_get_document(page) for page in iter_corpus(corpus_client, request["corpus"]))
 
     """
     store documents into a vector store.
@@ -202,106 +548,268 @@ def build_index(pages: list) -> str:
         * https://learn.microsoft.com/en-us/azure/search/search-get-started-vector
         * https://gpt-index.readthedocs.io/en/stable/community/integrations/vector_stores.html#using-a-vector-store-as-an-index
     """
-    set_global_service_context(_get_service_context("gpt-4", 8192))
-    index = VectorStoreIndex.from_documents(documents)
-    date = datetime.now().strftime("%Y-%m-%d")
-    index.storage_context.persist(persist_dir="/tmp/storage/" + date)
-
-    # writing files to Azure Storage
-    container_client = blob_service_client.get_container_client("indices")
-    for file in glob.glob(f"/tmp/storage/{date}/*"):
-        blob_name = os.path.basename(file)
-        blob_client = container_client.get_blob_client(date + "/" + blob_name)
-        with open(file, "rb") as data:
-            blob_client.upload_blob(data)
+    start = time.time()
+    embedding_cache = _get_embedding_cache(shard)
+    # passed to the index, not set globally: the shards are built at the same time, each with its own cache
+    service_context = _get_service_context("gpt-4", 8192, embedding_cache=embedding_cache)
+    prefix = f"{request['index']}/{shard}"
+    container_client = get_blob_service_client().get_container_client("indices")
+
+    # the docstore and embeddings of the batches done go to disk, see sscplus/spill.py
+    spill_dir = f"/tmp/build/{prefix}"
+    shutil.rmtree(spill_dir, ignore_errors=True)
+
+    # resume from the checkpoint of a previous attempt, if any, see sscplus/checkpoint.py
+    checkpoint = BuildCheckpoint(container_client, f"checkpoints/{prefix}", f"/tmp/checkpoints/{prefix}")
+    storage_context = checkpoint.resume()
+    if storage_context is not None:
+        if build_streaming:
+            storage_context.docstore = spill.spilling_docstore(storage_context.docstore, spill_dir)
+        with metrics.timer("index.load"):
+            index = load_index_from_storage(storage_context=storage_context, service_context=service_context)
+        nid_index = NidIndex.from_persist_dir(checkpoint.persist_dir, storage_context.docstore)
+    else:
+        # embeddings persisted as a numpy matrix instead of json, see sscplus/vector_store.py
+        storage_context = StorageContext.from_defaults(docstore=spill.new_docstore(spill_dir) if build_streaming else None,
+                                                       vector_store=new_vector_store())
+        index = VectorStoreIndex([], storage_context=storage_context, service_context=service_context)
+        nid_index = NidIndex()
+
+    # documents of the checkpoint still in the corpus, the others are deleted at the end
+    resumed, seen = set(checkpoint.documents), set()
+    def pending():
+        for document in documents:
+            if document.get_doc_id() in resumed:
+                seen.add(document.get_doc_id())
+            if not checkpoint.is_done(document):
+                yield document
+
+    batches = 0
+    for batch in iter_batches(pending(), batch_documents):
+        if batches and time.time() - start >= time_budget:
+            checkpoint.save(storage_context, nid_index)
+            if embedding_cache:
+                embedding_cache.persist()
+            logging.warning(f"Out of time building {shard}, {len(checkpoint.documents)} document(s) checkpointed")
+            return {"shard": shard, "complete": False, "documents": len(checkpoint.documents)}
+        # pages changed since the checkpoint
+        changed = [document.get_doc_id() for document in batch if document.get_doc_id() in checkpoint.documents]
+        delete_ref_docs(index, changed)
+        nid_index.remove(changed)
+        checkpoint.remove(changed)
+
+        insert_documents(index, batch)
+        for document in batch:
+            nid_index.add_document(document)
+        checkpoint.add(batch)
+        batches += 1
+        if build_streaming:
+            spill.spill(storage_context, spill_dir)
+        if checkpoint.due():
+            checkpoint.save(storage_context, nid_index)
+
+    # pages gone since the checkpoint
+    gone = list(resumed - seen)
+    delete_ref_docs(index, gone)
+    nid_index.remove(gone)
+    checkpoint.remove(gone)
+    logging.info(f"Inserted the {len(checkpoint.documents)} document(s) of {shard}")
+
+    # start from an empty directory, files of another format left by a previous run would be uploaded with it
+    shutil.rmtree("/tmp/storage/" + prefix, ignore_errors=True)
+    with metrics.timer("index.persist"):
+        index.storage_context.persist(persist_dir="/tmp/storage/" + prefix)
+        nid_index.persist("/tmp/storage/" + prefix)
+    spill.clear(storage_context, spill_dir)
+    if embedding_cache:
+        embedding_cache.persist()
+
+    # writing files to Azure Storage, those of the index in use (or of latest) that did not change are only referred to
+    base = resolve(container_client, request["index"]) or resolve(container_client, "latest")
+    files = upload_files(f"/tmp/storage/{prefix}", container_client, version_prefix(request["version"], shard), directory_files(base, shard))
+    checkpoint.clear()
+
+    return {"shard": shard, **shard_entry(shard), "documents": len(nid_index.entries), "nodes": len(index.index_struct.nodes_dict), "files": files}
 
-    return "Storage name: /tmp/storage/" + date
+# Activity
+@app.activity_trigger(input_name="request")
+def write_run_report(request: dict) -> dict:
+    """ reports/<run>.json, out of the reports of the activities of that orchestration """
+    report = merge_reports(_get_reports_container(), request["run"], request.get("name"))
+    return {"run": report["run"], "functions": len(report["functions"])}
+
+@app.activity_trigger(input_name="request")
+def publish_index_version(request: dict) -> dict:
+    """ the version with the shards just built (and the other shards of the index as they are), then <index> points at it """
+    from sscplus.shards import update_router
+
+    container_client = get_blob_service_client().get_container_client("indices")
+    base = resolve(container_client, request["index"])
+    # an index built before it was sharded has nothing to keep
+    files = base["files"] if base and base["router"] is not None else {}
+    entries = {}
+    for entry in request["shards"]:
+        shard, shard_files = entry.pop("shard"), entry.pop("files")
+        files = replace_directory(files, shard, shard_files)
+        entries[shard] = entry
+    router = update_router(base["router"] if base else None, entries)
+    write_version(container_client, request["version"], files, router, base["version"] if base else None)
+    pointer = publish(container_client, request["index"], request["version"])
+    prune(container_client)
+    return {**pointer, "shards": len(router["shards"])}
+
+@app.route(route="publish_index")
+def publish_index(req: func.HttpRequest) -> func.HttpResponse:
+    '''
+    point an index (?name=, latest by default) at a version: ?version=<version> or the one another index
+    points at (?index=<name>). promotes a build to the weekly updates and the file share, or rolls back.
+    '''
+    container_client = get_blob_service_client().get_container_client("indices")
+    version = req.params.get('version')
+    if not version and req.params.get('index'):
+        pointer, _ = read_pointer(container_client, req.params['index'])
+        version = pointer["version"] if pointer else None
+    if not version:
+        return func.HttpResponse("No version (or index pointing at one) provided", status_code=400)
+    try:
+        pointer = publish(container_client, req.params.get('name') or "latest", version)
+    except ResourceNotFoundError as e:
+        return func.HttpResponse(str(e), status_code=404)
+    return func.HttpResponse(json.dumps(pointer), mimetype="application/json")
 
 @app.schedule(schedule="0 0 * * 6", arg_name="timer", run_on_startup=True)
 def get_page_updates(timer: func.TimerRequest) -> None:
     date = datetime.now().strftime("%Y-%m-%d")
     logging.info(' [rebuild index] Timed triggered function ran at %s', date)
+    with run_report(_get_reports_container(), None, "get_page_updates"):
+        _get_page_updates(date)
+
+def _get_page_updates(date: str) -> None:
     '''get updated pages since last week and store them'''
+    from sscplus.shards import group_by_shard, shard_entry, update_router
+
     try:
-        r = _get_and_save(f"{domain}/en/rest/updated-ids/week", f"updated-ids-{date}.json")
-        logging.info("Getting all ids that need to be processed...")
-        for d in r:
-            _get_and_save(f"{domain}/en/rest/page-by-id/{d['nid']}", f"updated/{date}/{d['type']}/en/{d['nid']}.json")
-            _get_and_save(f"{domain}/fr/rest/page-by-id/{d['nid']}", f"updated/{date}/{d['type']}/fr/{d['nid']}.json")
+        previous_date = _get_previous_date("preload", date)
+        # en/fr pages of every updated id fetched concurrently, see sscplus/crawler.py
+        counts = asyncio.run(_crawl_updates(date, previous_date))
+        logging.info(f"Crawled {counts['ids']} updated id(s): {counts['uploaded']} page(s) uploaded, "
+                     f"{counts['unchanged']} unchanged, {counts['failed']} failed")
     except Exception as e:
         logging.error("Unable to send request and/or parse json. Error:" + str(e))
 
-    container_client = blob_service_client.get_container_client("indices")
+    # the pages uploaded above are read back from the page cache of this worker, not blob storage
+    pages = _get_pages_as_json("updated", date)
+
+    # the updated index is a new version of latest, the files that did not change are only referred to
+    container_client = get_blob_service_client().get_container_client("indices")
+    base = resolve(container_client, "latest")
+    version = new_version(datetime.now(timezone.utc), uuid.uuid4().hex)
+    if base is None or base["router"] is None:
+        # index built before it was sharded
+        files, _ = _update_index_dir(base, "", version, pages, _get_embedding_cache())
+        router = None
+    else:
+        # only the shards with updated pages are downloaded, updated and uploaded again
+        files, entries = base["files"], {}
+        for shard, shard_pages in group_by_shard(pages).items():
+            shard_files, counts = _update_index_dir(base, shard, version, shard_pages, _get_embedding_cache(shard))
+            files = replace_directory(files, shard, shard_files)
+            entries[shard] = {**shard_entry(shard), **counts}
+        router = update_router(base["router"], entries)
+    write_version(container_client, version, files, router, base["version"] if base else None)
+    # fails if latest was published (a build promoted ...) while this one was made
+    publish(container_client, "latest", version, expected=base["version"] if base else None)
+    prune(container_client)
+    logging.info("done updating the index and re-uploading to storage")
+
+def _update_index_dir(base: dict | None, directory: str, version: str, pages: list,
+                      embedding_cache: "EmbeddingCache | None") -> tuple[dict, dict]:
+    """
+    replace the given pages in <directory>/ of the base version of the index (created if there is none yet),
+    returns its files in the new version and the documents / nodes counts
+    """
+    from llama_index import (StorageContext, VectorStoreIndex,
+                             load_index_from_storage)
+
+    from sscplus.indexing import NidIndex, delete_ref_docs, insert_documents
+    from sscplus.vector_store import new_vector_store, storage_context_from_persist_dir
 
-    # Ensure the tmp directory exists
-    os.makedirs('/tmp/latest', exist_ok=True)
+    container_client = get_blob_service_client().get_container_client("indices")
+    prefix = f"latest/{directory}".rstrip("/")
+    base_files = directory_files(base, directory)
 
     '''load index locally'''
-    blob_list = container_client.list_blobs(name_starts_with="latest")
-    for blob in blob_list:
-        logging.info(f"CURRENT BLOB: {blob.name}")
-        # Construct the full file path
-        download_file_path = os.path.join('/tmp', blob.name)
-
-         # Skip download if file already exists
-        if os.path.exists(download_file_path):
-            logging.info(f"File {download_file_path} already exists. Skipping download.")
-            continue
-
-        # Download the blob to a local file
-        blob_client = container_client.get_blob_client(blob.name)
-        with open(download_file_path, "wb") as download_file:
-            download_file.write(blob_client.download_blob().readall())
-
-    #TODO: reuse the all the files from above instead of re-loading them this way, inefficient.. might be useless to store them in the first place...
-    pages = _get_pages_as_json("updated", date)
+    # only the files that changed since the copy already in /tmp (if any) are downloaded
+    download_dir(container_client, version_prefix(base["version"], directory) if base else prefix, f"/tmp/{prefix}", manifest=base_files)
     nids_set = {str(page['nid']) for page in pages}
 
     '''load index in memory'''
     start = time.time()
-    set_global_service_context(_get_service_context("gpt-4", 8192))
-    storage_context = StorageContext.from_defaults(persist_dir=os.path.join("/tmp", "latest"))
-    index = load_index_from_storage(storage_context=storage_context)
+    # passed to the index, not set globally (see _build_index)
+    service_context = _get_service_context("gpt-4", 8192, embedding_cache=embedding_cache)
+    with metrics.timer("index.load"):
+        if os.listdir(f"/tmp/{prefix}"):
+            storage_context = storage_context_from_persist_dir(f"/tmp/{prefix}")
+            index = load_index_from_storage(storage_context=storage_context, service_context=service_context)
+        else:
+            logging.info(f"No index under {prefix}/ yet, starting a new one")
+            storage_context = StorageContext.from_defaults(vector_store=new_vector_store())
+            index = VectorStoreIndex([], storage_context=storage_context, service_context=service_context)
     end = time.time()
     logging.info("Took {} seconds to load index/storage context.".format(end-start))
 
-    '''identify newly updated nodes and delete them, we will be re-building the new index and updating it instead..'''
-    for k,v in storage_context.docstore.docs.items():
-        filename = v.metadata['filename']
-        match = re.search(r'(\d+)\.json$', filename)
-        number = match.group(1) if match else None
-        if number in nids_set:
-            index.delete_ref_doc(k, delete_from_docstore=True)
-
+    '''identify newly updated pages and delete them, we will be re-building the new index and updating it instead..'''
+    # nid -> ref_doc_id side index, instead of going over every node of the docstore
+    nid_index = NidIndex.from_persist_dir(f"/tmp/{prefix}", storage_context.docstore)
+    delete_ref_docs(index, [ref_doc_id for nid in nids_set for ref_doc_id in nid_index.pop(nid)])
 
     '''update the index with the new documents'''
+    documents = []
     for page in pages:
-        # https://gpt-index.readthedocs.io/en/v0.6.34/how_to/customization/custom_documents.html
-        document = Document(
-            text=str(page["body"]).replace("\n", " "),
-            metadata={ # type: ignore
-                'filename': page["filename"],
-                'url': page["url"],
-                'title': page["title"],
-                'date': page["date"],
-                'nid': page['nid']
-            }
-        )
-        index.insert(document)
+        document = _get_document(page)
+        documents.append(document)
+        nid_index.add_document(document)
+    # one batch, so all the new nodes are embedded together
+    insert_documents(index, documents)
 
     '''persist the updated index'''
-    index.storage_context.persist(persist_dir="/tmp/storage/latest")
+    shutil.rmtree(f"/tmp/storage/{prefix}", ignore_errors=True)
+    with metrics.timer("index.persist"):
+        index.storage_context.persist(persist_dir=f"/tmp/storage/{prefix}")
+        nid_index.persist(f"/tmp/storage/{prefix}")
+    if embedding_cache:
+        embedding_cache.persist()
 
     # writing files to Azure Storage
-    container_client = blob_service_client.get_container_client("indices")
-    for file in glob.glob(f"/tmp/storage/latest/*"):
-        blob_name = os.path.basename(file)
-        blob_client = container_client.get_blob_client("latest/" + blob_name)
-        with open(file, "rb") as data:
-            blob_client.upload_blob(data, overwrite=True)
-    logging.info("done updating the index and re-uploading to storage")
+    files = upload_files(f"/tmp/storage/{prefix}", container_client, version_prefix(version, directory), base_files)
+    return files, {"documents": len(nid_index.entries), "nodes": len(index.index_struct.nodes_dict)}
+
+def _get_document(page: dict) -> "Document":
+    from llama_index import Document
+
+    # https://gpt-index.readthedocs.io/en/v0.6.34/how_to/customization/custom_documents.html
+    # the blob name as id, so the same page is the same document from one build attempt to the next
+    return Document(
+        id_=page["filename"],
+        # the structure (blocks, headings) is what the chunker splits on, the llama_index splitter gets one line as before
+        text=str(page["body"]) if structured_text else str(page["body"]).replace("\n", " "),
+        metadata={ # type: ignore
+            'filename': page["filename"],
+            'url': page["url"],
+            'title': page["title"],
+            'date': page["date"],
+            'nid': page['nid']
+        }
+    )
+
+def _get_service_context(model: str, context_window: int, num_output: int = 800, temperature: float = 0.7,
+                         embedding_cache: "EmbeddingCache | None" = None) -> "ServiceContext":
+    from llama_index import PromptHelper, ServiceContext
+    from llama_index.callbacks import CallbackManager
+
+    from sscplus.embeddings import BatchedAzureOpenAIEmbedding
+    from sscplus.indexing import MetricsCallbackHandler
 
-def _get_service_context(model: str, context_window: int, num_output: int = 800, temperature: float = 0.7,) -> "ServiceContext":
     # using same dep as model name because of an older bug in langchains lib (now fixed I believe)
     llm = _get_llm(model, temperature)
 
@@ -310,65 +818,76 @@ def _get_service_context(model: str, context_window: int, num_output: int = 800,
     chunk_overlap_ratio = 0.1 # overlap for each token fragment
     prompt_helper = PromptHelper(context_window=context_window, num_output=num_output, chunk_overlap_ratio=chunk_overlap_ratio,)
 
-    # limit is chunk size 1 atm
-    embedding_llm = AzureOpenAIEmbeddings(
-            model="text-embedding-ada-002", api_key=api_key, azure_endpoint=azure_openai_uri)
+    # batched, concurrent and rate aware, see EMBED_* settings in sscplus/embeddings.py
+    embedding_llm = BatchedAzureOpenAIEmbedding(
+            model="text-embedding-ada-002", deployment_name="text-embedding-ada-002",
+            api_key=api_key, azure_endpoint=azure_openai_uri, api_version=api_version, cache=embedding_cache)
 
-    llama_debug = LlamaDebugHandler(print_trace_on_end=True)
-    callback_manager = CallbackManager([llama_debug])
+    # only the duration of the events is kept, see sscplus/metrics.py
+    callback_manager = CallbackManager([MetricsCallbackHandler()])
 
     return ServiceContext.from_defaults(llm_predictor=llm_predictor, embed_model=embedding_llm, callback_manager=callback_manager, prompt_helper=prompt_helper)
 
+def _get_embedding_cache(shard: str | None = None) -> "EmbeddingCache | None":
+    """
+    embeddings of the previous runs, see sscplus/embedding_cache.py (EMBEDDING_CACHE=false to disable).
+    one cache per shard, shards are built at the same time and would overwrite each other's cache otherwise.
+    """
+    from sscplus.embedding_cache import EmbeddingCache, cache_enabled
+
+    if not cache_enabled:
+        return None
+    name = f"embedding-cache/{shard}/text-embedding-ada-002.sqlite" if shard else "embedding-cache/text-embedding-ada-002.sqlite"
+    blob_client = get_blob_service_client().get_blob_client("indices", name)
+    return EmbeddingCache.from_blob(blob_client, f"/tmp/{name}")
+
 def _get_llm(model: str, temperature: float = 0.7):
+    from langchain_openai import AzureChatOpenAI
+
     return AzureChatOpenAI(model=model,
                            temperature=temperature,api_key=api_key, api_version=api_version, azure_endpoint=azure_openai_uri)
 
-def _get_llm_predictor(llm) -> LLMPredictor:
+def _get_llm_predictor(llm) -> "LLMPredictor":
+    from llama_index import LLMPredictor
+
     return LLMPredictor(llm=llm,)
 
+async def _crawl_updates(date: str, previous_date: str | None) -> dict:
+    from sscplus.crawler import crawl_updates
+
+    async with _get_async_blob_service_client() as blob_service_client:
+        return await crawl_updates(blob_service_client.get_container_client("sscplusdata"), domain, date, previous_date)
+
+def _get_async_blob_service_client():
+    """ async clients belong to the event loop they run in, a new one per crawl """
+    from azure.storage.blob.aio import BlobServiceClient
+
+    return BlobServiceClient.from_connection_string(str(connection_string), max_single_put_size=sync_block_size, max_block_size=sync_block_size)
+
 def _get_pages_as_json(dir: str, date: str) -> list:
-    pages = []
-    container_client = blob_service_client.get_container_client("sscplusdata")
-    blobs = container_client.list_blobs(dir + "/" + date + "/")
-
-    ignore_selectors = ['div.comment-login-message', 'section.block-date-modified-block']
-
-    for blob in blobs:
-        blob_client = container_client.get_blob_client(blob) # type: ignore
-        # Download the blob data and decode it to string
-        data = blob_client.download_blob().readall().decode('utf-8')
-        if data is not None:
-            raw = json.loads(data)
-            if isinstance(raw, list) and raw:
-                raw = raw[0] # sometimes the object is boxed into an array, not useful to us
-            if isinstance(raw, dict):
-                page = {}
-                soup = BeautifulSoup(raw["body"], "html.parser")
-                # remove useless tags like date modified and login blocks (see example in 336 parsed data vs non parsed)
-                for selector in ignore_selectors:
-                     for s in soup.select(selector):
-                         s.decompose()
-
-                page["body"] = ' '.join(soup.stripped_strings)
-                page["title"] = str(raw["title"]).strip()
-                page["url"] = str(raw["url"]).strip()
-                page["date"] = str(raw["date"]).strip()
-                page["filename"] = blob_client.blob_name
-                page["nid"] = str(raw['nid']).strip()
-
-                pages.append(page)
-    return pages
+    return list(_iter_pages(dir, date))
+
+def _iter_pages(dir: str, date: str):
+    """ cleaned pages under <dir>/<date>/, downloaded and parsed in parallel, see sscplus.loader """
+    container_client = get_blob_service_client().get_container_client("sscplusdata")
+    return iter_pages(container_client, dir + "/" + date + "/", cache=get_page_cache())
 
 @app.schedule(schedule="0 0 * * 0", arg_name="timer", run_on_startup=True)
 def update_index(timer: func.TimerRequest) -> None:
-    """ Copy latest index to a fileshare used by the chatbot"""
+    """ Copy latest index to a fileshare used by the chatbot (versions/<version>/, named by latest.json)"""
+    with run_report(_get_reports_container(), None, "update_index"):
+        _update_index()
+
+def _update_index() -> None:
+    from azure.storage.fileshare import ShareServiceClient
+
     service = ShareServiceClient.from_connection_string(conn_str=str(os.getenv("FILESHARE_CONNECTION_STRING")))
     share_client = service.get_share_client(share=str(os.getenv("FILESHARE_NAME")))
 
-    container_client = blob_service_client.get_container_client("indices")
-    for blob in container_client.list_blobs("latest/"):
-        blob_name = blob.name
-        blob_client = container_client.get_blob_client(blob=blob_name)
-        download_stream = blob_client.download_blob()
-        file_client = share_client.get_file_client(file_path=blob_name)
-        file_client.upload_file(download_stream) # type: ignore
\ No newline at end of file
+    container_client = get_blob_service_client().get_container_client("indices")
+    version = resolve(container_client, "latest")
+    if version is None:
+        logging.warning("No latest index to copy to the file share")
+        return
+    # latest.json of the share is only pointed at the version once all of it is copied
+    sync_version_to_share(container_client, version, share_client)
\ No newline at end of file
@@ -0,0 +1,5 @@
+"""
+helpers shared by the function app (function_app.py) to fetch, clean and index
+the ssc plus drupal content. kept out of function_app.py so they can be used
+(and measured) without standing up the azure functions host.
+"""
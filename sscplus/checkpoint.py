@@ -0,0 +1,106 @@
+"""
+checkpoints of an index build, so a build_index activity that is retried (or
+called again after running out of time) resumes where the previous attempt
+stopped instead of chunking and embedding everything again.
+
+documents are inserted BUILD_BATCH_DOCUMENTS at a time. at most every
+BUILD_CHECKPOINT_SECONDS the partial index is persisted as usual (same files as
+a finished one) under indices/checkpoints/<index>/<shard>/, with a
+checkpoint.json of the documents it already holds ({doc_id: hash}). documents
+are matched on their id and hash when resuming, so only new or changed ones
+are processed again. checkpoint.json is uploaded after the index files and a
+checkpoint without its manifest.json (a save cut off half way) is not resumed
+from. the checkpoint is removed once the shard is uploaded.
+
+the documents are read from the staged corpus as they are inserted, with
+BUILD_STREAMING (the default) the docstore and the embeddings of the batches
+already inserted are moved to disk (see sscplus/spill.py): the memory used
+depends on the size of a batch, not of the shard.
+"""
+import json
+import logging
+import os
+import time
+from typing import Iterable, Iterator, Optional
+
+from llama_index import Document, StorageContext
+
+from sscplus.indexing import NidIndex
+from sscplus.metrics import metrics
+from sscplus.sync import MANIFEST_NAME, download_dir, read_blob_manifest, upload_dir
+from sscplus.vector_store import storage_context_from_persist_dir
+
+checkpoint_seconds = int(os.getenv("BUILD_CHECKPOINT_SECONDS", "300"))
+batch_documents    = int(os.getenv("BUILD_BATCH_DOCUMENTS", "500"))
+# stop (after a checkpoint) before the activity hits functionTimeout (45 minutes in host.json)
+time_budget        = int(os.getenv("BUILD_TIME_BUDGET_SECONDS", "2400"))
+build_streaming    = os.getenv("BUILD_STREAMING", "true").lower() == "true"
+
+FILE_NAME = "checkpoint.json"
+
+def iter_batches(items: Iterable, size: int) -> Iterator[list]:
+    batch: list = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class BuildCheckpoint:
+    def __init__(self, container_client, prefix: str, persist_dir: str, interval: int = checkpoint_seconds):
+        self.container_client = container_client
+        self.prefix = prefix
+        self.persist_dir = persist_dir
+        self.interval = interval
+        self.documents: dict[str, str] = {}
+        self.saved_at = time.time()
+
+    def resume(self) -> Optional[StorageContext]:
+        """ storage context of the last checkpoint, None when there is nothing to resume from """
+        # no manifest is an interrupted save (or none at all): its files can be from different saves
+        manifest = read_blob_manifest(self.container_client, self.prefix)
+        if FILE_NAME not in manifest:
+            return None
+        download_dir(self.container_client, self.prefix, self.persist_dir, manifest=manifest)
+        path = os.path.join(self.persist_dir, FILE_NAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            self.documents = json.load(f)["documents"]
+        logging.info(f"Resuming from the checkpoint under {self.prefix}/ ({len(self.documents)} document(s) done)")
+        return storage_context_from_persist_dir(self.persist_dir)
+
+    def is_done(self, document: Document) -> bool:
+        return self.documents.get(document.get_doc_id()) == document.hash
+
+    def add(self, documents: list[Document]) -> None:
+        for document in documents:
+            self.documents[document.get_doc_id()] = document.hash
+
+    def remove(self, doc_ids: list[str]) -> None:
+        for doc_id in doc_ids:
+            self.documents.pop(doc_id, None)
+
+    def due(self) -> bool:
+        return time.time() - self.saved_at >= self.interval
+
+    def save(self, storage_context: StorageContext, nid_index: NidIndex) -> None:
+        start = time.time()
+        storage_context.persist(persist_dir=self.persist_dir)
+        nid_index.persist(self.persist_dir)
+        with open(os.path.join(self.persist_dir, FILE_NAME), "w", encoding="utf-8") as f:
+            json.dump({"documents": self.documents}, f)
+        # checkpoint.json after the files it describes, then the manifest
+        upload_dir(self.persist_dir, self.container_client, self.prefix, last=[FILE_NAME])
+        self.saved_at = time.time()
+        metrics.observe("index.checkpoint", self.saved_at - start)
+        logging.info(f"Checkpointed {len(self.documents)} document(s) under {self.prefix}/ in {self.saved_at - start:.1f} seconds")
+
+    def clear(self) -> None:
+        # manifest and checkpoint.json first, a half deleted checkpoint is never resumed from
+        order = {MANIFEST_NAME: 0, FILE_NAME: 1}
+        names = self.container_client.list_blob_names(name_starts_with=f"{self.prefix}/")
+        for name in sorted(names, key=lambda name: order.get(name.rsplit("/", 1)[-1], 2)):
+            self.container_client.delete_blob(name)
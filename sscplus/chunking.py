@@ -0,0 +1,159 @@
+"""
+structure aware chunking of the pages, used instead of the llama_index sentence
+splitter over the page flattened to a single line.
+
+the cleaned body has a line per block (paragraph, list item, table row ...) and
+markdown style heading lines, see extract_structured_text in
+sscplus/text_extraction.py. blocks are packed in order into chunks of at most
+CHUNK_TOKENS tokens (cl100k_base, the tokenizer of ada-002), a chunk is closed
+rather than cutting a block in two and a heading never ends a chunk. blocks
+bigger than that on their own are split on sentences, then on tokens. the
+headings above a chunk are kept as its "section" metadata, embedded along with
+the title of the page (the other metadata is not embedded).
+
+chunk ids are a hash of the document id, the text of the chunk and how many
+times that text was seen before in the page: the same page always gives the
+same ids, and an edit only changes the ids of the chunks it touched.
+
+CHUNKER=llama goes back to the llama_index transformations of the service context.
+"""
+import hashlib
+import logging
+import os
+import re
+from typing import Sequence
+
+from llama_index import Document
+from llama_index.schema import NodeRelationship, TextNode
+
+from sscplus.text_extraction import HEADING_LINE
+
+chunker      = os.getenv("CHUNKER", "structure")
+chunk_tokens = int(os.getenv("CHUNK_TOKENS", "512"))
+
+# kept with the chunks, but only the title and section go into the embeddings
+EMBED_EXCLUDED_KEYS = ["filename", "url", "date", "nid"]
+
+SENTENCE_END = re.compile(r"(?<=[.!?;:])\s+")
+
+_encoding = None
+
+def _get_encoding():
+    """ tiktoken's cl100k_base, False if it can't be loaded (it downloads its vocabulary the first time) """
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logging.warning(f"Unable to load the cl100k_base tokenizer, estimating token counts. Error: {e}")
+            _encoding = False
+    return _encoding
+
+def count_tokens(texts: Sequence[str]) -> list[int]:
+    encoding = _get_encoding()
+    if encoding is False:
+        return [len(text) // 3 + 1 for text in texts]
+    return [len(tokens) for tokens in encoding.encode_ordinary_batch(list(texts))]
+
+def chunk_documents(documents: Sequence[Document], max_tokens: int = chunk_tokens) -> list[TextNode]:
+    return [node for document in documents for node in chunk_document(document, max_tokens)]
+
+def chunk_document(document: Document, max_tokens: int = chunk_tokens) -> list[TextNode]:
+    doc_id = document.get_doc_id()
+    nodes, seen = [], {}
+    for text, section in split_text(document.text, max_tokens):
+        occurrence = seen[text] = seen.get(text, -1) + 1
+        node = TextNode(
+            id_=hashlib.sha256(f"{doc_id}\n{occurrence}\n{text}".encode("utf-8")).hexdigest()[:32],
+            text=text,
+            metadata={**document.metadata, "section": section},
+            excluded_embed_metadata_keys=EMBED_EXCLUDED_KEYS,
+            excluded_llm_metadata_keys=list(document.excluded_llm_metadata_keys))
+        node.relationships[NodeRelationship.SOURCE] = document.as_related_node_info()
+        nodes.append(node)
+    return nodes
+
+def split_text(text: str, max_tokens: int = chunk_tokens) -> list[tuple[str, str]]:
+    """ [(chunk text, section)] of a structured text, section being the headings above the chunk ("A > B") """
+    lines = _parse(text)
+    tokens = count_tokens([line for line, _, _ in lines])
+    chunks: list[tuple[str, str]] = []
+    current: list[str] = []
+    current_tokens, current_section = 0, ""
+    # headings waiting for the first block under them
+    headings: list[tuple[str, int]] = []
+
+    def flush():
+        nonlocal current, current_tokens
+        if current:
+            chunks.append(("\n".join(current), current_section))
+        current, current_tokens = [], 0
+
+    for (line, level, path), count in zip(lines, tokens):
+        if level:
+            headings.append((line, count + 1))
+            continue
+        pending = sum(heading_tokens for _, heading_tokens in headings)
+        if current and current_tokens + pending + count > max_tokens:
+            flush()
+        if not current:
+            # the headings right above the chunk are in its section, not repeated in the text
+            current_section, headings = " > ".join(path), []
+            pending = 0
+        current.extend(heading for heading, _ in headings)
+        current_tokens += pending
+        headings = []
+        if count <= max_tokens:
+            current.append(line)
+            current_tokens += count + 1
+            continue
+        flush()
+        for piece in _split_block(line, max_tokens):
+            chunks.append((piece, " > ".join(path)))
+    flush()
+    if headings and not chunks:
+        # nothing but headings
+        chunks.append(("\n".join(heading for heading, _ in headings), ""))
+    return chunks
+
+def _parse(text: str) -> list[tuple[str, int, list[str]]]:
+    """ (text, heading level or 0, headings above it) of every line """
+    lines, path = [], []   # path: [(level, heading)]
+    for line in text.split("\n"):
+        if not line.strip():
+            continue
+        match = HEADING_LINE.match(line)
+        if match:
+            level, heading = len(match.group(1)), line[match.end():].strip()
+            path = [(l, h) for l, h in path if l < level] + [(level, heading)]
+            lines.append((heading, level, [h for _, h in path]))
+        else:
+            lines.append((line[1:] if line.startswith("\\") else line, 0, [h for _, h in path]))
+    return lines
+
+def _split_block(block: str, max_tokens: int) -> list[str]:
+    """ a block bigger than max_tokens, in pieces of sentences, sentences bigger than that in token windows """
+    sentences = SENTENCE_END.split(block)
+    pieces, current, current_tokens = [], [], 0
+    for sentence, count in zip(sentences, count_tokens(sentences)):
+        if current and current_tokens + count > max_tokens:
+            pieces.append(" ".join(current))
+            current, current_tokens = [], 0
+        if count > max_tokens:
+            pieces.extend(_split_tokens(sentence, max_tokens))
+            continue
+        current.append(sentence)
+        current_tokens += count + 1
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+def _split_tokens(text: str, max_tokens: int) -> list[str]:
+    encoding = _get_encoding()
+    if encoding is False:
+        words = text.split(" ")
+        size = max(max_tokens * 3 // 5, 1)   # ~5 characters (3 estimated tokens) a word
+        return [" ".join(words[i:i + size]) for i in range(0, len(words), size)]
+    tokens = encoding.encode_ordinary(text)
+    return [encoding.decode(tokens[i:i + max_tokens]).strip() for i in range(0, len(tokens), max_tokens)]
@@ -0,0 +1,124 @@
+"""
+asyncio crawler of the weekly update (get_page_updates).
+
+updated-ids/week is saved and read as it was, then the en and fr versions of
+every id are fetched together and saved under updated/<date>/<type>/<lang>/<nid>.json,
+with the same change detection as _get_and_save_if_changed in function_app.py
+(conditional requests, hash of the body, server side copy of the unchanged pages
+of the previous crawl). the blob etag and validators of the pages already saved
+(by an earlier run of the week) and of the previous crawl come from one listing
+of each prefix, not from a HEAD per page.
+
+at most CRAWL_CONCURRENCY ids are in flight on one aiohttp session. the requests
+go through the per host token bucket and the retries of sscplus.fetch, the blobs
+through the async azure storage client, so the pages being fetched overlap with
+the ones being uploaded instead of one request after the other.
+"""
+import asyncio
+import logging
+import os
+from typing import Optional
+
+import aiohttp
+
+from sscplus.fetch import Download, FetchClient, conditional_headers, get_fetch_client
+from sscplus.metrics import metrics
+from sscplus.page_cache import get_page_cache
+
+crawl_concurrency = int(os.getenv("CRAWL_CONCURRENCY", "16"))
+
+LANGS = ["en", "fr"]
+
+async def crawl_updates(container_client, domain: str, date: str, previous_date: Optional[str],
+                        concurrency: int = crawl_concurrency) -> dict:
+    """
+    crawl the pages updated this week into updated/<date>/, container_client is an
+    async (azure.storage.blob.aio) client of sscplusdata. returns what was done.
+    """
+    fetch_client = get_fetch_client()
+    counts = {"ids": 0, "uploaded": 0, "unchanged": 0, "failed": 0}
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks: set[asyncio.Task] = set()
+
+    with metrics.timer("blob.list"):
+        known = await _list_validators(container_client, f"updated/{date}/")
+        if previous_date:
+            known.update(await _list_validators(container_client, f"preload/{previous_date}/"))
+
+    async def crawl_id(d: dict) -> None:
+        try:
+            results = await asyncio.gather(*(
+                _crawl_page(container_client, session, fetch_client, known, f"{domain}/{lang}/rest/page-by-id/{d['nid']}",
+                            f"updated/{date}/{d['type']}/{lang}/{d['nid']}.json",
+                            f"preload/{previous_date}/{d['type']}/{lang}/{d['nid']}.json" if previous_date else None)
+                for lang in LANGS), return_exceptions=True)
+        finally:
+            semaphore.release()
+        for lang, result in zip(LANGS, results):
+            if isinstance(result, BaseException):
+                counts["failed"] += 1
+                metrics.count("fetch.failed_pages")
+                logging.error(f"Unable to download page {d['nid']} ({lang}). Error: {result!r}")
+            else:
+                counts["uploaded" if result else "unchanged"] += 1
+
+    connector = aiohttp.TCPConnector(limit=concurrency * len(LANGS), ssl=False)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=fetch_client.timeout)) as session:
+        with metrics.timer("ids.list"):
+            ids = await fetch_client.download_async(session, f"{domain}/en/rest/updated-ids/week")
+        try:
+            with ids:
+                await _upload(container_client.get_blob_client(f"updated-ids-{date}.json"), ids)
+                # the ids are scheduled as they are parsed, never more than `concurrency` of them at once
+                for d in ids.json_items():
+                    await semaphore.acquire()
+                    counts["ids"] += 1
+                    task = asyncio.create_task(crawl_id(d))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        finally:
+            await asyncio.gather(*tasks)
+
+    return counts
+
+async def _list_validators(container_client, prefix: str) -> dict[str, tuple[str, dict]]:
+    """ {blob name: (blob etag, metadata)} of the blobs under the prefix """
+    return {blob.name: (blob.etag, dict(blob.metadata or {}))
+            async for blob in container_client.list_blobs(name_starts_with=prefix, include=["metadata"])}
+
+async def _crawl_page(container_client, session: aiohttp.ClientSession, fetch_client: FetchClient, known: dict,
+                      url: str, blob_name: str, previous_blob_name: Optional[str]) -> bool:
+    """ same as _get_and_save_if_changed, True if the page was uploaded, False if it did not change """
+    blob_client = container_client.get_blob_client(blob_name)
+
+    source, source_etag, validators = None, None, {}
+    for name in filter(None, [blob_name, previous_blob_name]):
+        if name in known:
+            source, (source_etag, validators) = name, known[name]
+            break
+
+    with await fetch_client.download_async(session, url, conditional_headers(validators)) as download:
+        if source and (download.status == 304 or download.sha256 == validators.get("content_sha256")):
+            if source != blob_name:
+                with metrics.timer("blob.copy"):
+                    copy = await blob_client.start_copy_from_url(container_client.get_blob_client(source).url)
+                cache = get_page_cache()
+                if cache is not None and copy and copy.get("copy_status") == "success":
+                    cache.copy_raw(source, source_etag, blob_name, copy.get("etag"))
+            metrics.count("fetch.unchanged_pages")
+            logging.debug(f"{url} did not change since {source}, skipping upload")
+            return False
+
+        await _upload(blob_client, download)
+    return True
+
+async def _upload(blob_client, download: Download) -> None:
+    """ same as _upload_page in function_app.py """
+    with metrics.timer("blob.write"):
+        download.body.seek(0)
+        result = await blob_client.upload_blob(download.body, length=download.size, overwrite=True, metadata=download.validators())
+    metrics.count("blob.bytes_written", download.size)
+    cache = get_page_cache()
+    if cache is not None:
+        download.body.seek(0)
+        cache.put_raw(blob_client.blob_name, (result or {}).get("etag"), download.body)
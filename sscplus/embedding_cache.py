@@ -0,0 +1,122 @@
+"""
+content addressed cache of the embeddings, so unchanged chunks are not sent to
+azure openai again on the next build/update.
+
+keys are sha256(model + normalised chunk text), values the float32 embedding.
+it is a sqlite file under /tmp for the run, downloaded from / uploaded back to
+blob storage between runs. the least recently used entries are evicted past
+EMBEDDING_CACHE_MAX_ENTRIES when it is persisted.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Optional
+
+from azure.core.exceptions import ResourceNotFoundError
+
+cache_enabled     = os.getenv("EMBEDDING_CACHE", "true").lower() == "true"
+cache_max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+
+class EmbeddingCache:
+    def __init__(self, path: str, max_entries: int = cache_max_entries, blob_client=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.blob_client = blob_client
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection: Optional[sqlite3.Connection] = None
+
+    @classmethod
+    def from_blob(cls, blob_client, path: str, max_entries: int = cache_max_entries) -> "EmbeddingCache":
+        """ start from the cache persisted by the previous run, if any """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            with open(path, "wb") as f:
+                blob_client.download_blob(max_concurrency=4).readinto(f)
+            logging.info(f"Loaded embedding cache from {blob_client.blob_name}")
+        except ResourceNotFoundError:
+            os.remove(path)
+            logging.info(f"No embedding cache at {blob_client.blob_name} yet, starting an empty one")
+        return cls(path, max_entries, blob_client)
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\n{' '.join(text.split())}".encode('utf-8')).hexdigest()
+
+    def get_many(self, model: str, texts: list[str]) -> list[Optional[list[float]]]:
+        keys = [self.key(model, text) for text in texts]
+        found = {}
+        with self.lock:
+            connection = self._connect()
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = connection.execute(f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                found.update((key, array('f', blob).tolist()) for key, blob in rows)
+            now = int(time.time())
+            connection.executemany("UPDATE embeddings SET used = ? WHERE key = ?", [(now, key) for key in found])
+            connection.commit()
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        return [found.get(key) for key in keys]
+
+    def put_many(self, model: str, texts: list[str], embeddings: list[list[float]]) -> None:
+        now = int(time.time())
+        rows = [(self.key(model, text), array('f', embedding).tobytes(), now) for text, embedding in zip(texts, embeddings)]
+        with self.lock:
+            connection = self._connect()
+            connection.executemany("INSERT OR REPLACE INTO embeddings (key, embedding, used) VALUES (?, ?, ?)", rows)
+            connection.commit()
+
+    def evict(self) -> int:
+        """ drop the least recently used entries past max_entries """
+        with self.lock:
+            connection = self._connect()
+            count = connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            extra = count - self.max_entries
+            if extra <= 0:
+                return 0
+            connection.execute("DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY used LIMIT ?)", (extra,))
+            connection.commit()
+            connection.execute("VACUUM")
+            return extra
+
+    def persist(self) -> None:
+        """ evict and upload back to blob storage for the next run """
+        evicted = self.evict()
+        self.close()
+        logging.info(f"Embedding cache: {self.hits} hit(s), {self.misses} miss(es), {evicted} evicted")
+        if self.blob_client is not None and os.path.exists(self.path):
+            with open(self.path, "rb") as data:
+                self.blob_client.upload_blob(data, overwrite=True, max_concurrency=4)
+
+    def close(self) -> None:
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            try:
+                self.connection = self._open()
+            except sqlite3.DatabaseError as e:
+                # a cache is only a cache, a damaged one is started over instead of failing the build
+                logging.warning(f"Embedding cache {self.path} is not readable ({e}), starting an empty one")
+                os.remove(self.path)
+                self.connection = self._open()
+        return self.connection
+
+    def _open(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL, used INTEGER NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+        except sqlite3.DatabaseError:
+            connection.close()
+            raise
+        return connection
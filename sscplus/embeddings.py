@@ -0,0 +1,223 @@
+"""
+embedding stage used when building/updating the index.
+
+llama_index hands us every node text of an insert at once (see embed_batch_size),
+they are then:
+
+* packed into requests of at most EMBED_BATCH_SIZE texts and EMBED_BATCH_TOKENS tokens,
+* sent EMBED_CONCURRENCY at a time,
+* slowed down when azure openai says so: a 429 pauses everyone for the retry-after
+  and halves the concurrency, low x-ratelimit-remaining-* headers shave one off,
+  and successes slowly bring it back up. EMBED_TPM optionally caps tokens per minute.
+
+throughput (texts, tokens, requests, throttles) is logged after every call and
+counted in sscplus.metrics (embed.*).
+
+if an EmbeddingCache is given, only the texts it does not know are sent to azure openai.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+
+import openai
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.embeddings import AzureOpenAIEmbedding
+
+from sscplus.chunking import count_tokens
+from sscplus.embedding_cache import EmbeddingCache
+from sscplus.fetch import TokenBucket
+from sscplus.metrics import in_context, metrics
+
+embed_batch_size   = int(os.getenv("EMBED_BATCH_SIZE", "16"))
+embed_batch_tokens = int(os.getenv("EMBED_BATCH_TOKENS", "20000"))
+embed_concurrency  = int(os.getenv("EMBED_CONCURRENCY", "4"))
+embed_tpm          = int(os.getenv("EMBED_TPM", "0"))
+embed_max_attempts = int(os.getenv("EMBED_MAX_ATTEMPTS", "8"))
+
+class RateScheduler:
+    """
+    additive increase / multiplicative decrease on the number of requests in flight,
+    plus an optional tokens per minute budget.
+    """
+    def __init__(self, concurrency: int, tpm: int = 0):
+        self.max_limit = max(concurrency, 1)
+        self.limit = self.max_limit
+        self.in_flight = 0
+        self.successes = 0
+        self.paused_until = 0.0
+        self.throttles = 0
+        self.condition = threading.Condition()
+        self.budget = TokenBucket(tpm / 60, tpm) if tpm > 0 else None
+
+    def acquire(self, tokens: int) -> None:
+        with self.condition:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.in_flight < self.limit:
+                    break
+                self.condition.wait(timeout=wait if wait > 0 else None)
+            self.in_flight += 1
+        if self.budget:
+            self.budget.acquire(tokens)
+
+    def release(self, throttled: bool = False, retry_after: Optional[float] = None,
+                remaining_requests: Optional[int] = None, remaining_tokens: Optional[int] = None,
+                next_tokens: int = 0) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.throttles += 1
+                self.successes = 0
+                self.limit = max(1, self.limit // 2)
+                self.paused_until = max(self.paused_until, time.monotonic() + (retry_after or 1.0))
+            elif (remaining_requests is not None and remaining_requests <= self.in_flight) or \
+                 (remaining_tokens is not None and remaining_tokens < next_tokens * (self.in_flight + 1)):
+                # about to run out, back off a little before azure starts sending 429s
+                self.successes = 0
+                self.limit = max(1, self.limit - 1)
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_limit:
+                    self.successes = 0
+                    self.limit += 1
+            self.condition.notify_all()
+
+class BatchedAzureOpenAIEmbedding(AzureOpenAIEmbedding):
+    max_batch_items: int = Field(default=embed_batch_size, description="Max texts per embeddings request.")
+    max_batch_tokens: int = Field(default=embed_batch_tokens, description="Max tokens per embeddings request.")
+    concurrency: int = Field(default=embed_concurrency, description="Max embeddings requests in flight.")
+    tpm: int = Field(default=embed_tpm, description="Tokens per minute budget, 0 for no budget.")
+    max_attempts: int = Field(default=embed_max_attempts, description="Attempts per request before giving up.")
+
+    _scheduler: RateScheduler = PrivateAttr()
+    _stats: dict = PrivateAttr()
+    _cache: Optional[EmbeddingCache] = PrivateAttr()
+    _batch_client: Any = PrivateAttr(default=None)
+
+    def __init__(self, cache: Optional[EmbeddingCache] = None, **kwargs: Any):
+        # llama_index gives us all the texts of an insert in one go, we do the batching ourselves
+        kwargs.setdefault("embed_batch_size", 2048)
+        super().__init__(**kwargs)
+        self._cache = cache
+        self._scheduler = RateScheduler(self.concurrency, self.tpm)
+        self._stats = {"texts": 0, "tokens": 0, "requests": 0, "throttles": 0, "seconds": 0.0}
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "BatchedAzureOpenAIEmbedding"
+
+    @property
+    def stats(self) -> dict:
+        """ totals since this embed model was created """
+        return dict(self._stats, throttles=self._scheduler.throttles)
+
+    def _get_batch_client(self):
+        """
+        the client of the batched requests: the scheduler takes care of 429s, it should not retry
+        on its own. the query embeddings (and the async ones) keep the retries of the sdk
+        """
+        if self._batch_client is None:
+            # same connection pool as the client of llama_index
+            self._batch_client = self._get_client().with_options(max_retries=0)
+        return self._batch_client
+
+    def _pack(self, texts: List[str]) -> List[tuple]:
+        """ [(start index, texts, tokens)] respecting max_batch_items/max_batch_tokens, in order """
+        batches, start, current, tokens = [], 0, [], 0
+        for i, (text, count) in enumerate(zip(texts, count_tokens(texts))):
+            if current and (len(current) >= self.max_batch_items or tokens + count > self.max_batch_tokens):
+                batches.append((start, current, tokens))
+                start, current, tokens = i, [], 0
+            current.append(text)
+            tokens += count
+        if current:
+            batches.append((start, current, tokens))
+        return batches
+
+    def _embed_batch(self, texts: List[str], tokens: int) -> List[List[float]]:
+        # same as llama_index, newlines hurt the ada-002 embeddings
+        texts = [text.replace("\n", " ") for text in texts]
+        for attempt in range(1, self.max_attempts + 1):
+            self._scheduler.acquire(tokens)
+            try:
+                with metrics.timer("embed.request"):
+                    raw = self._get_batch_client().embeddings.with_raw_response.create(input=texts, model=self._text_engine, **self.additional_kwargs)
+            except openai.RateLimitError as e:
+                metrics.count("embed.throttled")
+                self._scheduler.release(throttled=True, retry_after=_retry_after(e.response.headers))
+                logging.warning(f"Embeddings throttled (attempt {attempt}), retrying")
+                continue
+            except (openai.APIConnectionError, openai.InternalServerError) as e:
+                metrics.count("embed.errors")
+                self._scheduler.release(throttled=True)
+                logging.warning(f"Embeddings request failed (attempt {attempt}): {e}")
+                continue
+            except Exception:
+                self._scheduler.release()
+                raise
+            self._scheduler.release(remaining_requests=_int_header(raw.headers, "x-ratelimit-remaining-requests"),
+                                    remaining_tokens=_int_header(raw.headers, "x-ratelimit-remaining-tokens"),
+                                    next_tokens=tokens)
+            return [d.embedding for d in sorted(raw.parse().data, key=lambda d: d.index)]
+        raise RuntimeError(f"Unable to get embeddings after {self.max_attempts} attempts")
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        if self._cache is None:
+            return self._embed(texts)
+
+        embeddings = self._cache.get_many(self.model_name, texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            new = self._embed([texts[i] for i in missing])
+            self._cache.put_many(self.model_name, [texts[i] for i in missing], new)
+            for i, embedding in zip(missing, new):
+                embeddings[i] = embedding
+        metrics.count("embed.cache_hits", len(texts) - len(missing))
+        metrics.count("embed.cache_misses", len(missing))
+        logging.info(f"{len(texts) - len(missing)}/{len(texts)} embedding(s) found in the cache")
+        return embeddings # type: ignore
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        start = time.perf_counter()
+        batches = self._pack(texts)
+        embeddings: List[Any] = [None] * len(texts)
+
+        def run(batch):
+            index, batch_texts, tokens = batch
+            embeddings[index:index + len(batch_texts)] = self._embed_batch(batch_texts, tokens)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            list(executor.map(in_context(run), batches))
+
+        seconds = time.perf_counter() - start
+        tokens = sum(b[2] for b in batches)
+        for key, value in [("texts", len(texts)), ("tokens", tokens), ("requests", len(batches)), ("seconds", seconds)]:
+            self._stats[key] += value
+        metrics.count("embed.texts", len(texts))
+        metrics.count("embed.tokens", tokens)
+        metrics.count("embed.batches", len(batches))
+        metrics.observe("embed.call", seconds)
+        logging.info(f"Embedded {len(texts)} text(s), {tokens} tokens in {len(batches)} request(s) and {seconds:.1f}s "
+                     f"({len(texts) / max(seconds, 1e-9):.1f} texts/s, {tokens / max(seconds, 1e-9):.0f} tokens/s, "
+                     f"{self._scheduler.throttles} throttle(s) so far, concurrency {self._scheduler.limit})")
+        return embeddings
+
+def _int_header(headers, name: str) -> Optional[int]:
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+def _retry_after(headers) -> Optional[float]:
+    """ azure sends retry-after-ms and/or retry-after (seconds) on 429 """
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
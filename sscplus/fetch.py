@@ -0,0 +1,373 @@
+"""
+shared http client used to talk to the ssc plus drupal api.
+
+* one connection pooled requests session per worker, so pages reuse the
+  keep-alive TCP+TLS connection instead of a new handshake per page,
+* a token bucket per host so the fan out does not hammer the fw/lb in front of
+  the aks instances (they were terminating connections on us),
+* exponential backoff with jitter on transient errors, honouring the
+  Retry-After header on 429/503.
+* download() streams the body into a spool (memory, then a temporary file past
+  HTTP_SPOOL_MAX_SIZE) hashed on the way, so a page of any size is uploaded as
+  is without holding it in memory, and iter_json_array() goes through a json
+  array (the id lists) an item at a time. download_async() is the same for the
+  asyncio crawler (sscplus/crawler.py), with the same buckets and retries.
+* every body of the api is a json array: a 2xx that is not one (an html page or a
+  body cut short by the fw/lb) is tried again like a 503, it is never saved.
+
+requests, bytes, retries and the latency of every attempt go to sscplus.metrics
+(fetch.*).
+"""
+import asyncio
+import codecs
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import IO, TYPE_CHECKING, Iterator, Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from tenacity import (AsyncRetrying, Retrying, retry_if_exception_type,
+                      stop_after_attempt, wait_random_exponential)
+
+from sscplus.metrics import metrics
+
+if TYPE_CHECKING:
+    import aiohttp
+
+# a connection per download thread of the activities a worker runs at once (see function_app.py)
+pool_size    = int(os.getenv("HTTP_POOL_SIZE", str(int(os.getenv("DOWNLOAD_CONCURRENCY", "8")) * int(os.getenv("DOWNLOAD_WINDOW_SIZE", "4")))))
+timeout      = float(os.getenv("HTTP_TIMEOUT", "30"))
+max_attempts = int(os.getenv("HTTP_MAX_ATTEMPTS", "5"))
+backoff_max  = float(os.getenv("HTTP_BACKOFF_MAX", "60"))
+# requests per second allowed per host, and how many can be sent in a burst
+rate_limit   = float(os.getenv("HTTP_RATE_LIMIT", "10"))
+rate_burst   = float(os.getenv("HTTP_RATE_BURST", "20"))
+# bodies bigger than this are spooled to a temporary file instead of memory
+spool_max_size = int(os.getenv("HTTP_SPOOL_MAX_SIZE", str(1024 * 1024)))
+CHUNK_SIZE = 64 * 1024
+
+RETRYABLE_STATUS   = {429, 500, 502, 503, 504}
+RETRY_AFTER_STATUS = {429, 503}
+
+class RetryableHTTPError(requests.HTTPError):
+    """ a response we want to try again, optionally after the server provided delay """
+    def __init__(self, response: requests.Response, retry_after: Optional[float] = None):
+        super().__init__(f"{response.status_code} returned by {response.url}", response=response)
+        self.retry_after = retry_after
+
+class RetryableStatusError(Exception):
+    """ same as RetryableHTTPError, for the aiohttp responses """
+    def __init__(self, url: str, status: int, retry_after: Optional[float] = None):
+        super().__init__(f"{status} returned by {url}")
+        self.status = status
+        self.retry_after = retry_after
+
+class InvalidBodyError(Exception):
+    """ a 2xx whose body is not a json array, tried again """
+    def __init__(self, url: str, reason: str):
+        super().__init__(f"Invalid body returned by {url}: {reason}")
+
+class Download:
+    """ a response body spooled by FetchClient.download() (or the crawler), rewound and hashed """
+    def __init__(self, status: int, headers, body: IO[bytes], size: int, sha256: str):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.size = size
+        self.sha256 = sha256
+
+    def validators(self) -> dict:
+        """ what we keep around (as blob metadata) to tell if a page changed the next time we fetch it """
+        validators = {"content_sha256": self.sha256}
+        if self.headers.get("ETag"):
+            validators["etag"] = self.headers["ETag"]
+        if self.headers.get("Last-Modified"):
+            validators["last_modified"] = self.headers["Last-Modified"]
+        return validators
+
+    def __enter__(self) -> "Download":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.body.close()
+
+    def json_items(self) -> Iterator:
+        """ items of the json array in the body, the body is closed once they are all read """
+        try:
+            self.body.seek(0)
+            yield from iter_json_array(self.body)
+        finally:
+            self.close()
+
+class TokenBucket:
+    """
+    classic token bucket, `rate` tokens are added every second up to `capacity`.
+    acquire() blocks until enough tokens are available.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0) -> None:
+        while (wait := self._take(amount)) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, amount: float = 1.0) -> None:
+        """ same as acquire, without blocking the event loop """
+        while (wait := self._take(amount)) > 0:
+            await asyncio.sleep(wait)
+
+    def _take(self, amount: float) -> float:
+        """ take the tokens and return 0, or how long to wait before there are enough of them """
+        if self.rate <= 0:
+            return 0
+        amount = min(amount, self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0
+            return (amount - self.tokens) / self.rate
+
+class FetchClient:
+    def __init__(self, pool_size: int = pool_size, timeout: float = timeout, max_attempts: int = max_attempts,
+                 backoff_max: float = backoff_max, rate_limit: float = rate_limit, rate_burst: float = rate_burst):
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff_max = backoff_max
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        self.buckets: dict[str, TokenBucket] = {}
+        self.buckets_lock = threading.Lock()
+
+        self.session = requests.Session()
+        # same as the previous requests.get(url, verify=False) calls
+        self.session.verify = False
+        # retries are handled below, not by urllib3. past pool_size, threads wait for a
+        # connection instead of opening one that is thrown away after the request
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url: str, headers: Optional[dict] = None, stream: bool = False) -> requests.Response:
+        """
+        GET with retries. Returns the response for anything under 400 (304 included),
+        raises for the rest once the attempts are exhausted.
+        """
+        return self._retrying()(self._get, url, headers, stream)
+
+    def download(self, url: str, headers: Optional[dict] = None) -> Download:
+        """
+        same as get, but the body is streamed into a spool. reading the body is part of
+        the attempt, a connection dropped halfway through is tried again from the start.
+        """
+        return self._retrying()(self._download, url, headers)
+
+    async def download_async(self, session: "aiohttp.ClientSession", url: str, headers: Optional[dict] = None) -> Download:
+        """ same as download, with an aiohttp session (its timeout and connection pool) """
+        import aiohttp
+
+        retrying = AsyncRetrying(
+            stop=stop_after_attempt(self.max_attempts),
+            wait=self._wait,
+            retry=retry_if_exception_type((aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                                           asyncio.TimeoutError, RetryableStatusError, InvalidBodyError)),
+            before_sleep=self._before_sleep,
+            reraise=True)
+        return await retrying(self._download_async, url, headers, session)
+
+    def _retrying(self) -> Retrying:
+        return Retrying(
+            stop=stop_after_attempt(self.max_attempts),
+            wait=self._wait,
+            retry=retry_if_exception_type((requests.ConnectionError, requests.Timeout,
+                                           requests.exceptions.ChunkedEncodingError, RetryableHTTPError, InvalidBodyError)),
+            before_sleep=self._before_sleep,
+            reraise=True)
+
+    def _get(self, url: str, headers: Optional[dict], stream: bool) -> requests.Response:
+        self.bucket(url).acquire()
+        metrics.count("fetch.requests")
+        with metrics.timer("fetch.request"):
+            response = self.session.get(url, headers=headers, timeout=self.timeout, stream=stream)
+        if response.status_code in RETRY_AFTER_STATUS:
+            metrics.count("fetch.throttled")
+        elif response.status_code == 304:
+            metrics.count("fetch.not_modified")
+        elif not stream:
+            metrics.count("fetch.bytes", len(response.content))
+        if response.status_code in RETRYABLE_STATUS:
+            retry_after = _parse_retry_after(response.headers.get("Retry-After")) if response.status_code in RETRY_AFTER_STATUS else None
+            response.close()
+            raise RetryableHTTPError(response, retry_after)
+        response.raise_for_status()
+        return response
+
+    def _download(self, url: str, headers: Optional[dict]) -> Download:
+        response = self._get(url, headers, stream=True)
+        body = tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+        digest = hashlib.sha256()
+        try:
+            with response:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    body.write(chunk)
+                    digest.update(chunk)
+            size = body.tell()
+            metrics.count("fetch.bytes", size)
+            if response.status_code != 304:
+                check_json_array(url, response.headers, body)
+        except BaseException:
+            body.close()
+            raise
+        body.seek(0)
+        return Download(response.status_code, response.headers, body, size, digest.hexdigest())
+
+    async def _download_async(self, url: str, headers: Optional[dict], session: "aiohttp.ClientSession") -> Download:
+        await self.bucket(url).acquire_async()
+        metrics.count("fetch.requests")
+        body = tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+        digest = hashlib.sha256()
+        start = time.perf_counter()
+        try:
+            async with session.get(url, headers=headers) as response:
+                metrics.observe("fetch.request", time.perf_counter() - start)
+                if response.status in RETRY_AFTER_STATUS:
+                    metrics.count("fetch.throttled")
+                elif response.status == 304:
+                    metrics.count("fetch.not_modified")
+                if response.status in RETRYABLE_STATUS:
+                    retry_after = _parse_retry_after(response.headers.get("Retry-After")) if response.status in RETRY_AFTER_STATUS else None
+                    raise RetryableStatusError(url, response.status, retry_after)
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    body.write(chunk)
+                    digest.update(chunk)
+            size = body.tell()
+            metrics.count("fetch.bytes", size)
+            if response.status != 304:
+                check_json_array(url, response.headers, body)
+        except BaseException:
+            body.close()
+            raise
+        body.seek(0)
+        return Download(response.status, response.headers, body, size, digest.hexdigest())
+
+    def bucket(self, url: str) -> TokenBucket:
+        """ token bucket of the host, shared with the async crawler (sscplus/crawler.py) """
+        host = urlparse(url).netloc
+        with self.buckets_lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate_limit, self.rate_burst)
+            return self.buckets[host]
+
+    def _before_sleep(self, retry_state) -> None:
+        metrics.count("fetch.retries")
+        logging.warning(f"Retrying {retry_state.args[0]} (attempt {retry_state.attempt_number}): {retry_state.outcome.exception()}")
+
+    def _wait(self, retry_state) -> float:
+        exception = retry_state.outcome.exception()
+        if isinstance(exception, (RetryableHTTPError, RetryableStatusError)) and exception.retry_after is not None:
+            return min(exception.retry_after, self.backoff_max)
+        return wait_random_exponential(multiplier=1, max=self.backoff_max)(retry_state)
+
+def conditional_headers(validators: dict) -> dict:
+    """ If-None-Match/If-Modified-Since out of the validators kept with the previous download """
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+def check_json_array(url: str, headers, body: IO[bytes]) -> None:
+    """ raise InvalidBodyError if the spooled body is not a json array, it is read from the start """
+    content_type = headers.get("Content-Type") or ""
+    if content_type and "json" not in content_type.lower():
+        metrics.count("fetch.invalid_bodies")
+        raise InvalidBodyError(url, f"Content-Type is {content_type}")
+    body.seek(0)
+    try:
+        # items are parsed one at a time and dropped, a large body is not held in memory
+        for _ in iter_json_array(body):
+            pass
+    except ValueError as e:
+        metrics.count("fetch.invalid_bodies")
+        raise InvalidBodyError(url, str(e))
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """ Retry-After is either a number of seconds or an http date """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def iter_json_array(stream: IO[bytes], chunk_size: int = CHUNK_SIZE) -> Iterator:
+    """ items of the json array in a binary stream, parsed as the stream is read """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer, position, started, eof, more = "", 0, False, False, False
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if more or position == len(buffer):
+            if eof:
+                raise ValueError("Unexpected end of the json array")
+            chunk = stream.read(chunk_size)
+            eof = not chunk
+            buffer, position, more = buffer[position:] + text_decoder.decode(chunk, final=eof), 0, False
+            continue
+        if not started:
+            if buffer[position] != "[":
+                raise ValueError(f"Expected a json array, got {buffer[position:position + 20]!r}")
+            started = True
+            position += 1
+        elif buffer[position] == "]":
+            return
+        else:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # the item is not all in the buffer yet
+                more = True
+                continue
+            if not eof and (end == len(buffer) or buffer[end] not in " \t\r\n,]"):
+                # a number cut by the end of the chunk ("-4." of "-4.5e3") goes on in the next one
+                more = True
+                continue
+            yield item
+            position = end
+
+_client: Optional[FetchClient] = None
+_client_lock = threading.Lock()
+
+def get_fetch_client() -> FetchClient:
+    """ one client (and connection pool) per worker process """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = FetchClient()
+        return _client
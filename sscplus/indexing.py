@@ -0,0 +1,149 @@
+"""
+helpers to update an existing llama_index VectorStoreIndex page by page.
+
+NidIndex is a side index (nid -> language -> ref_doc_ids) persisted next to the
+other index files as nid_index.json, so finding what to delete for an updated
+page is a lookup instead of a scan of the whole docstore. deletes and inserts
+are done for all the updated pages at once (one embedding batch for all nodes).
+
+MetricsCallbackHandler times the llama_index events (chunking, embedding ...)
+into sscplus.metrics, instead of keeping (and printing) every trace like the
+LlamaDebugHandler.
+"""
+import json
+import logging
+import os
+import re
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+from llama_index import Document, VectorStoreIndex
+from llama_index.callbacks.base_handler import BaseCallbackHandler
+from llama_index.callbacks.schema import CBEventType
+from llama_index.ingestion import run_transformations
+from llama_index.vector_stores import SimpleVectorStore
+
+from sscplus import chunking
+from sscplus.metrics import metrics
+from sscplus.vector_store import NumpyVectorStore
+
+FILE_NAME = "nid_index.json"
+
+def page_key(filename: str) -> Optional[tuple[str, str]]:
+    """ (nid, lang) out of a blob name like preload/<date>/<type>/<lang>/<nid>.json """
+    match = re.search(r'(?:^|/)(\w+)/(\d+)\.json$', filename)
+    return (match.group(2), match.group(1)) if match else None
+
+class NidIndex:
+    def __init__(self, entries: Optional[dict] = None):
+        self.entries: dict[str, dict[str, list[str]]] = entries or {}
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, docstore=None) -> "NidIndex":
+        """ load nid_index.json, or build it from the docstore (once) for indices persisted before it existed """
+        path = os.path.join(persist_dir, FILE_NAME)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                return cls(json.load(f))
+        if docstore is None:
+            return cls()
+        logging.info(f"No {FILE_NAME} in {persist_dir}, building it from the docstore")
+        nid_index = cls()
+        for node in docstore.docs.values():
+            key = page_key(node.metadata.get('filename', ''))
+            if key and node.ref_doc_id:
+                nid_index.add(key[0], key[1], node.ref_doc_id)
+        return nid_index
+
+    def add(self, nid: str, lang: str, ref_doc_id: str) -> None:
+        ref_doc_ids = self.entries.setdefault(str(nid), {}).setdefault(lang, [])
+        if ref_doc_id not in ref_doc_ids:
+            ref_doc_ids.append(ref_doc_id)
+
+    def add_document(self, document: Document) -> None:
+        key = page_key(document.metadata['filename'])
+        if key:
+            self.add(key[0], key[1], document.get_doc_id())
+
+    def pop(self, nid: str) -> list[str]:
+        """ remove a page (all languages) and return its ref_doc_ids """
+        return [ref_doc_id for ref_doc_ids in self.entries.pop(str(nid), {}).values() for ref_doc_id in ref_doc_ids]
+
+    def remove(self, ref_doc_ids: Sequence[str]) -> None:
+        """ forget these ref_doc_ids, whichever page they belong to """
+        drop = set(ref_doc_ids)
+        for nid in list(self.entries):
+            languages = {lang: [ref_doc_id for ref_doc_id in ids if ref_doc_id not in drop] for lang, ids in self.entries[nid].items()}
+            languages = {lang: ids for lang, ids in languages.items() if ids}
+            if languages:
+                self.entries[nid] = languages
+            else:
+                del self.entries[nid]
+
+    def persist(self, persist_dir: str) -> None:
+        os.makedirs(persist_dir, exist_ok=True)
+        with open(os.path.join(persist_dir, FILE_NAME), "w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+
+def delete_ref_docs(index: VectorStoreIndex, ref_doc_ids: Sequence[str]) -> None:
+    """ same as index.delete_ref_doc(ref_doc_id, delete_from_docstore=True) for each of them """
+    vector_store, docstore, index_struct = index.vector_store, index.docstore, index.index_struct
+    for ref_doc_id in ref_doc_ids:
+        ref_doc_info = docstore.get_ref_doc_info(ref_doc_id)
+        node_ids = ref_doc_info.node_ids if ref_doc_info else []
+        if isinstance(vector_store, NumpyVectorStore):
+            vector_store.delete_nodes(node_ids)
+        elif isinstance(vector_store, SimpleVectorStore):
+            # SimpleVectorStore.delete goes over every embedding to find the ones of the ref doc,
+            # they are keyed by node id so we go straight to them instead
+            data = vector_store._data
+            for node_id in node_ids:
+                data.embedding_dict.pop(node_id, None)
+                data.text_id_to_ref_doc_id.pop(node_id, None)
+                if data.metadata_dict is not None:
+                    data.metadata_dict.pop(node_id, None)
+        else:
+            vector_store.delete(ref_doc_id)
+        for node_id in node_ids:
+            if node_id in index_struct.nodes_dict:
+                index_struct.delete(node_id)
+        docstore.delete_ref_doc(ref_doc_id, raise_error=False)
+    index.storage_context.index_store.add_index_struct(index_struct)
+
+def insert_documents(index: VectorStoreIndex, documents: Sequence[Document]) -> None:
+    """ same as index.insert(document) for each of them, but all the nodes are embedded together """
+    with metrics.timer("index.chunking"):
+        if chunking.chunker == "structure":
+            nodes = chunking.chunk_documents(documents)
+        else:
+            nodes = run_transformations(list(documents), index.service_context.transformations)
+    metrics.count("index.documents", len(documents))
+    metrics.count("index.nodes", len(nodes))
+    # embeddings included, see embed.* for the requests themselves
+    with metrics.timer("index.insert"):
+        index.insert_nodes(nodes)
+    for document in documents:
+        index.docstore.set_document_hash(document.get_doc_id(), document.hash)
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """ duration of every llama_index event, as llama.<event type> timers """
+    def __init__(self) -> None:
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self.starts: dict[str, float] = {}
+
+    def on_event_start(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None,
+                       event_id: str = "", parent_id: str = "", **kwargs: Any) -> str:
+        self.starts[event_id] = time.perf_counter()
+        return event_id
+
+    def on_event_end(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None,
+                     event_id: str = "", **kwargs: Any) -> None:
+        start = self.starts.pop(event_id, None)
+        if start is not None:
+            metrics.observe(f"llama.{event_type.value}", time.perf_counter() - start)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(self, trace_id: Optional[str] = None, trace_map: Optional[Dict[str, List[str]]] = None) -> None:
+        pass
@@ -0,0 +1,226 @@
+"""
+loads the pages saved by the fetch (preload/<date>/..., updated/<date>/...) back
+from blob storage and cleans them into the dicts used to build the index.
+
+blobs are downloaded by a bounded pool of threads (i/o bound) and the html is
+cleaned by a pool of processes (html parsing is cpu bound and holds the GIL).
+pages are yielded as they come so callers never need the whole prefix in memory.
+with a PageCache (see sscplus/page_cache.py) the pages already cleaned on this
+worker, or uploaded by the fetch, are not downloaded/cleaned again (same name
+and etag). only the cleaned pages are cached here.
+blob reads and the cleaning of every page are timed in sscplus.metrics (load.*),
+the cleaning is timed in the worker process and recorded here.
+
+the cleaned pages can also be staged as a (gzipped) json lines blob, or one per
+shard of the index, so the durable activities only have to pass a small
+manifest around instead of the corpus.
+"""
+import gzip
+import json
+import multiprocessing
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import (Executor, Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+import time
+from typing import Callable, Iterable, Iterator, Optional
+
+from sscplus.metrics import in_context, metrics
+from sscplus.page_cache import PageCache
+from sscplus.text_extraction import (default_backend, extract_structured_text,
+                                     extract_text)
+
+download_concurrency = int(os.getenv("LOADER_DOWNLOAD_CONCURRENCY", "16"))
+clean_processes      = int(os.getenv("LOADER_CLEAN_PROCESSES", str(os.cpu_count() or 1)))
+compress_corpus      = os.getenv("CORPUS_COMPRESS", "true").lower() == "true"
+
+# the structure aware chunker (sscplus/chunking.py) splits on the lines of extract_structured_text,
+# CHUNKER=llama gets the single line text of the TEXT_EXTRACTION_BACKEND backend
+structured_text = os.getenv("CHUNKER", "structure") == "structure"
+
+# version of what parse_page returns, the cached pages of another version are not used
+PAGE_FORMAT = "page-2" if structured_text else f"page-2-{default_backend}"
+
+def iter_pages(container_client, prefix: str, download_concurrency: int = download_concurrency,
+               clean_processes: int = clean_processes, cache: Optional[PageCache] = None) -> Iterator[dict]:
+    """ yield the cleaned pages under prefix, in listing order """
+    def download(name: str, etag: str) -> tuple:
+        with metrics.timer("load.blob_read"):
+            data = container_client.get_blob_client(name).download_blob().readall()
+        metrics.count("load.bytes", len(data))
+        return data, name, etag, None
+
+    # the cache is read here rather than by the download threads, on a single cpu they
+    # would queue for the GIL behind the cleaning after each (fast) read
+    def read(blob) -> Future:
+        if cache is not None:
+            page = cache.get_page(blob.name, blob.etag, PAGE_FORMAT)
+            if page is not None:
+                return _completed((None, blob.name, blob.etag, page))
+            data = cache.get_raw(blob.name, blob.etag)
+            if data is not None:
+                return _completed((data, blob.name, blob.etag, None))
+        return downloads.submit(in_context(download), blob.name, blob.etag)
+
+    def clean(item: tuple) -> Future:
+        data, name, etag, page = item
+        if page is not None:
+            return _completed((page, None, name, etag))
+        return cleaning.submit(_clean_page, data, name, etag)
+
+    blobs = container_client.list_blobs(name_starts_with=prefix)
+    with ThreadPoolExecutor(max_workers=download_concurrency) as downloads, _clean_executor(clean_processes) as cleaning:
+        items = _bounded(map(read, blobs), download_concurrency * 2)
+        for page, seconds, name, etag in _bounded(map(clean, items), max(clean_processes, 1) * 2):
+            if seconds is not None:
+                metrics.observe("load.clean", seconds)
+                if page is not None and cache is not None:
+                    cache.put_page(name, etag, PAGE_FORMAT, page)
+            if page is not None:
+                metrics.count("load.pages")
+                yield page
+
+def write_corpus(container_client, blob_name: str, pages: Iterable[dict], compress: bool = compress_corpus) -> dict:
+    """
+    write the pages as json lines to a staging blob (spooled through a temp file, not memory).
+    returns the manifest to hand over to the next activity, see iter_corpus.
+    """
+    with _CorpusWriter(container_client, blob_name, compress) as writer:
+        for page in pages:
+            writer.write(page)
+    return writer.manifest
+
+def write_corpus_shards(container_client, prefix: str, pages: Iterable[dict], key: Callable[[dict], Optional[str]],
+                        compress: bool = compress_corpus) -> dict:
+    """
+    same as write_corpus, but split in one blob per shard (<prefix><shard>/corpus.jsonl[.gz]).
+    returns {shard: manifest}, pages without a shard (key returns None) are dropped.
+    """
+    writers: dict[str, _CorpusWriter] = {}
+    try:
+        for page in pages:
+            shard = key(page)
+            if shard is None:
+                continue
+            if shard not in writers:
+                writers[shard] = _CorpusWriter(container_client, f"{prefix}{shard}/corpus.jsonl" + (".gz" if compress else ""), compress)
+            writers[shard].write(page)
+    except BaseException:
+        for writer in writers.values():
+            writer.discard()
+        raise
+    for writer in writers.values():
+        writer.close()
+    return {shard: writer.manifest for shard, writer in writers.items()}
+
+def delete_corpus(container_client, prefix: str) -> int:
+    """ remove the blobs written by write_corpus_shards under prefix, returns how many there were """
+    names = list(container_client.list_blob_names(name_starts_with=prefix))
+    for name in names:
+        container_client.delete_blob(name)
+    return len(names)
+
+def iter_corpus(container_client, manifest: dict) -> Iterator[dict]:
+    """ stream back the pages written by write_corpus """
+    with tempfile.TemporaryFile() as f:
+        container_client.get_blob_client(manifest["blob_name"]).download_blob(max_concurrency=4).readinto(f)
+        f.seek(0)
+        lines = gzip.GzipFile(fileobj=f, mode="rb") if manifest["compressed"] else f
+        for line in lines:
+            yield json.loads(line)
+
+def parse_page(data: bytes, blob_name: str) -> Optional[dict]:
+    """ turn the json saved for a page into the (cleaned) page dict, None if there is nothing to use """
+    if data is None:
+        return None
+
+    raw = json.loads(data.decode('utf-8'))
+    if isinstance(raw, list) and raw:
+        raw = raw[0] # sometimes the object is boxed into an array, not useful to us
+    if not isinstance(raw, dict):
+        return None
+
+    return {
+        "body": extract_structured_text(raw["body"]) if structured_text else extract_text(raw["body"]),
+        "title": str(raw["title"]).strip(),
+        "url": str(raw["url"]).strip(),
+        "date": str(raw["date"]).strip(),
+        "filename": blob_name,
+        "nid": str(raw['nid']).strip(),
+    }
+
+def _clean_page(data: bytes, blob_name: str, etag: str) -> tuple[Optional[dict], float, str, str]:
+    """ parse_page in the cleaning processes, timed there """
+    start = time.perf_counter()
+    page = parse_page(data, blob_name)
+    return page, time.perf_counter() - start, blob_name, etag
+
+class _CorpusWriter:
+    """ json lines spooled through a temp file (gzipped or not) and uploaded to blob_name on close """
+    def __init__(self, container_client, blob_name: str, compress: bool):
+        self.container_client = container_client
+        self.blob_name = blob_name
+        self.compress = compress
+        self.count = 0
+        self.manifest: Optional[dict] = None
+        self._file = tempfile.TemporaryFile()
+        self._out = gzip.GzipFile(fileobj=self._file, mode="wb", compresslevel=6) if compress else self._file
+
+    def __enter__(self) -> "_CorpusWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def write(self, page: dict) -> None:
+        self._out.write(json.dumps(page, ensure_ascii=False).encode('utf-8') + b"\n")
+        self.count += 1
+
+    def close(self) -> None:
+        if self.compress:
+            self._out.close()
+        metrics.count("load.corpus_bytes", self._file.tell())
+        self._file.seek(0)
+        with metrics.timer("load.corpus_upload"):
+            self.container_client.get_blob_client(self.blob_name).upload_blob(self._file, overwrite=True, max_concurrency=4)
+        self._file.close()
+        self.manifest = {"container": self.container_client.container_name, "blob_name": self.blob_name,
+                         "count": self.count, "compressed": self.compress}
+
+    def discard(self) -> None:
+        self._file.close()
+
+def _bounded(futures: Iterable[Future], window: int) -> Iterator:
+    """ results of the futures in order, only pulling `window` of them ahead instead of submitting everything up front """
+    pending = deque()
+    for future in futures:
+        pending.append(future)
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def _completed(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+class _InlineExecutor(Executor):
+    """ runs the work in the calling thread, used when there is no point in starting processes """
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+def _clean_executor(processes: int) -> Executor:
+    if processes <= 1:
+        return _InlineExecutor()
+    # spawn rather than fork, the functions worker is multi threaded (grpc) and forking it is not safe
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
@@ -0,0 +1,235 @@
+"""
+lightweight instrumentation of the pipeline: counters and timings per stage.
+
+  from sscplus.metrics import metrics
+  with metrics.timer("fetch.request"):
+      ...
+  metrics.count("fetch.bytes", len(response.content))
+
+measurements are aggregated in memory (per worker process, thread safe), timers
+as a count, a total and a fixed bucket histogram of the durations. when the
+opentelemetry api is installed they are also recorded on opentelemetry
+instruments (meter "sscplus"), sent to Application Insights when
+azure-monitor-opentelemetry is installed and APPLICATIONINSIGHTS_CONNECTION_STRING
+is set. METRICS=false turns everything off.
+
+run_report() wraps an activity / timer function: what was measured while it ran
+is logged as one json line and written to reports/<run>/<function>-<id>.json,
+merge_reports() sums those parts into reports/<run>.json once the orchestration
+is done. a report only has what was measured in its own context (contextvars),
+activities running at the same time in one worker do not count each other's
+work. the threads of a ThreadPoolExecutor do not inherit the context, the
+functions they run are wrapped with in_context().
+"""
+import bisect
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Iterator, Optional
+
+metrics_enabled = os.getenv("METRICS", "true").lower() == "true"
+
+REPORTS_PREFIX = "reports"
+# upper bounds (seconds) of the duration histograms, the last bucket is everything above
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+class Collector:
+    """ counters and timers, those of the worker and those of each run_report """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: dict[str, float] = {}
+        # name -> [count, total seconds, max seconds, *bucket counts]
+        self.timers: dict[str, list] = {}
+
+    def count(self, name: str, value: float) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0] + [0] * (len(BUCKETS) + 1))
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+            timer[3 + bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {"counters": dict(self.counters), "timers": {name: list(timer) for name, timer in self.timers.items()}}
+
+# the collectors of the run reports the current code runs under (nested reports each get everything)
+_collectors: contextvars.ContextVar[tuple[Collector, ...]] = contextvars.ContextVar("collectors", default=())
+
+class Metrics:
+    def __init__(self, enabled: bool = metrics_enabled):
+        self.enabled = enabled
+        # everything measured in this worker
+        self.totals = Collector()
+        self.instruments: dict[str, object] = {}
+        # opentelemetry meter, imported on first use (False when not installed)
+        self.meter = None
+
+    def count(self, name: str, value: float = 1) -> None:
+        if not self.enabled:
+            return
+        for collector in (self.totals, *_collectors.get()):
+            collector.count(name, value)
+        instrument = self._instrument(name, "counter")
+        if instrument is not None:
+            instrument.add(value) # type: ignore
+
+    def observe(self, name: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        for collector in (self.totals, *_collectors.get()):
+            collector.observe(name, seconds)
+        instrument = self._instrument(name, "histogram")
+        if instrument is not None:
+            instrument.record(seconds) # type: ignore
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        return self.totals.snapshot()
+
+    def _instrument(self, name: str, kind: str):
+        if self.meter is None:
+            try:
+                from opentelemetry import metrics as otel_metrics
+                self.meter = otel_metrics.get_meter("sscplus")
+            except ImportError:
+                self.meter = False
+        if self.meter is False:
+            return None
+        key = f"{kind}:{name}"
+        if key not in self.instruments:
+            self.instruments[key] = self.meter.create_histogram(f"sscplus.{name}", unit="s") if kind == "histogram" \
+                else self.meter.create_counter(f"sscplus.{name}")
+        return self.instruments[key]
+
+metrics = Metrics()
+
+def in_context(fn: Callable) -> Callable:
+    """ fn measured for the run reports of the caller, when it runs in another thread (executor.map/submit) """
+    collectors = _collectors.get()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _collectors.set(collectors)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _collectors.reset(token)
+    return wrapper
+
+def summarise(before: dict, after: dict) -> dict:
+    """ what was measured between two snapshots """
+    counters = {name: value - before["counters"].get(name, 0) for name, value in after["counters"].items()}
+    timers = {}
+    for name, timer in after["timers"].items():
+        previous = before["timers"].get(name)
+        if previous is not None:
+            # the max can't be told apart, it is the one since the worker started
+            timer = [timer[0] - previous[0], timer[1] - previous[1], timer[2]] + [a - b for a, b in zip(timer[3:], previous[3:])]
+        if timer[0]:
+            timers[name] = timer
+    return {"counters": {name: value for name, value in counters.items() if value},
+            "timers": {name: _describe(timer) for name, timer in timers.items()}}
+
+def _describe(timer: list) -> dict:
+    count, total, longest, buckets = timer[0], timer[1], timer[2], timer[3:]
+    return {"count": count, "seconds": round(total, 3), "mean": round(total / count, 4), "max": round(longest, 3),
+            "p50": _quantile(buckets, 0.5, longest), "p95": _quantile(buckets, 0.95, longest), "buckets": buckets}
+
+def _quantile(buckets: list, q: float, longest: float) -> float:
+    """ upper bound of the bucket the quantile falls in """
+    target, seen = q * sum(buckets), 0
+    for bound, count in zip(BUCKETS + (longest,), buckets):
+        seen += count
+        if count and seen >= target:
+            return round(min(bound, longest), 4)
+    return round(longest, 4)
+
+_configured = False
+
+def configure_telemetry() -> None:
+    """ send the opentelemetry metrics to Application Insights, if azure-monitor-opentelemetry is around """
+    global _configured
+    if _configured or not metrics_enabled or not os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
+        return
+    _configured = True
+    try:
+        from azure.monitor.opentelemetry import configure_azure_monitor
+    except ImportError:
+        return
+    try:
+        configure_azure_monitor()
+    except Exception as e:
+        logging.warning(f"Unable to configure the Application Insights exporter. Error: {e}")
+
+@contextmanager
+def run_report(container_client, run: Optional[str], function: str) -> Iterator[dict]:
+    """
+    measure the body, then log and upload its report. the yielded dict is added to
+    the report (counts, sizes ... the function wants to report on).
+    """
+    configure_telemetry()
+    collector, started, start = Collector(), datetime.now(timezone.utc), time.perf_counter()
+    token = _collectors.set(_collectors.get() + (collector,))
+    extra: dict = {}
+    error = None
+    try:
+        yield extra
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        _collectors.reset(token)
+        if metrics_enabled:
+            report = {"run": run, "function": function, "started": started.isoformat(), "seconds": round(time.perf_counter() - start, 3),
+                      "error": error, **extra, **summarise({"counters": {}, "timers": {}}, collector.snapshot())}
+            logging.info(f"Run report {json.dumps(report)}")
+            stamp = started.strftime("%Y-%m-%dT%H-%M-%S")
+            blob_name = f"{REPORTS_PREFIX}/{run}/{function}-{stamp}-{uuid.uuid4().hex[:8]}.json" if run \
+                else f"{REPORTS_PREFIX}/{function}-{stamp}.json"
+            try:
+                container_client.get_blob_client(blob_name).upload_blob(json.dumps(report, indent=2), overwrite=True)
+            except Exception as e:
+                # a report never fails the run
+                logging.warning(f"Unable to write the run report {blob_name}. Error: {e}")
+
+def merge_reports(container_client, run: str, name: Optional[str] = None) -> dict:
+    """ sum the parts under reports/<run>/ into reports/<run>.json, stages sorted by the time spent in them """
+    counters: dict[str, float] = {}
+    timers: dict[str, list] = {}
+    functions = []
+    for blob_name in sorted(container_client.list_blob_names(name_starts_with=f"{REPORTS_PREFIX}/{run}/")):
+        part = json.loads(container_client.get_blob_client(blob_name).download_blob().readall())
+        functions.append({key: part.get(key) for key in ("function", "started", "seconds", "error")})
+        for counter, value in part["counters"].items():
+            counters[counter] = counters.get(counter, 0) + value
+        for timer_name, timer in part["timers"].items():
+            merged = timers.setdefault(timer_name, [0, 0.0, 0.0] + [0] * (len(BUCKETS) + 1))
+            merged[0] += timer["count"]
+            merged[1] += timer["seconds"]
+            merged[2] = max(merged[2], timer["max"])
+            merged[3:] = [a + b for a, b in zip(merged[3:], timer["buckets"])]
+
+    stages = dict(sorted(((timer_name, _describe(timer)) for timer_name, timer in timers.items()), key=lambda item: -item[1]["seconds"]))
+    report = {"run": run, "name": name, "functions": functions, "counters": dict(sorted(counters.items())), "timers": stages}
+    container_client.get_blob_client(f"{REPORTS_PREFIX}/{run}.json").upload_blob(json.dumps(report, indent=2), overwrite=True)
+    logging.info(f"Run report of {name or run}: " + ", ".join(f"{timer_name} {timer['seconds']}s" for timer_name, timer in list(stages.items())[:10]))
+    return report
@@ -0,0 +1,156 @@
+"""
+worker local cache of the pages, so the fetch, load and index activities running
+on the same host do not download and clean the same blobs over and over.
+
+entries are keyed by blob name and ETag (a new version of the blob is a new key):
+
+* "raw": the json as saved by the fetch, put there when the page is uploaded
+  (or copied from the previous crawl),
+* the cleaned page dict, put there by the loader once the html is cleaned. the
+  loader names it after the format of its output, pages cleaned by an older
+  version of the code are never returned.
+
+same as the embedding cache, it is a sqlite file under /tmp (a file per entry
+costs a file creation per page, slower than the blob read it saves on a busy
+disk). synchronous writes are off, it is only a cache. the processes of the
+worker share the file, the least recently used entries are evicted once it holds
+more than PAGE_CACHE_MAX_BYTES. hits, misses and evictions go to sscplus.metrics
+(page_cache.*).
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import IO, Optional
+
+from sscplus.metrics import metrics
+
+cache_enabled   = os.getenv("PAGE_CACHE", "true").lower() == "true"
+cache_path      = os.getenv("PAGE_CACHE_PATH", "/tmp/page-cache/pages.sqlite")
+cache_max_bytes = int(os.getenv("PAGE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+RAW = "raw"
+# bigger pages are not worth holding in memory to cache them
+MAX_ENTRY_BYTES = 8 * 1024 * 1024
+
+class PageCache:
+    def __init__(self, path: str = cache_path, max_bytes: int = cache_max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection: Optional[sqlite3.Connection] = None
+        # bytes written since the size was last checked
+        self.written = 0
+
+    @staticmethod
+    def key(blob_name: str, etag: str, kind: str) -> str:
+        # the listing and the upload responses do not quote the etag the same way
+        etag = etag.strip('"')
+        return hashlib.sha256(f"{kind}\n{blob_name}\n{etag}".encode("utf-8")).hexdigest()
+
+    def get_raw(self, blob_name: str, etag: Optional[str]) -> Optional[bytes]:
+        return self._get(blob_name, etag, RAW)
+
+    def put_raw(self, blob_name: str, etag: Optional[str], data: bytes | IO[bytes]) -> None:
+        """ data is the bytes of the blob or a file positioned at their start """
+        if not isinstance(data, bytes):
+            data = data.read(MAX_ENTRY_BYTES + 1)
+        self._put(blob_name, etag, RAW, data)
+
+    def get_page(self, blob_name: str, etag: Optional[str], kind: str) -> Optional[dict]:
+        data = self._get(blob_name, etag, kind)
+        return None if data is None else json.loads(data)
+
+    def put_page(self, blob_name: str, etag: Optional[str], kind: str, page: dict) -> None:
+        self._put(blob_name, etag, kind, json.dumps(page, ensure_ascii=False).encode("utf-8"))
+
+    def copy_raw(self, source_name: str, source_etag: Optional[str], blob_name: str, etag: Optional[str]) -> None:
+        """ a blob copied server side has the same content under a new name and etag """
+        data = self.get_raw(source_name, source_etag)
+        if data is not None:
+            self.put_raw(blob_name, etag, data)
+
+    def close(self) -> None:
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def _get(self, blob_name: str, etag: Optional[str], kind: str) -> Optional[bytes]:
+        if not etag:
+            return None
+        key = self.key(blob_name, etag, kind)
+        try:
+            with self.lock:
+                connection = self._connect()
+                row = connection.execute("SELECT data FROM pages WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    connection.execute("UPDATE pages SET used = ? WHERE key = ?", (time.time(), key))
+                    connection.commit()
+        except sqlite3.Error as e:
+            logging.warning(f"Unable to read {blob_name} ({kind}) from the page cache. Error: {e}")
+            row = None
+        metrics.count(f"page_cache.{'raw' if kind == RAW else 'clean'}_{'misses' if row is None else 'hits'}")
+        return None if row is None else row[0]
+
+    def _put(self, blob_name: str, etag: Optional[str], kind: str, data: bytes) -> None:
+        if not etag or len(data) > MAX_ENTRY_BYTES:
+            return
+        try:
+            with self.lock:
+                connection = self._connect()
+                connection.execute("INSERT OR REPLACE INTO pages (key, data, size, used) VALUES (?, ?, ?, ?)",
+                                   (self.key(blob_name, etag, kind), data, len(data), time.time()))
+                connection.commit()
+                self.written += len(data)
+                # the other processes write too, the total is summed again every few MB
+                if self.written > min(self.max_bytes // 10, 16 * 1024 * 1024):
+                    self.written = 0
+                    self._evict(connection)
+        except sqlite3.Error as e:
+            # a full disk, a database locked for too long ... only costs a miss the next time
+            logging.warning(f"Unable to cache {blob_name} ({kind}). Error: {e}")
+            return
+        metrics.count("page_cache.bytes_written", len(data))
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        """ drop the least recently used entries until the cache is back under 90% of max_bytes """
+        size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        if size <= self.max_bytes:
+            return
+        evicted, excess = 0, size - self.max_bytes * 0.9
+        for key, entry_size in connection.execute("SELECT key, size FROM pages ORDER BY used").fetchall():
+            if excess <= 0:
+                break
+            connection.execute("DELETE FROM pages WHERE key = ?", (key,))
+            excess -= entry_size
+            evicted += 1
+        connection.commit()
+        metrics.count("page_cache.evictions", evicted)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode = WAL")
+            self.connection.execute("PRAGMA synchronous = OFF")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, data BLOB NOT NULL, "
+                                    "size INTEGER NOT NULL, used REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS pages_used ON pages (used)")
+        return self.connection
+
+_cache: Optional[PageCache] = None
+_cache_lock = threading.Lock()
+
+def get_page_cache() -> Optional[PageCache]:
+    """ one cache (connection) per worker process, None if PAGE_CACHE=false """
+    global _cache
+    if not cache_enabled:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = PageCache()
+        return _cache
@@ -0,0 +1,153 @@
+"""
+vectorised top k similarity search over the embedding matrix of a persisted
+index (default__vector_store.npy, see sscplus/vector_store.py).
+
+exact search is a matrix-vector product per block of rows, with the norms of
+the rows computed once, and argpartition to pick the top k. for bigger indices
+an IVF index (k-means centroids and the rows of each of their lists) is built
+when the vector store is persisted (IVF_MIN_NODES and up, 0 to never build it)
+and saved next to it as default__vector_store.ivf.npz, a query then only scores
+the rows of the IVF_PROBES lists with the closest centroids.
+
+NumpyVectorStore.query goes through this, so does SearchEngine for consumers of
+the index files (the chatbot reading the file share) that don't use llama_index.
+"""
+import json
+import logging
+import os
+import time
+from typing import Optional, Sequence
+
+import numpy as np
+
+ivf_min_nodes  = int(os.getenv("IVF_MIN_NODES", "20000"))
+# 0 means sqrt(number of nodes)
+ivf_lists      = int(os.getenv("IVF_LISTS", "0"))
+ivf_probes     = int(os.getenv("IVF_PROBES", "16"))
+ivf_iterations = int(os.getenv("IVF_ITERATIONS", "10"))
+
+# rows read from the (memory-mapped) matrix at once
+BLOCK_ROWS = 8192
+# rows per list used to train the centroids
+TRAINING_ROWS_PER_LIST = 64
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """ indices of the k highest scores, highest first """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+def cosine_scores(block: np.ndarray, query: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(block, axis=1) * np.linalg.norm(query)
+    return block @ query / np.where(norms == 0, 1, norms)
+
+def _normalise(rows: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(rows, axis=-1, keepdims=True)
+    return rows / np.where(norms == 0, 1, norms)
+
+class ExactSearch:
+    def __init__(self, matrix: np.ndarray):
+        self.matrix = matrix
+        inv_norms = np.empty(matrix.shape[0], dtype=np.float32)
+        for start in range(0, matrix.shape[0], BLOCK_ROWS):
+            norms = np.linalg.norm(np.asarray(matrix[start:start + BLOCK_ROWS], dtype=np.float32), axis=1)
+            inv_norms[start:start + BLOCK_ROWS] = 1 / np.where(norms == 0, np.inf, norms)
+        self.inv_norms = inv_norms
+
+    def scores(self, query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """ cosine similarity of the query with the given (sorted) rows, all of them by default """
+        query = _normalise(np.asarray(query, dtype=np.float32))
+        count = self.matrix.shape[0] if rows is None else len(rows)
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, BLOCK_ROWS):
+            block = self.matrix[start:start + BLOCK_ROWS] if rows is None else self.matrix[rows[start:start + BLOCK_ROWS]]
+            inv_norms = self.inv_norms[start:start + BLOCK_ROWS] if rows is None else self.inv_norms[rows[start:start + BLOCK_ROWS]]
+            scores[start:start + len(block)] = np.asarray(block, dtype=np.float32) @ query * inv_norms
+        return scores
+
+    def search(self, query: np.ndarray, k: int, rows: Optional[np.ndarray] = None) -> tuple[np.ndarray, np.ndarray]:
+        """ (rows, similarities) of the k closest rows """
+        scores = self.scores(query, rows)
+        top = top_k(scores, k)
+        return (top if rows is None else rows[top]), scores[top]
+
+class IVFIndex:
+    def __init__(self, centroids: np.ndarray, offsets: np.ndarray, rows: np.ndarray):
+        self.centroids = centroids
+        # rows of list i are rows[offsets[i]:offsets[i + 1]]
+        self.offsets = offsets
+        self.rows = rows
+
+    @classmethod
+    def build(cls, exact: ExactSearch, n_lists: int = ivf_lists, iterations: int = ivf_iterations, seed: int = 0) -> "IVFIndex":
+        """ spherical k-means on a sample of the rows, then every row assigned to its closest centroid """
+        start = time.time()
+        matrix = exact.matrix
+        count = matrix.shape[0]
+        n_lists = max(1, min(n_lists or int(np.sqrt(count)), count))
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(count, size=min(count, n_lists * TRAINING_ROWS_PER_LIST), replace=False))
+        training = _normalise(np.asarray(matrix[sample], dtype=np.float32))
+        centroids = training[rng.choice(len(training), size=n_lists, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(training @ centroids.T, axis=1)
+            order = np.argsort(assignments, kind="stable")
+            counts = np.bincount(assignments, minlength=n_lists)
+            empty = counts == 0
+            sums = np.zeros_like(centroids)
+            sums[~empty] = np.add.reduceat(training[order], (np.cumsum(counts) - counts)[~empty])
+            # lists left empty start again from random rows
+            sums[empty] = training[rng.choice(len(training), size=int(empty.sum()))]
+            centroids = _normalise(sums)
+
+        assignments = np.empty(count, dtype=np.int32)
+        for start_row in range(0, count, BLOCK_ROWS):
+            block = _normalise(np.asarray(matrix[start_row:start_row + BLOCK_ROWS], dtype=np.float32))
+            assignments[start_row:start_row + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        rows = np.argsort(assignments, kind="stable").astype(np.int32)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))]).astype(np.int64)
+        logging.info(f"Built an IVF index of {n_lists} lists over {count} rows in {time.time() - start:.1f} seconds")
+        return cls(centroids.astype(np.float32), offsets, rows)
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path) as data:
+            return cls(data["centroids"], data["offsets"], data["rows"])
+
+    def save(self, path: str) -> None:
+        # np.savez adds .npz to names that don't end with it
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, centroids=self.centroids, offsets=self.offsets, rows=self.rows)
+        os.replace(path + ".tmp", path)
+
+    def search(self, exact: ExactSearch, query: np.ndarray, k: int, n_probe: int = ivf_probes) -> tuple[np.ndarray, np.ndarray]:
+        query = np.asarray(query, dtype=np.float32)
+        lists = top_k(self.centroids @ _normalise(query), n_probe)
+        rows = np.sort(np.concatenate([self.rows[self.offsets[i]:self.offsets[i + 1]] for i in lists]))
+        if len(rows) < k:
+            return exact.search(query, k)
+        return exact.search(query, k, rows)
+
+class SearchEngine:
+    """ top k node ids of a persisted index directory, without loading the rest of the index """
+    def __init__(self, matrix: np.ndarray, ids: Sequence[str], ivf: Optional[IVFIndex] = None):
+        self.exact = ExactSearch(matrix)
+        self.ids = list(ids)
+        self.ivf = ivf
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, namespace: str = "default") -> "SearchEngine":
+        root = os.path.join(persist_dir, f"{namespace}__vector_store")
+        with open(root + ".ids.json", encoding="utf-8") as f:
+            ids = json.load(f)["ids"]
+        ivf = IVFIndex.load(root + ".ivf.npz") if os.path.exists(root + ".ivf.npz") else None
+        return cls(np.load(root + ".npy", mmap_mode="r"), ids, ivf)
+
+    def search(self, query_embedding: Sequence[float], k: int = 4, exact: bool = False) -> list[tuple[str, float]]:
+        if self.ivf is not None and not exact:
+            rows, scores = self.ivf.search(self.exact, np.asarray(query_embedding), k)
+        else:
+            rows, scores = self.exact.search(np.asarray(query_embedding), k)
+        return [(self.ids[row], float(score)) for row, score in zip(rows, scores)]
@@ -0,0 +1,95 @@
+"""
+indices built in shards, one per (content type, language) of the pages.
+
+<shard>/ of a version of an index holds a complete index (same files as an
+unsharded one, see sscplus/vector_store.py) and its router.json lists them:
+
+  {"shards": {"page-en": {"type": "page", "lang": "en", "documents": 1234, "nodes": 5678}, ...}}
+
+shards are built by separate activities (build_index_orc) and can be rebuilt or
+updated (get_page_updates) on their own, only their files and entry of the
+router change in the next version (see sscplus/versions.py).
+ShardedRetriever (llama_index) and ShardedSearchEngine (numpy only) query all
+the shards of a persisted index, or those of one language, and merge the results.
+"""
+import json
+import os
+import re
+from typing import Iterable, List, Optional, Sequence
+
+from llama_index import QueryBundle, ServiceContext, load_index_from_storage
+from llama_index.retrievers import BaseRetriever
+from llama_index.schema import NodeWithScore
+
+from sscplus.retrieval import SearchEngine
+from sscplus.vector_store import storage_context_from_persist_dir
+from sscplus.versions import ROUTER_NAME
+
+def shard_key(filename: str) -> Optional[str]:
+    """ <type>-<lang>, the shard of a page out of its blob name (preload/<date>/<type>/<lang>/<nid>.json) """
+    match = re.search(r'(?:^|/)([\w-]+)/(\w+)/\d+\.json$', filename)
+    return f"{match.group(1)}-{match.group(2)}" if match else None
+
+def shard_entry(shard: str) -> dict:
+    """ type and lang of a shard, as kept in the router """
+    type, lang = shard.rsplit("-", 1)
+    return {"type": type, "lang": lang}
+
+def group_by_shard(pages: Iterable[dict]) -> dict[str, list[dict]]:
+    shards: dict[str, list[dict]] = {}
+    for page in pages:
+        shard = shard_key(page["filename"])
+        if shard is not None:
+            shards.setdefault(shard, []).append(page)
+    return shards
+
+def update_router(router: Optional[dict], shards: dict) -> dict:
+    """ add / replace the given shard entries of a router, the other shards are kept as they are """
+    router = {"shards": {**(router or {"shards": {}})["shards"], **shards}}
+    router["shards"] = dict(sorted(router["shards"].items()))
+    return router
+
+def _read_local_router(persist_dir: str) -> dict:
+    with open(os.path.join(persist_dir, ROUTER_NAME), encoding="utf-8") as f:
+        return json.load(f)
+
+def _select(router: dict, lang: Optional[str] = None) -> List[str]:
+    return [shard for shard, entry in router["shards"].items() if lang is None or entry.get("lang") == lang]
+
+class ShardedRetriever(BaseRetriever):
+    """ retrieves from every shard and keeps the best similarity_top_k nodes overall """
+    def __init__(self, retrievers: Sequence[BaseRetriever], similarity_top_k: int = 4, **kwargs):
+        self.retrievers = list(retrievers)
+        self.similarity_top_k = similarity_top_k
+        super().__init__(**kwargs)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, similarity_top_k: int = 4, lang: Optional[str] = None,
+                         service_context: Optional[ServiceContext] = None) -> "ShardedRetriever":
+        retrievers = []
+        for shard in _select(_read_local_router(persist_dir), lang):
+            storage_context = storage_context_from_persist_dir(os.path.join(persist_dir, shard))
+            index = load_index_from_storage(storage_context=storage_context, service_context=service_context)
+            retrievers.append(index.as_retriever(similarity_top_k=similarity_top_k))
+        return cls(retrievers, similarity_top_k)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # the same bundle goes to every shard, the query is embedded by the first one only
+        nodes = [node for retriever in self.retrievers for node in retriever.retrieve(query_bundle)]
+        return sorted(nodes, key=lambda node: node.score or 0.0, reverse=True)[:self.similarity_top_k]
+
+class ShardedSearchEngine:
+    """ SearchEngine over every shard of a persisted index """
+    def __init__(self, engines: dict[str, SearchEngine]):
+        self.engines = engines
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, lang: Optional[str] = None) -> "ShardedSearchEngine":
+        return cls({shard: SearchEngine.from_persist_dir(os.path.join(persist_dir, shard))
+                    for shard in _select(_read_local_router(persist_dir), lang)})
+
+    def search(self, query_embedding: Sequence[float], k: int = 4, exact: bool = False) -> list[tuple[str, str, float]]:
+        """ (shard, node id, similarity) of the k closest nodes over all shards """
+        results = [(shard, node_id, score) for shard, engine in self.engines.items()
+                   for node_id, score in engine.search(query_embedding, k, exact)]
+        return sorted(results, key=lambda result: result[2], reverse=True)[:k]
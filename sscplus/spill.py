@@ -0,0 +1,129 @@
+"""
+docstore and embeddings of an index being built, kept on disk instead of in
+memory (BUILD_STREAMING, see _build_index in function_app.py).
+
+llama_index's SimpleDocumentStore holds every node (text, metadata, relations)
+in the dict of a SimpleKVStore until the whole of it is dumped as
+docstore.json, and NumpyVectorStore holds the embeddings added since it was
+loaded in a list. after every batch of documents, spill() moves both to files
+under /tmp:
+
+* SpillingKVStore, the same key value store with its entries moved to a
+  sqlite file. reads and deletes go to both, persist writes the same
+  docstore.json as SimpleKVStore one entry at a time, it is loaded as usual.
+* NumpyVectorStore.spill, the new rows appended to a raw matrix file that is
+  memory mapped and their ids, ref doc ids and metadata moved to a sqlite file
+  (see sscplus/vector_store.py). both are persisted a row at a time.
+
+what stays in memory is the batch being embedded, the node ids of the index
+struct (index_store.json) and the ids of the documents (checkpoint, nid index).
+"""
+import json
+import os
+import shutil
+import sqlite3
+from typing import Any, Dict, Optional
+
+from llama_index import StorageContext
+from llama_index.storage.docstore import SimpleDocumentStore
+from llama_index.storage.kvstore.simple_kvstore import SimpleKVStore
+from llama_index.storage.kvstore.types import DEFAULT_COLLECTION
+
+from sscplus.metrics import metrics
+from sscplus.vector_store import NumpyVectorStore
+
+DOCSTORE_NAME = "docstore.sqlite"
+EMBEDDINGS_NAME = "embeddings.bin"
+ROWS_NAME = "rows.sqlite"
+
+class SpillingKVStore(SimpleKVStore):
+    def __init__(self, path: str, data: Optional[dict] = None):
+        super().__init__(data)
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            # left by an attempt that did not finish, what it held is in the checkpoint (if anything)
+            os.remove(path)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # scratch space, nothing to recover after a crash
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute("CREATE TABLE entries (collection TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                                "PRIMARY KEY (collection, key))")
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        # what is in memory is more recent than what was spilled
+        value = super().get(key, collection)
+        if value is None:
+            row = self.connection.execute("SELECT value FROM entries WHERE collection = ? AND key = ?", (collection, key)).fetchone()
+            value = None if row is None else json.loads(row[0])
+        return value
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        values = {key: json.loads(value) for key, value in
+                  self.connection.execute("SELECT key, value FROM entries WHERE collection = ?", (collection,))}
+        values.update(super().get_all(collection))
+        return values
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        spilled = self.connection.execute("DELETE FROM entries WHERE collection = ? AND key = ?", (collection, key)).rowcount > 0
+        return super().delete(key, collection) or spilled
+
+    def spill(self) -> int:
+        """ move the entries in memory to the file, returns how many """
+        count = 0
+        for collection, entries in self._data.items():
+            self.connection.executemany("INSERT OR REPLACE INTO entries (collection, key, value) VALUES (?, ?, ?)",
+                                        ((collection, key, json.dumps(value)) for key, value in entries.items()))
+            count += len(entries)
+        self.connection.commit()
+        self._data = {}
+        return count
+
+    def persist(self, persist_path: str, fs: Optional[Any] = None) -> None:
+        """ same file as SimpleKVStore.persist, written an entry at a time (local files only) """
+        self.spill()
+        os.makedirs(os.path.dirname(persist_path) or ".", exist_ok=True)
+        with open(persist_path, "w", encoding="utf-8") as f:
+            f.write("{")
+            current = None
+            for collection, key, value in self.connection.execute("SELECT collection, key, value FROM entries ORDER BY collection, key"):
+                if collection != current:
+                    f.write(("}, " if current is not None else "") + json.dumps(collection) + ": {")
+                    current = collection
+                else:
+                    f.write(", ")
+                f.write(json.dumps(key) + ": " + value)
+            f.write("}}" if current is not None else "}")
+
+    def close(self) -> None:
+        self.connection.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def new_docstore(directory: str) -> SimpleDocumentStore:
+    return SimpleDocumentStore(simple_kvstore=SpillingKVStore(os.path.join(directory, DOCSTORE_NAME)))
+
+def spilling_docstore(docstore: SimpleDocumentStore, directory: str) -> SimpleDocumentStore:
+    """ a loaded docstore (a checkpoint) moved to disk """
+    kvstore = SpillingKVStore(os.path.join(directory, DOCSTORE_NAME), docstore._kvstore._data)
+    kvstore.spill()
+    return SimpleDocumentStore(simple_kvstore=kvstore)
+
+def spill(storage_context: StorageContext, directory: str) -> None:
+    """ move what the last batch added to the docstore and the vector store to disk """
+    with metrics.timer("index.spill"):
+        kvstore = storage_context.docstore._kvstore
+        if isinstance(kvstore, SpillingKVStore):
+            metrics.count("index.spilled_entries", kvstore.spill())
+        if isinstance(storage_context.vector_store, NumpyVectorStore):
+            storage_context.vector_store.spill(os.path.join(directory, EMBEDDINGS_NAME), os.path.join(directory, ROWS_NAME))
+
+def clear(storage_context: StorageContext, directory: str) -> None:
+    """ once the index is persisted """
+    kvstore = storage_context.docstore._kvstore
+    if isinstance(kvstore, SpillingKVStore):
+        kvstore.close()
+    if isinstance(storage_context.vector_store, NumpyVectorStore):
+        storage_context.vector_store.close()
+    shutil.rmtree(directory, ignore_errors=True)
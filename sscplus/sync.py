@@ -0,0 +1,207 @@
+"""
+delta sync of a persisted index directory between /tmp, blob storage and the
+chatbot file share.
+
+every copy of an index carries a manifest.json ({file name: {sha256, size}}).
+a sync compares the manifest of the source with the one of the destination and
+only moves the files that differ, large files are moved in parallel chunks
+(SYNC_MAX_CONCURRENCY connections of SYNC_BLOCK_SIZE bytes). the destination
+manifest is removed while files are being replaced and written last, so an
+interrupted sync is seen as "no manifest" (full copy) the next time around.
+the time and bytes of every sync go to sscplus.metrics (sync.<action>).
+
+the manifest of a version of an index (see sscplus/versions.py) can be given
+instead of the one under the prefix, its entries name the blob holding each file
+("blob"), which can be the one of an older version.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Optional
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+from sscplus.metrics import metrics
+
+MANIFEST_NAME = "manifest.json"
+
+sync_max_concurrency = int(os.getenv("SYNC_MAX_CONCURRENCY", "8"))
+# also used as the block/chunk size of the blob service client, see function_app.py
+sync_block_size      = int(os.getenv("SYNC_BLOCK_SIZE", str(8 * 1024 * 1024)))
+
+def file_manifest(local_dir: str, expected: Optional[dict] = None) -> dict:
+    """
+    {file name: {sha256, size}} of the files in local_dir. when expected is given, files whose size
+    already differs from it are not hashed (they will be transferred anyway).
+    """
+    manifest = {}
+    if not os.path.isdir(local_dir):
+        return manifest
+    for name in sorted(os.listdir(local_dir)):
+        path = os.path.join(local_dir, name)
+        if name == MANIFEST_NAME or not os.path.isfile(path):
+            continue
+        size = os.path.getsize(path)
+        if expected is not None and (expected.get(name) or {}).get("size") != size:
+            manifest[name] = {"sha256": None, "size": size}
+        else:
+            manifest[name] = {"sha256": _sha256(path), "size": size}
+    return manifest
+
+def read_blob_manifest(container_client, prefix: str) -> dict:
+    try:
+        return json.loads(container_client.get_blob_client(f"{prefix}/{MANIFEST_NAME}").download_blob().readall())
+    except ResourceNotFoundError:
+        return {}
+
+def upload_dir(local_dir: str, container_client, prefix: str, max_concurrency: int = sync_max_concurrency,
+               last: Optional[list[str]] = None) -> dict:
+    """
+    upload the files of local_dir that changed compared to <prefix>/manifest.json (the ones named
+    in last after the others), then the new manifest
+    """
+    start = time.time()
+    remote = read_blob_manifest(container_client, prefix)
+    local = file_manifest(local_dir)
+    changed = sorted((name for name, entry in local.items() if remote.get(name) != entry), key=lambda name: name in (last or []))
+    stale = [name for name in remote if name not in local]
+
+    if changed or stale:
+        _delete_blob(container_client, f"{prefix}/{MANIFEST_NAME}")
+    for name in changed:
+        with open(os.path.join(local_dir, name), "rb") as data:
+            container_client.get_blob_client(f"{prefix}/{name}").upload_blob(data, overwrite=True, max_concurrency=max_concurrency)
+    for name in stale:
+        _delete_blob(container_client, f"{prefix}/{name}")
+    container_client.get_blob_client(f"{prefix}/{MANIFEST_NAME}").upload_blob(json.dumps(local, indent=2), overwrite=True)
+
+    return _report("uploaded", f"{local_dir} -> {prefix}/", local, changed, stale, start)
+
+def upload_files(local_dir: str, container_client, prefix: str, base: Optional[dict] = None,
+                 max_concurrency: int = sync_max_concurrency) -> dict:
+    """
+    upload the files of local_dir under <prefix>/, but those with the same content in base (a manifest
+    with blob names). returns the manifest of local_dir, with the blob of every file
+    """
+    start = time.time()
+    base = base or {}
+    local = file_manifest(local_dir)
+    changed = [name for name, entry in local.items() if not _same(base.get(name), entry)]
+    for name in changed:
+        with open(os.path.join(local_dir, name), "rb") as data:
+            container_client.get_blob_client(f"{prefix}/{name}").upload_blob(data, overwrite=True, max_concurrency=max_concurrency)
+
+    _report("uploaded", f"{local_dir} -> {prefix}/", local, changed, [], start)
+    return {name: {**entry, "blob": f"{prefix}/{name}" if name in changed else base[name]["blob"]} for name, entry in local.items()}
+
+def download_dir(container_client, prefix: str, local_dir: str, max_concurrency: int = sync_max_concurrency,
+                 manifest: Optional[dict] = None) -> dict:
+    """ download the files of <prefix>/ (or of the manifest) that are missing or different in local_dir """
+    start = time.time()
+    os.makedirs(local_dir, exist_ok=True)
+    remote = read_blob_manifest(container_client, prefix) if manifest is None else manifest
+    if not remote and manifest is None:
+        # copied before manifests existed (or interrupted), everything is transferred once
+        logging.info(f"No {MANIFEST_NAME} under {prefix}/, downloading all of it")
+        remote = list_blob_dir(container_client, prefix)
+    local = file_manifest(local_dir, remote)
+    changed = [name for name, entry in remote.items() if not _same(local.get(name), entry)]
+    stale = [name for name in local if name not in remote]
+
+    for name in changed:
+        path = os.path.join(local_dir, name)
+        # write next to the target and swap, a failed download never leaves a truncated file behind
+        with tempfile.NamedTemporaryFile(dir=local_dir, delete=False) as f:
+            container_client.get_blob_client(_blob_name(prefix, name, remote[name])).download_blob(max_concurrency=max_concurrency).readinto(f)
+        os.replace(f.name, path)
+    for name in stale:
+        os.remove(os.path.join(local_dir, name))
+
+    return _report("downloaded", f"{prefix}/ -> {local_dir}", remote, changed, stale, start)
+
+def sync_to_share(container_client, prefix: str, share_client, directory: str, max_concurrency: int = sync_max_concurrency,
+                  manifest: Optional[dict] = None) -> dict:
+    """ copy the files of <prefix>/ (or of the manifest) that differ from <directory>/manifest.json on the file share """
+    start = time.time()
+    remote = read_blob_manifest(container_client, prefix) if manifest is None else manifest
+    if not remote and manifest is None:
+        logging.info(f"No {MANIFEST_NAME} under {prefix}/, copying all of it to the file share")
+        remote = list_blob_dir(container_client, prefix)
+    share = _read_share_manifest(share_client, directory)
+    changed = [name for name, entry in remote.items() if not _same(share.get(name), entry)]
+    stale = [name for name in share if name not in remote]
+
+    # parents first, the file share has no implicit directories
+    parts = directory.split("/")
+    for depth in range(1, len(parts) + 1):
+        try:
+            share_client.get_directory_client("/".join(parts[:depth])).create_directory()
+        except ResourceExistsError:
+            pass
+    if changed or stale:
+        _delete_share_file(share_client, f"{directory}/{MANIFEST_NAME}")
+    for name in changed:
+        # staged through /tmp so both sides are transferred in parallel chunks
+        with tempfile.TemporaryFile() as f:
+            size = container_client.get_blob_client(_blob_name(prefix, name, remote[name])).download_blob(max_concurrency=max_concurrency).readinto(f)
+            f.seek(0)
+            share_client.get_file_client(f"{directory}/{name}").upload_file(f, length=size, max_concurrency=max_concurrency)
+    for name in stale:
+        _delete_share_file(share_client, f"{directory}/{name}")
+    if all(entry["sha256"] is not None for entry in remote.values()):
+        share_manifest = {name: {"sha256": entry["sha256"], "size": entry["size"]} for name, entry in remote.items()}
+        share_client.get_file_client(f"{directory}/{MANIFEST_NAME}").upload_file(json.dumps(share_manifest, indent=2))
+
+    return _report("copied", f"{prefix}/ -> share:{directory}/", remote, changed, stale, start)
+
+def list_blob_dir(container_client, prefix: str) -> dict:
+    """ files directly under <prefix>/ (not those of the sub directories, like the shards of an index) """
+    return {blob.name[len(prefix) + 1:]: {"sha256": None, "size": blob.size}
+            for blob in container_client.list_blobs(name_starts_with=f"{prefix}/")
+            if "/" not in blob.name[len(prefix) + 1:] and not blob.name.endswith(f"/{MANIFEST_NAME}")}
+
+def _same(entry: Optional[dict], other: dict) -> bool:
+    """ same content, as far as the manifests tell (a file of unknown hash is never the same) """
+    return entry is not None and other["sha256"] is not None and \
+        entry["sha256"] == other["sha256"] and entry["size"] == other["size"]
+
+def _blob_name(prefix: str, name: str, entry: dict) -> str:
+    return entry.get("blob") or f"{prefix}/{name}"
+
+def _read_share_manifest(share_client, directory: str) -> dict:
+    try:
+        return json.loads(share_client.get_file_client(f"{directory}/{MANIFEST_NAME}").download_file().readall())
+    except ResourceNotFoundError:
+        return {}
+
+def _delete_blob(container_client, blob_name: str):
+    try:
+        container_client.delete_blob(blob_name)
+    except ResourceNotFoundError:
+        pass
+
+def _delete_share_file(share_client, file_path: str):
+    try:
+        share_client.get_file_client(file_path).delete_file()
+    except ResourceNotFoundError:
+        pass
+
+def _sha256(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def _report(action: str, what: str, manifest: dict, changed: list, stale: list, start: float) -> dict:
+    moved = sum(manifest[name]["size"] or 0 for name in changed)
+    total = sum(entry["size"] or 0 for entry in manifest.values())
+    metrics.observe(f"sync.{action}", time.time() - start)
+    metrics.count(f"sync.{action}_bytes", moved)
+    metrics.count(f"sync.{action}_files", len(changed))
+    logging.info(f"Sync {what}: {action} {len(changed)}/{len(manifest)} files ({moved}/{total} bytes), "
+                 f"removed {len(stale)}, took {time.time() - start:.1f} seconds")
+    return {"files": len(manifest), "changed": len(changed), "removed": len(stale), "bytes": moved, "total_bytes": total}
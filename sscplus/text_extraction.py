@@ -0,0 +1,328 @@
+"""
+html to text for the ssc plus pages.
+
+the reference is what we always did with BeautifulSoup: parse the body with
+html.parser, decompose the ignored selectors and join the stripped strings with
+a space. building that tree is the most expensive part of loading a corpus, so
+the same text can come from different backends:
+
+* "stream": html.parser events only, no tree. ignored subtrees are dropped as
+  they are parsed. same output as "bs4".
+* "lxml" / "selectolax": C parsers, only if installed (they are not in
+  requirements.txt). they build their own tree, so broken markup can come out
+  slightly differently than with "bs4".
+* "bs4": the reference.
+
+see benchmarks/text_extraction.py for the golden pages and pages/sec per backend.
+
+extract_structured_text keeps the structure the chunker needs (see sscplus/chunking.py):
+same strings as "stream", but one line per block (paragraph, list item, table row ...)
+and the headings as markdown style lines ("## Key dates"). flatten_text turns it back
+into the extract_text output, newlines replaced by spaces. the loader only uses
+extract_text (and so the backend) with CHUNKER=llama, the llama_index splitter gets
+the page as a single line.
+"""
+import html.entities
+import logging
+import os
+import re
+from html.parser import HTMLParser
+from typing import Callable, Optional
+
+# remove useless tags like date modified and login blocks (see example in 336 parsed data vs non parsed)
+IGNORE_SELECTORS = ['div.comment-login-message', 'section.block-date-modified-block']
+
+default_backend = os.getenv("TEXT_EXTRACTION_BACKEND", "stream")
+
+# same as bs4's html tree builder: tags that never have content, and tags whose strings
+# are not "text" (they are not returned by stripped_strings)
+EMPTY_ELEMENT_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta',
+                      'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex',
+                      'nextid', 'spacer'}
+STRING_CONTAINER_TAGS = {'rt', 'rp', 'style', 'script', 'template'}
+
+# tags whose text goes on a line of its own in extract_structured_text (cells of a table row stay together)
+BLOCK_TAGS = {'address', 'article', 'aside', 'blockquote', 'caption', 'dd', 'details', 'dialog', 'div', 'dl', 'dt',
+              'fieldset', 'figcaption', 'figure', 'footer', 'form', 'header', 'hr', 'li', 'main', 'nav', 'ol', 'p',
+              'pre', 'section', 'summary', 'table', 'tbody', 'tfoot', 'thead', 'tr', 'ul'}
+HEADING_TAGS = {'h1': 1, 'h2': 2, 'h3': 3, 'h4': 4, 'h5': 5, 'h6': 6}
+HEADING_LINE = re.compile(r"^(#{1,6}) ")
+
+def extract_text(body: str, ignore_selectors: list[str] = IGNORE_SELECTORS, backend: Optional[str] = None) -> str:
+    """ text of an html body, minus the ignored selectors, strings separated by a single space """
+    return get_backend(backend or default_backend)(body, ignore_selectors)
+
+def extract_structured_text(body: str, ignore_selectors: list[str] = IGNORE_SELECTORS) -> str:
+    """ same strings as extract_text, a line per block and "#" * level + " " + text for the headings """
+    parser = _StructureParser([_parse_selector(s) for s in ignore_selectors])
+    parser.feed(body)
+    parser.close()
+    parser.flush(not parser.containers)
+    parser.break_line()
+    return '\n'.join(parser.lines)
+
+def flatten_text(text: str) -> str:
+    """ extract_structured_text back to the extract_text output (with its newlines as spaces) """
+    return ' '.join(line[1:] if line.startswith("\\") else HEADING_LINE.sub("", line) for line in text.split('\n') if line)
+
+def get_backend(name: str) -> Callable[[str, list[str]], str]:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown text extraction backend {name}, expected one of {', '.join(BACKENDS)}")
+    if name not in available_backends():
+        logging.warning(f"Text extraction backend {name} is not installed, using stream instead")
+        name = "stream"
+    return BACKENDS[name]
+
+def available_backends() -> list[str]:
+    available = []
+    for name, module in [("bs4", "bs4"), ("stream", None), ("lxml", "lxml.html"), ("selectolax", "selectolax.lexbor")]:
+        try:
+            if module:
+                __import__(module)
+            available.append(name)
+        except ImportError:
+            continue
+    return available
+
+def _parse_selector(selector: str) -> tuple:
+    """ (tag or None, set of classes) for simple `tag.class1.class2` selectors, the only kind we use """
+    match = re.fullmatch(r"([a-zA-Z][\w-]*)?((?:\.[\w-]+)*)", selector.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        raise ValueError(f"Unsupported selector {selector}, only tag.class selectors are supported")
+    tag = match.group(1).lower() if match.group(1) else None
+    return tag, frozenset(c for c in match.group(2).split(".") if c)
+
+def _matches(selectors: list[tuple], tag: str, classes: Optional[str]) -> bool:
+    if not selectors:
+        return False
+    class_list = set((classes or "").split())
+    return any((s_tag is None or s_tag == tag) and s_classes <= class_list for s_tag, s_classes in selectors)
+
+def _extract_bs4(body: str, ignore_selectors: list[str]) -> str:
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(body, "html.parser")
+    for selector in ignore_selectors:
+        for s in soup.select(selector):
+            s.decompose()
+    return ' '.join(soup.stripped_strings)
+
+_ENTITIES: dict[str, str] = {}
+for _name, _character in sorted(html.entities.html5.items()):
+    _ENTITIES.setdefault(_name[:-1] if _name.endswith(";") else _name, _character)
+
+class _TextParser(HTMLParser):
+    """
+    replays what bs4 does with html.parser events (open tag stack, void elements,
+    when strings are cut) without building the tree. strings are kept only if they
+    are not under an ignored element or a script/style/template/rt/rp tag.
+    """
+    def __init__(self, selectors: list[tuple]):
+        super().__init__(convert_charrefs=False)
+        self.selectors = selectors
+        self.stack: list[str] = []
+        self.ignored_at: Optional[int] = None   # stack depth of the outermost ignored element
+        self.containers: list[int] = []         # stack depth of the open string container tags
+        self.already_closed: list[str] = []
+        self.data: list[str] = []
+        self.strings: list[str] = []
+
+    def flush(self, is_text: bool = True) -> None:
+        if not self.data:
+            return
+        string = ''.join(self.data).strip()
+        self.data = []
+        if string and is_text and self.ignored_at is None:
+            self.strings.append(string)
+
+    def handle_starttag(self, tag, attrs, handle_empty_element=True):
+        self.flush(not self.containers)
+        classes = None
+        for key, value in attrs:
+            if key == "class":
+                classes = value
+        self.stack.append(tag)
+        if self.ignored_at is None and _matches(self.selectors, tag, classes):
+            self.ignored_at = len(self.stack)
+        if tag in STRING_CONTAINER_TAGS:
+            self.containers.append(len(self.stack))
+        if handle_empty_element and tag in EMPTY_ELEMENT_TAGS:
+            self.handle_endtag(tag, check_already_closed=False)
+            self.already_closed.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, handle_empty_element=False)
+        self.handle_endtag(tag, check_already_closed=False)
+
+    def handle_endtag(self, tag, check_already_closed=True):
+        if check_already_closed and tag in self.already_closed:
+            self.already_closed.remove(tag)
+            return
+        self.flush(not self.containers)
+        if tag not in self.stack:
+            return
+        while self.stack:
+            popped = self.stack.pop()
+            if self.ignored_at is not None and len(self.stack) < self.ignored_at:
+                self.ignored_at = None
+            if self.containers and len(self.stack) < self.containers[-1]:
+                self.containers.pop()
+            if popped == tag:
+                break
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_charref(self, name):
+        character, extra = _dereference_charref(name)
+        self.data.append(character)
+        self.data.append(extra)
+
+    def handle_entityref(self, name):
+        self.data.append(_ENTITIES.get(name, "&%s" % name))
+
+    def handle_comment(self, data):
+        self.flush(not self.containers)
+        self.data.append(data)
+        self.flush(False)
+
+    def handle_decl(self, decl):
+        self.handle_comment(decl)
+
+    def handle_pi(self, data):
+        self.handle_comment(data)
+
+    def unknown_decl(self, data):
+        self.flush(not self.containers)
+        if data.upper().startswith("CDATA["):
+            # CDATA sections are text, even inside a string container
+            self.data.append(data[len("CDATA["):])
+            self.flush(True)
+        else:
+            self.data.append(data)
+            self.flush(False)
+
+class _StructureParser(_TextParser):
+    """ _TextParser that also groups the strings in lines, at the start and end of block/heading tags """
+    def __init__(self, selectors: list[tuple]):
+        super().__init__(selectors)
+        self.lines: list[str] = []
+        self.line: list[str] = []
+        self.heading: Optional[int] = None
+
+    def flush(self, is_text: bool = True) -> None:
+        count = len(self.strings)
+        super().flush(is_text)
+        if len(self.strings) > count:
+            self.line.append(self.strings[-1])
+
+    def break_line(self) -> None:
+        if not self.line:
+            return
+        # newlines kept inside strings would start new lines
+        line = ' '.join(self.line).replace('\n', ' ')
+        self.line = []
+        if self.heading is not None:
+            line = "#" * self.heading + " " + line
+        elif line.startswith(("#", "\\")):
+            # escaped, so text can't be read as a heading line
+            line = "\\" + line
+        self.lines.append(line)
+
+    def handle_starttag(self, tag, attrs, handle_empty_element=True):
+        super().handle_starttag(tag, attrs, handle_empty_element)
+        if tag in BLOCK_TAGS or tag in HEADING_TAGS:
+            self.break_line()
+        if tag in HEADING_TAGS:
+            self.heading = HEADING_TAGS[tag]
+
+    def handle_endtag(self, tag, check_already_closed=True):
+        super().handle_endtag(tag, check_already_closed)
+        if tag in BLOCK_TAGS or tag in HEADING_TAGS:
+            self.break_line()
+        if tag in HEADING_TAGS:
+            self.heading = None
+
+def _dereference_charref(name: str) -> tuple[str, str]:
+    """ numeric character reference to (character, trailing data), the way bs4 does it """
+    base, pattern = 10, r"^([0-9]+)(.*)"
+    if name.startswith("x") or name.startswith("X"):
+        name, base, pattern = name[1:], 16, r"^([0-9a-f]+)(.*)"
+
+    extra = ""
+    try:
+        number = int(name, base)
+    except ValueError:
+        match = re.search(pattern, name)
+        if match is None:
+            return "", name
+        number, extra = int(match.group(1), base), match.group(2)
+
+    if number == 0 or number > 0x10ffff or 0xd800 <= number <= 0xdfff:
+        return "\ufffd", extra
+    if 0x80 <= number <= 0x9f:
+        try:
+            return bytes([number]).decode("windows-1252"), extra
+        except UnicodeDecodeError:
+            pass
+    return chr(number), extra
+
+def _extract_stream(body: str, ignore_selectors: list[str]) -> str:
+    parser = _TextParser([_parse_selector(s) for s in ignore_selectors])
+    parser.feed(body)
+    parser.close()
+    parser.flush(not parser.containers)
+    return ' '.join(parser.strings)
+
+def _extract_lxml(body: str, ignore_selectors: list[str]) -> str:
+    import lxml.html
+    from lxml import etree
+
+    if not body.strip():
+        return ""
+    selectors = [_parse_selector(s) for s in ignore_selectors]
+    root = lxml.html.document_fromstring(body)
+    for el in [el for el in root.iter(tag=etree.Element) if _matches(selectors, el.tag, el.get("class"))]:
+        el.drop_tree()
+
+    strings: list[str] = []
+    def walk(el):
+        if isinstance(el.tag, str) and el.tag not in STRING_CONTAINER_TAGS:
+            if el.text and el.text.strip():
+                strings.append(el.text.strip())
+            for child in el:
+                walk(child)
+        if el.tail and el.tail.strip() and el is not root:
+            strings.append(el.tail.strip())
+    walk(root)
+    return ' '.join(strings)
+
+def _extract_selectolax(body: str, ignore_selectors: list[str]) -> str:
+    from selectolax.lexbor import LexborHTMLParser
+
+    tree = LexborHTMLParser(body)
+    for selector in ignore_selectors:
+        for node in tree.css(selector):
+            node.decompose()
+    if tree.root is None:
+        return ""
+
+    strings: list[str] = []
+    for node in tree.root.traverse(include_text=True):
+        if node.tag != "-text":
+            continue
+        parent, excluded = node.parent, False
+        while parent is not None and not excluded:
+            excluded = parent.tag in STRING_CONTAINER_TAGS
+            parent = parent.parent
+        text = (node.text_content or "").strip()
+        if text and not excluded:
+            strings.append(text)
+    return ' '.join(strings)
+
+BACKENDS: dict[str, Callable[[str, list[str]], str]] = {
+    "bs4": _extract_bs4,
+    "stream": _extract_stream,
+    "lxml": _extract_lxml,
+    "selectolax": _extract_selectolax,
+}
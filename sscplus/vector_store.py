@@ -0,0 +1,382 @@
+"""
+llama_index vector store persisted as a numpy array instead of json.
+
+SimpleVectorStore writes every embedding as a list of floats in
+default__vector_store.json, which is slow to parse and takes several times the
+memory of the floats themselves once loaded. NumpyVectorStore writes:
+
+  default__vector_store.npy       (nodes x dimensions) float32 (or float16) matrix
+  default__vector_store.ids.json  node ids, ref doc ids and metadata, one entry per row
+  default__vector_store.ivf.npz   approximate search index, for bigger indices (see sscplus/retrieval.py)
+
+the matrix is memory-mapped on load, rows are only read when they are queried
+or written back. deleted rows are skipped and additions are kept on the side
+until the store is persisted again (compacted in blocks), or spilled to disk:
+the rows to a raw matrix file, their ids and metadata to a sqlite file.
+
+VECTOR_STORE_FORMAT=json keeps the llama_index default (SimpleVectorStore),
+VECTOR_STORE_DTYPE=float16 halves the size of the matrix.
+"""
+import itertools
+import json
+import logging
+import os
+import sqlite3
+from typing import Any, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+from llama_index import StorageContext
+from llama_index.indices.query.embedding_utils import (
+    get_top_k_embeddings_learner, get_top_k_mmr_embeddings)
+from llama_index.schema import BaseNode
+from llama_index.vector_stores import SimpleVectorStore
+from llama_index.vector_stores.simple import (DEFAULT_VECTOR_STORE, LEARNER_MODES, MMR_MODE, NAMESPACE_SEP,
+                                              _build_metadata_filter_fn)
+from llama_index.vector_stores.types import (DEFAULT_PERSIST_DIR, DEFAULT_PERSIST_FNAME, VectorStore, VectorStoreQuery,
+                                             VectorStoreQueryMode, VectorStoreQueryResult)
+from llama_index.vector_stores.utils import node_to_metadata_dict
+
+from sscplus.retrieval import BLOCK_ROWS, ExactSearch, IVFIndex, cosine_scores, ivf_min_nodes, top_k
+
+vector_store_format = os.getenv("VECTOR_STORE_FORMAT", "numpy").lower()
+vector_store_dtype  = os.getenv("VECTOR_STORE_DTYPE", "float32").lower()
+
+_ROOT_NAME = DEFAULT_PERSIST_FNAME[:-len(".json")]
+
+class SpilledRows:
+    """ node id, ref doc id and metadata of the live rows of a spilled NumpyVectorStore, in a sqlite file """
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # scratch space, nothing to recover after a crash
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute("CREATE TABLE rows (position INTEGER PRIMARY KEY, node_id TEXT NOT NULL, ref_doc_id TEXT NOT NULL, metadata TEXT NOT NULL)")
+        self.connection.execute("CREATE INDEX rows_node_id ON rows (node_id)")
+        self.connection.execute("CREATE INDEX rows_ref_doc_id ON rows (ref_doc_id)")
+        self.count = 0
+
+    def add(self, rows: Iterable[tuple[int, str, str, dict]]) -> None:
+        before = self.connection.total_changes
+        self.connection.executemany("INSERT INTO rows (position, node_id, ref_doc_id, metadata) VALUES (?, ?, ?, ?)",
+                                    ((position, node_id, ref_doc_id, json.dumps(metadata)) for position, node_id, ref_doc_id, metadata in rows))
+        self.connection.commit()
+        self.count += self.connection.total_changes - before
+
+    def delete(self, node_ids: Sequence[str]) -> None:
+        for start in range(0, len(node_ids), 500):
+            chunk = list(node_ids[start:start + 500])
+            self.count -= self.connection.execute(f"DELETE FROM rows WHERE node_id IN ({','.join('?' * len(chunk))})", chunk).rowcount
+        self.connection.commit()
+
+    def delete_ref_doc(self, ref_doc_id: str) -> None:
+        self.count -= self.connection.execute("DELETE FROM rows WHERE ref_doc_id = ?", (ref_doc_id,)).rowcount
+        self.connection.commit()
+
+    def position(self, node_id: str) -> Optional[int]:
+        row = self.connection.execute("SELECT position FROM rows WHERE node_id = ?", (node_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def node_id(self, position: int) -> str:
+        return self.connection.execute("SELECT node_id FROM rows WHERE position = ?", (position,)).fetchone()[0]
+
+    def metadata(self, node_id: str) -> dict:
+        return json.loads(self.connection.execute("SELECT metadata FROM rows WHERE node_id = ?", (node_id,)).fetchone()[0])
+
+    def items(self) -> Iterator[tuple[str, int]]:
+        """ (node id, position) of the rows, in order """
+        return iter(self.connection.execute("SELECT node_id, position FROM rows ORDER BY position"))
+
+    def column(self, name: str) -> Iterator[Any]:
+        """ position, node_id, ref_doc_id or metadata (as json) of the rows, in order """
+        assert name in ("position", "node_id", "ref_doc_id", "metadata")
+        return (value for value, in self.connection.execute(f"SELECT {name} FROM rows ORDER BY position"))
+
+    def close(self) -> None:
+        self.connection.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class NumpyVectorStore(VectorStore):
+    stores_text: bool = False
+
+    def __init__(self, embeddings: Optional[np.ndarray] = None, ids: Optional[list] = None,
+                 ref_doc_ids: Optional[list] = None, metadata: Optional[list] = None, dtype: str = vector_store_dtype):
+        self.dtype = np.dtype(dtype)
+        self._base = embeddings if embeddings is not None else np.empty((0, 0), dtype=self.dtype)
+        self._extra: list[np.ndarray] = []
+        # rows from _offset on, the ones before it were spilled to _rows
+        self._offset = 0
+        self._rows: Optional[SpilledRows] = None
+        self._ids: list[str] = list(ids or [])
+        self._ref_doc_ids: list[str] = list(ref_doc_ids or [])
+        self._metadata: list[dict] = list(metadata or [{} for _ in self._ids])
+        # node id -> row of the live nodes, rows of deleted / replaced nodes are dropped on persist
+        self._positions = {node_id: position for position, node_id in enumerate(self._ids)}
+        self._exact: Optional[ExactSearch] = None
+        self._ivf: Optional[IVFIndex] = None
+        self._spill_path: Optional[str] = None
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, namespace: str = DEFAULT_VECTOR_STORE, mmap: bool = True) -> "NumpyVectorStore":
+        root = os.path.join(persist_dir, f"{namespace}{NAMESPACE_SEP}{_ROOT_NAME}")
+        with open(root + ".ids.json", encoding="utf-8") as f:
+            table = json.load(f)
+        embeddings = np.load(root + ".npy", mmap_mode="r" if mmap else None)
+        store = cls(embeddings, table["ids"], table["ref_doc_ids"], table["metadata"], dtype=str(embeddings.dtype))
+        if os.path.exists(root + ".ivf.npz"):
+            store._ivf = IVFIndex.load(root + ".ivf.npz")
+        return store
+
+    @classmethod
+    def from_simple(cls, store: SimpleVectorStore, dtype: str = vector_store_dtype) -> "NumpyVectorStore":
+        """ convert an index persisted in the json format """
+        data = store._data
+        ids = list(data.embedding_dict)
+        embeddings = np.array([data.embedding_dict[node_id] for node_id in ids], dtype=dtype) if ids else None
+        return cls(embeddings, ids, [data.text_id_to_ref_doc_id.get(node_id, "None") for node_id in ids],
+                   [(data.metadata_dict or {}).get(node_id, {}) for node_id in ids], dtype=dtype)
+
+    @property
+    def client(self) -> None:
+        return None
+
+    def get(self, text_id: str) -> List[float]:
+        position = self._positions.get(text_id)
+        if position is None and self._rows is not None:
+            position = self._rows.position(text_id)
+        if position is None:
+            raise KeyError(text_id)
+        return self._row(position).astype(np.float32).tolist()
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        if self._rows is not None:
+            # the nodes added again replace their spilled rows
+            self._rows.delete([node.node_id for node in nodes])
+        for node in nodes:
+            metadata = node_to_metadata_dict(node, remove_text=True, flat_metadata=False)
+            metadata.pop("_node_content", None)
+            self._positions[node.node_id] = self._offset + len(self._ids)
+            self._ids.append(node.node_id)
+            self._ref_doc_ids.append(node.ref_doc_id or "None")
+            self._metadata.append(metadata)
+            self._extra.append(np.asarray(node.get_embedding(), dtype=self.dtype))
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        self.delete_nodes([node_id for node_id, position in self._positions.items() if self._ref_doc_ids[position - self._offset] == ref_doc_id])
+        if self._rows is not None:
+            self._rows.delete_ref_doc(ref_doc_id)
+
+    def delete_nodes(self, node_ids: Sequence[str]) -> None:
+        for node_id in node_ids:
+            self._positions.pop(node_id, None)
+        if self._rows is not None:
+            self._rows.delete(node_ids)
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        metadata_filter = _build_metadata_filter_fn(self._node_metadata, query.filters)
+        available_ids = set(query.node_ids) if query.node_ids is not None else None
+        positions = [position for node_id, position in self._live()
+                     if (available_ids is None or node_id in available_ids) and metadata_filter(node_id)]
+        positions.sort()
+        query_embedding = np.asarray(query.query_embedding, dtype=np.float32)
+
+        if query.mode == VectorStoreQueryMode.DEFAULT:
+            if query.filters is None and query.node_ids is None and not self._extra and self._count() == self._base.shape[0]:
+                # unchanged since it was loaded, rows are positions: search the matrix directly (through the IVF index if any)
+                if self._exact is None:
+                    self._exact = ExactSearch(self._base)
+                if self._ivf is not None:
+                    rows, similarities = self._ivf.search(self._exact, query_embedding, query.similarity_top_k)
+                else:
+                    rows, similarities = self._exact.search(query_embedding, query.similarity_top_k)
+                return VectorStoreQueryResult(similarities=similarities.tolist(), ids=[self._node_id(row) for row in rows])
+            # cosine similarity of every candidate at once, block by block, then top k without a full sort
+            similarities = np.concatenate([cosine_scores(block, query_embedding) for block in self._iter_blocks(positions)] or
+                                          [np.empty(0, dtype=np.float32)])
+            top = top_k(similarities, query.similarity_top_k)
+            return VectorStoreQueryResult(similarities=similarities[top].tolist(), ids=[self._node_id(positions[i]) for i in top])
+
+        node_ids = [self._node_id(position) for position in positions]
+        embeddings = [row.tolist() for block in self._iter_blocks(positions) for row in block]
+        if query.mode in LEARNER_MODES:
+            similarities, ids = get_top_k_embeddings_learner(query_embedding.tolist(), embeddings,
+                                                              similarity_top_k=query.similarity_top_k, embedding_ids=node_ids)
+        elif query.mode == MMR_MODE:
+            similarities, ids = get_top_k_mmr_embeddings(query_embedding.tolist(), embeddings, similarity_top_k=query.similarity_top_k,
+                                                         embedding_ids=node_ids, mmr_threshold=kwargs.get("mmr_threshold", None))
+        else:
+            raise ValueError(f"Invalid query mode: {query.mode}")
+        return VectorStoreQueryResult(similarities=similarities, ids=ids)
+
+    def persist(self, persist_path: str = os.path.join(DEFAULT_PERSIST_DIR, DEFAULT_PERSIST_FNAME), fs: Optional[Any] = None) -> None:
+        """ persist_path is the json name StorageContext.persist asks for, the .npy / .ids.json pair is written next to it """
+        root = persist_path[:-len(".json")] if persist_path.endswith(".json") else persist_path
+        os.makedirs(os.path.dirname(root) or ".", exist_ok=True)
+        count, dim = self._count(), self._dim()
+
+        # written block by block into a new file, the matrix we read from may be a memory map of the previous one
+        with open(root + ".npy.tmp", "wb") as f:
+            np.lib.format.write_array_header_1_0(f, {"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False, "shape": (count, dim)})
+            for positions in _chunks(self._live_positions(), BLOCK_ROWS):
+                for block in self._iter_blocks(positions, dtype=self.dtype):
+                    f.write(block.tobytes())
+        # same file as json.dump of the whole table, a row at a time
+        with open(root + ".ids.json.tmp", "w", encoding="utf-8") as f:
+            f.write(f'{{"dtype": {json.dumps(self.dtype.name)}, "dim": {dim}')
+            for key, column in [("ids", "node_id"), ("ref_doc_ids", "ref_doc_id"), ("metadata", "metadata")]:
+                f.write(f', "{key}": [')
+                for i, value in enumerate(self._column(column)):
+                    f.write(", " + value if i else value)
+                f.write("]")
+            f.write("}")
+        os.replace(root + ".npy.tmp", root + ".npy")
+        os.replace(root + ".ids.json.tmp", root + ".ids.json")
+        logging.info(f"Persisted {count} embeddings ({dim} x {self.dtype.name}) to {root}.npy")
+
+        # the IVF index refers to rows of the matrix, it is rebuilt for every new matrix
+        if ivf_min_nodes and count >= ivf_min_nodes:
+            IVFIndex.build(ExactSearch(np.load(root + ".npy", mmap_mode="r"))).save(root + ".ivf.npz")
+        elif os.path.exists(root + ".ivf.npz"):
+            os.remove(root + ".ivf.npz")
+
+    def spill(self, path: str, rows_path: str) -> None:
+        """
+        move the rows added since the last call to the end of a raw matrix file at path, memory mapped
+        instead of held in memory, and their ids and metadata to a sqlite file at rows_path (streaming
+        builds, see sscplus/spill.py). the rows the store was loaded with are moved there the first time
+        """
+        if not self._ids:
+            return
+        dim = self._dim()
+        if self._spill_path != path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "wb") as f:
+                for start in range(0, self._base.shape[0], BLOCK_ROWS):
+                    rows = np.arange(start, min(start + BLOCK_ROWS, self._base.shape[0]))
+                    f.write(np.asarray(_read_rows(self._base, rows), dtype=self.dtype).tobytes())
+            self._spill_path = path
+            self._rows = SpilledRows(rows_path)
+        with open(path, "ab") as f:
+            for start in range(0, len(self._extra), BLOCK_ROWS):
+                f.write(np.asarray(self._extra[start:start + BLOCK_ROWS], dtype=self.dtype).tobytes())
+        assert self._rows is not None
+        self._rows.add((position, node_id, self._ref_doc_ids[position - self._offset], self._metadata[position - self._offset])
+                       for node_id, position in sorted(self._positions.items(), key=lambda item: item[1]))
+        rows = self._offset + len(self._ids)
+        self._base = np.memmap(path, dtype=self.dtype, mode="r", shape=(rows, dim))
+        self._offset, self._extra, self._ids, self._ref_doc_ids, self._metadata, self._positions = rows, [], [], [], [], {}
+        # both were made for the previous matrix
+        self._exact, self._ivf = None, None
+
+    def close(self) -> None:
+        """ once a spilled store is persisted, it is not used after that """
+        if self._rows is not None:
+            self._rows.close()
+
+    def _dim(self) -> int:
+        if self._base.shape[0]:
+            return self._base.shape[1]
+        return len(self._extra[0]) if self._extra else 0
+
+    def _count(self) -> int:
+        return len(self._positions) + (self._rows.count if self._rows is not None else 0)
+
+    def _live(self) -> Iterator[tuple[str, int]]:
+        """ (node id, position) of the live rows """
+        if self._rows is not None:
+            yield from self._rows.items()
+        yield from self._positions.items()
+
+    def _live_positions(self) -> Iterator[int]:
+        """ positions of the live rows, in order (the spilled ones are before the others) """
+        if self._rows is not None:
+            yield from self._rows.column("position")
+        yield from sorted(self._positions.values())
+
+    def _column(self, name: str) -> Iterator[str]:
+        """ node_id, ref_doc_id or metadata of the live rows, in order and json encoded """
+        if self._rows is not None:
+            values = self._rows.column(name)
+            yield from values if name == "metadata" else map(json.dumps, values)
+        column = {"node_id": self._ids, "ref_doc_id": self._ref_doc_ids, "metadata": self._metadata}[name]
+        for position in sorted(self._positions.values()):
+            yield json.dumps(column[position - self._offset])
+
+    def _node_id(self, position: int) -> str:
+        if position >= self._offset:
+            return self._ids[position - self._offset]
+        assert self._rows is not None
+        return self._rows.node_id(position)
+
+    def _node_metadata(self, node_id: str) -> dict:
+        position = self._positions.get(node_id)
+        if position is not None:
+            return self._metadata[position - self._offset]
+        assert self._rows is not None
+        return self._rows.metadata(node_id)
+
+    def _row(self, position: int) -> np.ndarray:
+        base_rows = self._base.shape[0]
+        return self._base[position] if position < base_rows else self._extra[position - base_rows]
+
+    def _iter_blocks(self, positions: Sequence[int], dtype=np.float32) -> Iterator[np.ndarray]:
+        """ rows at (sorted) positions, BLOCK_ROWS at a time """
+        base_rows = self._base.shape[0]
+        for start in range(0, len(positions), BLOCK_ROWS):
+            block = positions[start:start + BLOCK_ROWS]
+            split = int(np.searchsorted(block, base_rows))
+            parts = []
+            if split:
+                # a spilled matrix is only read through its file, see _read_rows
+                rows = _read_rows(self._base, np.asarray(block[:split])) if self._spill_path else self._base[block[:split]]
+                parts.append(np.asarray(rows, dtype=dtype))
+            if split < len(block):
+                parts.append(np.asarray([self._extra[position - base_rows] for position in block[split:]], dtype=dtype))
+            yield parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+def _chunks(values: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(values)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+def _read_rows(matrix: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """
+    rows (sorted) of a memory mapped matrix, read from its file: the pages read through the map
+    would count in the memory of the process until it is unmapped
+    """
+    if not isinstance(matrix, np.memmap) or matrix.filename is None:
+        return matrix[rows]
+    row_bytes = matrix.shape[1] * matrix.dtype.itemsize
+    result = np.empty((len(rows), matrix.shape[1]), dtype=matrix.dtype)
+    done = 0
+    with open(matrix.filename, "rb") as f:
+        # one read per run of consecutive rows
+        for run in np.split(rows, np.flatnonzero(np.diff(rows) != 1) + 1):
+            if not len(run):
+                continue
+            f.seek(matrix.offset + int(run[0]) * row_bytes)
+            result[done:done + len(run)] = np.frombuffer(f.read(len(run) * row_bytes), dtype=matrix.dtype).reshape(len(run), -1)
+            done += len(run)
+    return result
+
+def new_vector_store():
+    """ empty vector store in the configured format, for a new index """
+    return NumpyVectorStore() if vector_store_format == "numpy" else SimpleVectorStore()
+
+def load_vector_store(persist_dir: str):
+    """ the vector store of a persisted index, whichever format it was persisted in """
+    if os.path.exists(os.path.join(persist_dir, f"{DEFAULT_VECTOR_STORE}{NAMESPACE_SEP}{_ROOT_NAME}.npy")):
+        return NumpyVectorStore.from_persist_dir(persist_dir)
+    store = SimpleVectorStore.from_namespaced_persist_dir(persist_dir)[DEFAULT_VECTOR_STORE]
+    if vector_store_format == "numpy":
+        logging.info(f"Converting the json vector store of {persist_dir}, it will be persisted as numpy")
+        return NumpyVectorStore.from_simple(store)
+    return store
+
+def storage_context_from_persist_dir(persist_dir: str) -> StorageContext:
+    return StorageContext.from_defaults(persist_dir=persist_dir, vector_store=load_vector_store(persist_dir))
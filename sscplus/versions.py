@@ -0,0 +1,250 @@
+"""
+immutable versions of the indices and the pointers publishing them.
+
+a build or an update of an index never overwrites the files of the index in
+use: it writes the files that changed under versions/<version>/ of the indices
+container, then versions/<version>/version.json lists all of its files:
+
+  {"version": "20240601T000000-1a2b3c4d", "parent": "<version it was made from>", "created": "...",
+   "router": {"shards": {...}} (None for an unsharded index, see sscplus/shards.py),
+   "files": {"page-en/docstore.json": {"sha256": "...", "size": 123, "blob": "versions/<version>/page-en/docstore.json"}, ...}}
+
+a file that did not change since the parent version is not uploaded again, its
+entry names the blob of the version that wrote it. a version is only used once
+pointers/<name>.json ({"version": ..., "previous": ...}) names it: that is one
+blob written in one request, readers see the previous version or the new one,
+never a mix of both, and pointing a name back at an older version is a
+rollback. versions no pointer names are pruned, but the INDEX_VERSIONS_KEEP
+most recent ones.
+
+indices written before there were versions (<name>/router.json, <name>/<shard>/
+and their manifest.json) become a version the first time their name is
+resolved, the version refers to their files where they are.
+
+on the chatbot file share, a version is copied to versions/<version>/ and
+latest.json names the one to load, see sync_version_to_share and resolve_persist_dir.
+"""
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Optional
+
+from azure.core import MatchConditions
+from azure.core.exceptions import (ResourceExistsError, ResourceModifiedError,
+                                   ResourceNotFoundError)
+
+from sscplus.metrics import metrics
+from sscplus.sync import list_blob_dir, read_blob_manifest, sync_to_share
+
+VERSIONS_PREFIX = "versions"
+POINTERS_PREFIX = "pointers"
+VERSION_NAME = "version.json"
+ROUTER_NAME = "router.json"
+# on the file share, next to versions/
+SHARE_POINTER_NAME = "latest.json"
+
+versions_keep = int(os.getenv("INDEX_VERSIONS_KEEP", "8"))
+
+def new_version(now: datetime, seed: str) -> str:
+    """ sorted by creation time, seed (the id of the run making it) keeps two of them apart """
+    return f"{now.strftime('%Y%m%dT%H%M%S')}-{hashlib.sha256(seed.encode('utf-8')).hexdigest()[:8]}"
+
+def version_prefix(version: str, directory: str = "") -> str:
+    return f"{VERSIONS_PREFIX}/{version}/{directory}".rstrip("/")
+
+def read_pointer(container_client, name: str) -> tuple[Optional[dict], Optional[str]]:
+    """ pointer of the index <name> and its etag, (None, None) if there is none """
+    try:
+        download = container_client.get_blob_client(f"{POINTERS_PREFIX}/{name}.json").download_blob()
+    except ResourceNotFoundError:
+        return None, None
+    return json.loads(download.readall()), download.properties.etag
+
+def read_version(container_client, version: str) -> Optional[dict]:
+    try:
+        return json.loads(container_client.get_blob_client(f"{version_prefix(version)}/{VERSION_NAME}").download_blob().readall())
+    except ResourceNotFoundError:
+        return None
+
+def resolve(container_client, name: str) -> Optional[dict]:
+    """ the version the index <name> points at, None if there is no such index """
+    pointer, _ = read_pointer(container_client, name)
+    if pointer is not None:
+        return read_version(container_client, pointer["version"])
+    files, router = _unversioned_files(container_client, name)
+    if not files:
+        return None
+    version = write_version(container_client, new_version(datetime.now(timezone.utc), name), files, router, None)
+    try:
+        publish(container_client, name, version["version"])
+    except ResourceExistsError:
+        # another activity got there first, its version is the one in use
+        return resolve(container_client, name)
+    logging.info(f"Index {name}/ published as version {version['version']}, its files are not copied")
+    return version
+
+def directory_files(version: Optional[dict], directory: str = "") -> dict:
+    """ {file name: entry} of the files of a version right under <directory>/ ("" for the top) """
+    start = f"{directory}/" if directory else ""
+    return {path[len(start):]: entry for path, entry in (version or {}).get("files", {}).items()
+            if path.startswith(start) and "/" not in path[len(start):]}
+
+def replace_directory(files: dict, directory: str, entries: dict) -> dict:
+    """ files of a version, those right under <directory>/ replaced by entries ({file name: entry}) """
+    start = f"{directory}/" if directory else ""
+    kept = {path: entry for path, entry in files.items() if not (path.startswith(start) and "/" not in path[len(start):])}
+    return {**kept, **{start + name: entry for name, entry in entries.items()}}
+
+def write_version(container_client, version: str, files: dict, router: Optional[dict], parent: Optional[str]) -> dict:
+    """ version.json of a version whose files are uploaded (the router is written along with it) """
+    files = {path: entry for path, entry in files.items() if path != ROUTER_NAME}
+    if router is not None:
+        data = json.dumps(router, indent=2).encode("utf-8")
+        blob_name = f"{version_prefix(version)}/{ROUTER_NAME}"
+        container_client.get_blob_client(blob_name).upload_blob(data, overwrite=True)
+        files[ROUTER_NAME] = {"sha256": hashlib.sha256(data).hexdigest(), "size": len(data), "blob": blob_name}
+    manifest = {"version": version, "parent": parent, "created": datetime.now(timezone.utc).isoformat(),
+                "router": router, "files": dict(sorted(files.items()))}
+    container_client.get_blob_client(f"{version_prefix(version)}/{VERSION_NAME}").upload_blob(json.dumps(manifest, indent=2), overwrite=True)
+    return manifest
+
+def publish(container_client, name: str, version: str, expected: Optional[str] = None) -> dict:
+    """
+    point the index <name> at a written version. with expected, only if <name> still points at that
+    version (the one the new version was made from), ResourceModifiedError otherwise.
+    """
+    if read_version(container_client, version) is None:
+        raise ResourceNotFoundError(f"No version {version} of the indices")
+    pointer, etag = read_pointer(container_client, name)
+    previous = pointer["version"] if pointer else None
+    if expected is not None and previous != expected:
+        raise ResourceModifiedError(f"Index {name} points at {previous}, not {expected} anymore")
+
+    data = json.dumps({"version": version, "previous": previous, "published": datetime.now(timezone.utc).isoformat()}, indent=2)
+    blob_client = container_client.get_blob_client(f"{POINTERS_PREFIX}/{name}.json")
+    # only if nobody published in between
+    if etag is None:
+        blob_client.upload_blob(data, overwrite=False)
+    else:
+        blob_client.upload_blob(data, overwrite=True, etag=etag, match_condition=MatchConditions.IfNotModified)
+    metrics.count("index.published")
+    logging.info(f"Index {name} now points at version {version} (was {previous})")
+    return {"name": name, "version": version, "previous": previous}
+
+def prune(container_client, keep: int = versions_keep) -> int:
+    """
+    delete the versions no pointer names, but the `keep` most recent ones, with the files no other
+    version uses. returns how many versions were deleted
+    """
+    names = list(container_client.list_blob_names(name_starts_with=f"{VERSIONS_PREFIX}/"))
+    prefixes = sorted({name.split("/")[1] for name in names})
+    versions = sorted({name.split("/")[1] for name in names if name.endswith(f"/{VERSION_NAME}")})
+    pointed = set()
+    for name in container_client.list_blob_names(name_starts_with=f"{POINTERS_PREFIX}/"):
+        pointed.add(json.loads(container_client.get_blob_client(name).download_blob().readall())["version"])
+    kept = set(versions[-keep:] if keep > 0 else []) | pointed
+    if not versions or not kept:
+        return 0
+    # files of a version being written have no version.json yet, they are more recent than the oldest kept
+    # version. older ones are what is left of a failed build or a version pruned while others used its files
+    oldest = min(kept)
+    stale = [prefix for prefix in prefixes if prefix not in kept and (prefix in versions or prefix < oldest)]
+    if not stale:
+        return 0
+
+    used = {entry["blob"] for version in kept for entry in (read_version(container_client, version) or {}).get("files", {}).values()}
+    for prefix in stale:
+        # version.json first, a version is gone as soon as it is
+        under = [name for name in names if name.startswith(f"{VERSIONS_PREFIX}/{prefix}/")]
+        for name in sorted(under, key=lambda name: not name.endswith(f"/{VERSION_NAME}")):
+            if name not in used:
+                _delete_blob(container_client, name)
+    pruned = len([prefix for prefix in stale if prefix in versions])
+    metrics.count("index.pruned_versions", pruned)
+    logging.info(f"Pruned {pruned} version(s) of the indices, {len(kept)} kept")
+    return pruned
+
+def sync_version_to_share(container_client, version: dict, share_client) -> dict:
+    """
+    copy a version to versions/<version>/ of the file share, then point latest.json at it. the
+    directory of an older version is renamed and updated rather than copied from scratch, the
+    directories of the version in use and of the new one are kept.
+    """
+    name = version["version"]
+    pointer = _read_share_json(share_client, SHARE_POINTER_NAME)
+    current = pointer["version"] if pointer else None
+    existing = _list_share_dirs(share_client, VERSIONS_PREFIX)
+    if name not in existing:
+        spare = [other for other in existing if other != current]
+        if spare:
+            # its manifests make the sync below only copy what changed since that version
+            share_client.get_directory_client(version_prefix(spare[0])).rename_directory(version_prefix(name))
+            existing = [other for other in existing if other != spare[0]] + [name]
+
+    directories = sorted({path.rpartition("/")[0] for path in version["files"]})
+    results = {directory or ".": sync_to_share(container_client, version_prefix(name, directory), share_client,
+                                               version_prefix(name, directory), manifest=directory_files(version, directory))
+               for directory in directories}
+    # shards of the version that was renamed which this one does not have
+    for directory in _list_share_dirs(share_client, version_prefix(name)):
+        if directory not in directories:
+            _delete_share_dir(share_client, version_prefix(name, directory))
+
+    # written last, the chatbot only sees the version once all of it is copied
+    share_client.get_file_client(SHARE_POINTER_NAME).upload_file(json.dumps({"version": name, "previous": current}, indent=2))
+    for other in existing:
+        if other not in (name, current):
+            _delete_share_dir(share_client, version_prefix(other))
+    logging.info(f"Version {name} copied to the file share (was {current})")
+    return results
+
+def resolve_persist_dir(root: str) -> str:
+    """ directory of the version to load, in the file share mounted at root (<root>/latest before there were versions) """
+    try:
+        with open(os.path.join(root, SHARE_POINTER_NAME), encoding="utf-8") as f:
+            return os.path.join(root, version_prefix(json.load(f)["version"]))
+    except FileNotFoundError:
+        return os.path.join(root, "latest")
+
+def _unversioned_files(container_client, name: str) -> tuple[dict, Optional[dict]]:
+    """ files (and router) of an index written under <name>/ before there were versions """
+    try:
+        router = json.loads(container_client.get_blob_client(f"{name}/{ROUTER_NAME}").download_blob().readall())
+    except ResourceNotFoundError:
+        router = None
+    files = {}
+    for directory in (list(router["shards"]) if router else [""]):
+        prefix = f"{name}/{directory}".rstrip("/")
+        manifest = read_blob_manifest(container_client, prefix) or list_blob_dir(container_client, prefix)
+        files.update({f"{directory}/{file}".lstrip("/"): {**entry, "blob": f"{prefix}/{file}"} for file, entry in manifest.items()})
+    return files, router
+
+def _delete_blob(container_client, blob_name: str) -> None:
+    try:
+        container_client.delete_blob(blob_name)
+    except ResourceNotFoundError:
+        pass
+
+def _read_share_json(share_client, file_path: str) -> Optional[dict]:
+    try:
+        return json.loads(share_client.get_file_client(file_path).download_file().readall())
+    except ResourceNotFoundError:
+        return None
+
+def _list_share_dirs(share_client, directory: str) -> list[str]:
+    try:
+        return sorted(item["name"] for item in share_client.get_directory_client(directory).list_directories_and_files()
+                      if item["is_directory"])
+    except ResourceNotFoundError:
+        return []
+
+def _delete_share_dir(share_client, directory: str) -> None:
+    directory_client = share_client.get_directory_client(directory)
+    for item in directory_client.list_directories_and_files():
+        if item["is_directory"]:
+            _delete_share_dir(share_client, f"{directory}/{item['name']}")
+        else:
+            directory_client.delete_file(item["name"])
+    directory_client.delete_directory()
@@ -132,7 +132,7 @@ resource "azurerm_linux_function_app" "main" {
 
   virtual_network_subnet_id = data.azurerm_subnet.subscription-vnet-sub.id
 
-  # just run zip package.zip function_app.py requirements.txt host.json
+  # just run zip -r package.zip function_app.py sscplus requirements.txt host.json
   zip_deploy_file = var.zip_deploy_file
 
   identity {